@@ -3,19 +3,59 @@
 
 import os
 import json
-import requests
+import time
 from flask import Blueprint, request, jsonify, Response, make_response
+from werkzeug.exceptions import ClientDisconnected
+from IspLookup import create_isp_lookup # Cached, pluggable ISP lookups for getIP.
+from TransferStats import download_ledger, upload_ledger # Server-side accounting of speed test transfers.
 
 # Define blueprint for backend routes
 backend_bp = Blueprint("backend_bp", __name__)
 
 # Pre-generate a buffer of random data (1 MB of random bytes) for garbage endpoint.
 PREGENERATED_DATA = os.urandom(1024 * 1024)
-# Define timeout duration in seconds for external API calls.
-API_TIMEOUT_SECONDS = 2
+# Upload bodies are read (and discarded) in chunks of this many bytes.
+UPLOAD_READ_CHUNK_BYTES = 64 * 1024
+
+# ISP lookup behind /backend/getIP?isp (a local records file or ipinfo.io, cached, or a
+# local prefix table), or None if none of ACCESSPOINTER_ISP_FILE,
+# ACCESSPOINTER_ISP_PREFIXES and IPINFO_APIKEY is set.
+isp_lookup = create_isp_lookup()
 
 # --- Helper Functions ---
 
+def garbage_stream(block_count: int, test_id: str = None, started: float = None):
+    """
+    Yields PREGENERATED_DATA block_count times for /backend/garbage.
+    The same immutable bytes object is handed to the server each time, so a download
+    of any size holds no per-request buffer and copies nothing.
+    With test_id, the stream is added to download_ledger when it ends or is cut off.
+    A block counts as sent once the server asks for the next one (or finishes), so
+    only data actually written out is counted.
+    Args:
+        block_count: Number of blocks to send.
+        test_id: Speed test run to account the stream to, or None.
+        started: time.monotonic() when the request arrived (defaults to the first block).
+    """
+    first_byte = None
+    sent_bytes = 0
+    completed = False
+    try:
+        for _ in range(block_count):
+            if first_byte is None:
+                # The server sends the headers with the first block.
+                first_byte = time.monotonic()
+            yield PREGENERATED_DATA
+            sent_bytes += len(PREGENERATED_DATA)
+        completed = True
+    finally:
+        # Also reached through GeneratorExit when the client disconnects early.
+        if test_id:
+            finished = time.monotonic()
+            if started is None:
+                started = first_byte if first_byte is not None else finished
+            download_ledger.record(test_id, sent_bytes, started, finished, first_byte, completed)
+
 def get_client_ip():
     """
     Retrieves the client's IP address from request headers.
@@ -36,6 +76,24 @@ def get_client_ip():
     # Remove IPv6 mapping prefix if present.
     return ip_address.replace("::ffff:", "")
 
+def drain_request_body() -> tuple[int, bool]:
+    """
+    Reads the request body to the end in UPLOAD_READ_CHUNK_BYTES chunks without
+    keeping it.
+    Returns (bytes received, whether the whole body arrived); a client that aborts
+    mid-upload (the speed test cancels uploads when its timer expires) leaves a
+    partial body rather than an error.
+    """
+    total_bytes = 0
+    try:
+        while True:
+            chunk = request.stream.read(UPLOAD_READ_CHUNK_BYTES)
+            if not chunk:
+                return total_bytes, True
+            total_bytes += len(chunk)
+    except ClientDisconnected:
+        return total_bytes, False
+
 # --- Route Definitions ---
 
 @backend_bp.route("/backend/getIP", methods=["GET"])
@@ -43,7 +101,9 @@ def get_ip():
     """
     GET /backend/getIP
     Returns the client's IP address.
-    Optionally includes ISP information if 'isp' query parameter is present.
+    Optionally includes ISP information if 'isp' query parameter is present; lookups
+    go through isp_lookup, so a recurring IP is answered from its cache (or from the
+    local prefix table, with no external call at all).
     Supports CORS if 'cors' query parameter is present.
     """
     # Get the client's IP address.
@@ -56,31 +116,9 @@ def get_ip():
         # Handle local IP addresses.
         if ip_address.startswith("127.") or ip_address.startswith("192.168.") or ip_address == "::1":
             isp_info = "localhost IPv4 access"
-        else:
-            # Attempt to get ISP info from ipinfo.io API.
-            api_key = os.getenv("IPINFO_APIKEY")
-            # Use API key if available for higher rate limits.
-            if api_key:
-                try:
-                    # Construct the API URL.
-                    api_url = f"https://ipinfo.io/{ip_address}/json?token={api_key}"
-                    # Make the request with a timeout.
-                    res = requests.get(api_url, timeout=API_TIMEOUT_SECONDS)
-                    # Check if the request was successful.
-                    if res.ok:
-                        data = res.json()
-                        raw_info = data # Store the raw JSON response.
-                        # Extract ISP organization name, preferring 'org' field.
-                        if "org" in data:
-                            # Clean up the organization name.
-                            isp_info = data["org"].replace("AS", "").strip()
-                        # Fallback to ASN name if 'org' is not present.
-                        elif "asn" in data and "name" in data["asn"]:
-                            isp_info = data["asn"]["name"]
-                except requests.exceptions.RequestException as e:
-                    # Log API call failure, but continue.
-                    print(f"ipinfo.io API call failed: {e}")
-                    pass # Fallback if API call fails or times out.
+        elif isp_lookup is not None:
+            # Attempt to get ISP info from the configured lookup.
+            isp_info, raw_info = isp_lookup.lookup(ip_address) or (None, "")
 
     # Construct the processed string including IP and ISP if available.
     processed_string = ip_address
@@ -114,12 +152,24 @@ def get_ip():
 @backend_bp.route("/backend/empty", methods=["GET", "POST"])
 def empty():
     """
-    GET, POST /backend/empty
+    GET, POST /backend/empty[?test_id=<id>]
     Returns an empty response (200 OK).
     Used by the speed test for ping and upload measurements.
+    The request body is drained in fixed-size chunks; with 'test_id' (from
+    /generate_unique_id), the bytes received and the time taken are added to that
+    test run's server-side upload statistics (see /backend/transfer-stats), also
+    when the client disconnects before sending the whole body.
     Supports CORS if 'cors' query parameter is present.
     Disables caching.
     """
+    # Receive the whole upload (or what arrived before the client went away)
+    # before answering, timing it on the server.
+    started = time.monotonic()
+    received_bytes, completed = drain_request_body()
+    test_id = request.args.get("test_id")
+    if test_id and received_bytes:
+        upload_ledger.record(test_id, received_bytes, started, time.monotonic(), completed=completed)
+
     # Create an empty response with status code 200.
     response = make_response("", 200)
     # Enable CORS if requested via query parameter.
@@ -141,12 +191,18 @@ def empty():
 @backend_bp.route("/backend/garbage", methods=["GET"])
 def garbage():
     """
-    GET /backend/garbage
+    GET /backend/garbage[?test_id=<id>]
     Returns a stream of random data.
     Used by the speed test for download measurements.
-    The size of the data stream is controlled by the 'ckSize' query parameter.
+    The size of the data stream is controlled by the 'ckSize' query parameter
+    (number of 1 MB blocks). The blocks are streamed from the pre-generated buffer,
+    so memory use per download does not grow with its size.
+    With 'test_id' (from /generate_unique_id), the bytes actually sent, the time to
+    first byte and the completion time are added to that test run's server-side
+    download statistics (see /backend/transfer-stats).
     Supports CORS if 'cors' query parameter is present.
     """
+    started = time.monotonic()
     # Get chunk size multiplier from query parameter, default to 4.
     try:
         # Ensure ckSize is an integer between 1 and 1024.
@@ -156,8 +212,6 @@ def garbage():
         # Default to 4 if conversion fails.
         chunk_size_multiplier = 4
 
-    # Generate payload by repeating the pre-generated 1MB chunk.
-    payload = PREGENERATED_DATA * chunk_size_multiplier
     # Define response headers for file transfer.
     headers = {
         "Content-Description": "File Transfer",
@@ -167,8 +221,8 @@ def garbage():
         # Prevent caching of the random data.
         "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0, s-maxage=0",
         "Pragma": "no-cache",
-        # Set the correct content length.
-        "Content-Length": str(len(payload))
+        # Set the correct content length (the stream repeats the pre-generated 1MB chunk).
+        "Content-Length": str(len(PREGENERATED_DATA) * chunk_size_multiplier)
     }
 
     # Enable CORS if requested via query parameter.
@@ -176,8 +230,25 @@ def garbage():
         headers["Access-Control-Allow-Origin"] = "*"
         headers["Access-Control-Allow-Methods"] = "GET, POST"
 
-    # Return the random data payload with appropriate headers.
-    return Response(payload, headers=headers)
+    # Stream the random data with appropriate headers; passed through to the server as is.
+    stream = garbage_stream(chunk_size_multiplier, request.args.get("test_id"), started)
+    return Response(stream, headers=headers, direct_passthrough=True)
+
+@backend_bp.route("/backend/transfer-stats/<test_id>", methods=["GET"])
+def transfer_stats(test_id: str):
+    """
+    GET /backend/transfer-stats/<test_id>
+    Returns the transfer statistics measured by the server for one speed test run.
+    Returns JSON: {"test_id": str, "download": dict | None, "upload": dict | None}, each
+    direction as {"streams": int, "completed_streams": int, "bytes": int, "seconds": float,
+    "mbps": float | None, "mean_ttfb_ms": float | None}, or None if nothing was recorded.
+    Only the transfers handled by this worker process are counted.
+    """
+    return jsonify({
+        "test_id": test_id,
+        "download": download_ledger.summary(test_id),
+        "upload": upload_ledger.summary(test_id),
+    }), 200
 
 @backend_bp.route("/results/telemetry", methods=["POST"])
 def save_telemetry():
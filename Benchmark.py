@@ -0,0 +1,395 @@
+# Benchmark.py
+# Command-line performance benchmarks for the application's hot paths.
+# Database benchmarks run against a throwaway SQLite file, never the real db.sqlite3.
+#
+# Usage:
+#   python Benchmark.py read-path [--sizes 10000 100000 1000000]
+#   python Benchmark.py sqlite-concurrency [--rows 20000] [--readers 4] [--writers 4] [--seconds 5]
+#   python Benchmark.py mapping [--points 1000000]
+#   python Benchmark.py position-log [--fixes 1000000]
+#   python Benchmark.py isp-prefixes [--prefixes 500000] [--lookups 100000]
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Default row counts for the database read-path benchmark.
+READ_PATH_SIZES = [10000, 100000, 1000000]
+# SQLite's out-of-the-box behavior, used as the "before" profile of the concurrency benchmark.
+SQLITE_DEFAULT_PRAGMAS = {"journal_mode": "DELETE", "synchronous": "FULL"}
+# Default number of coordinates for the mapping benchmark.
+MAPPING_POINTS = 1000000
+# Default number of logged fixes for the position log benchmark.
+POSITION_LOG_FIXES = 1000000
+# Number of prefixes and lookups for the ISP prefix table benchmark.
+ISP_PREFIXES = 500000
+ISP_LOOKUPS = 100000
+
+
+def setup_scratch_database() -> str:
+    """
+    Points Django at a fresh temporary SQLite file and creates the schema.
+    Must run before DatabaseHandler is imported, since importing it calls django.setup().
+    Returns the path of the temporary database file.
+    """
+    fd, db_path = tempfile.mkstemp(prefix="accesspointer-bench-", suffix=".sqlite3")
+    os.close(fd)
+    os.environ["ACCESSPOINTER_DB_PATH"] = db_path
+    # Importing DatabaseHandler configures Django against the scratch file.
+    import DatabaseHandler  # noqa: F401
+    from django.core.management import call_command
+    call_command("migrate", verbosity=0)
+    return db_path
+
+
+def remove_database_files(db_path: str):
+    """Deletes a scratch database together with its WAL and shared-memory files."""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+
+def populate_measurements(rows: int):
+    """
+    Replaces the Internet/Location tables with `rows` paired measurements.
+    Every tenth speed test has no location so the outer join path is exercised.
+    """
+    from django.db import connection, transaction
+    from myapp.models import Internet, Location
+
+    rng = random.Random(rows)
+    unique_ids = rng.sample(range(100000, 100000 + rows * 10), rows)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {Internet._meta.db_table}")
+        cursor.execute(f"DELETE FROM {Location._meta.db_table}")
+        cursor.executemany(
+            f"INSERT INTO {Internet._meta.db_table} (download, upload, ping, unique_id) VALUES (%s, %s, %s, %s)",
+            [(rng.randint(1, 500), rng.randint(1, 100), rng.randint(5, 80), uid) for uid in unique_ids]
+        )
+        cursor.executemany(
+            f"INSERT INTO {Location._meta.db_table} (latitude, longitude, unique_id) VALUES (%s, %s, %s)",
+            [(43.037278 + rng.random() * 0.000666, -76.132944 + rng.random() * 0.00075, uid)
+             for i, uid in enumerate(unique_ids) if i % 10]
+        )
+
+
+def legacy_get_data() -> dict:
+    """The original read path: two full model scans merged through a dict keyed on unique_id."""
+    from myapp.models import Internet, Location
+
+    combined_data = {}
+    for internet_entry in Internet.objects.all():
+        combined_data[internet_entry.unique_id] = {
+            'download': internet_entry.download,
+            'upload': internet_entry.upload,
+            'ping': internet_entry.ping,
+            'location': None
+        }
+    for location_entry in Location.objects.all():
+        if location_entry.unique_id in combined_data:
+            combined_data[location_entry.unique_id]['location'] = {
+                'latitude': location_entry.latitude,
+                'longitude': location_entry.longitude
+            }
+    return combined_data
+
+
+def measure(func, with_memory: bool) -> tuple[float, float | None]:
+    """
+    Runs func once for wall time and, optionally, once more under tracemalloc.
+    Returns (seconds, peak MiB or None).
+    """
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak_mib = None
+    if with_memory:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_mib = peak / (1024 * 1024)
+    return elapsed, peak_mib
+
+
+def bench_read_path(args):
+    """Compares the legacy two-scan get_data() against the joined streaming iter_data()."""
+    db_path = setup_scratch_database()
+    from DatabaseHandler import DatabaseHandler
+    db_handler = DatabaseHandler()
+
+    # Each candidate consumes the full result so both do equivalent work.
+    def stream_rows():
+        for _row in db_handler.iter_data():
+            pass
+
+    candidates = [
+        ("legacy get_data (2 scans + dict merge)", legacy_get_data),
+        ("iter_data (joined query, streamed)", stream_rows),
+    ]
+
+    try:
+        print(f"{'rows':>9}  {'path':<40} {'seconds':>9} {'peak MiB':>9}")
+        for rows in args.sizes:
+            populate_measurements(rows)
+            for name, func in candidates:
+                elapsed, peak_mib = measure(func, not args.no_memory)
+                peak_str = f"{peak_mib:9.1f}" if peak_mib is not None else f"{'-':>9}"
+                print(f"{rows:>9}  {name:<40} {elapsed:9.3f} {peak_str}")
+    finally:
+        remove_database_files(db_path)
+
+
+def run_concurrent_workload(db_handler, readers: int, writers: int, seconds: float) -> dict:
+    """
+    Runs reader threads (full iter_data() scans, as the heatmap rebuild does) and
+    writer threads (single-row autocommit inserts, as unbuffered saves do) for
+    `seconds`. Returns operation and error counts per role.
+    """
+    from django.db import connection
+    from myapp.models import Internet
+
+    counts = {"reads": 0, "writes": 0, "read_errors": 0, "write_errors": 0}
+    counts_lock = threading.Lock()
+    stop = threading.Event()
+
+    def record(key):
+        with counts_lock:
+            counts[key] += 1
+
+    def reader():
+        while not stop.is_set():
+            try:
+                for _row in db_handler.iter_data():
+                    pass
+                record("reads")
+            except Exception:
+                record("read_errors")
+        connection.close()
+
+    def writer(worker_id):
+        sequence = 0
+        while not stop.is_set():
+            sequence += 1
+            try:
+                Internet(download=100.0, upload=20.0, ping=15.0, unique_id=worker_id * 10000000 + sequence).save()
+                record("writes")
+            except Exception:
+                record("write_errors")
+        connection.close()
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer, args=(i + 1,)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def bench_sqlite_concurrency(args):
+    """Compares reader/writer throughput with SQLite defaults against the settings profile."""
+    db_path = setup_scratch_database()
+    from django.conf import settings
+    from django.db import connections
+    from DatabaseHandler import DatabaseHandler
+    from database.settings import sqlite_init_command
+
+    populate_measurements(args.rows)
+    db_handler = DatabaseHandler()
+    profiles = [
+        ("sqlite defaults", SQLITE_DEFAULT_PRAGMAS, None),
+        ("settings profile", settings.SQLITE_PRAGMAS, settings.SQLITE_TRANSACTION_MODE),
+    ]
+
+    try:
+        print(f"{'profile':<18} {'reads/s':>9} {'writes/s':>9} {'read errs':>10} {'write errs':>11}")
+        for name, pragmas, transaction_mode in profiles:
+            # New connections (one per worker thread) pick up the updated options.
+            connections.close_all()
+            connections.settings["default"]["OPTIONS"] = {
+                "init_command": sqlite_init_command(pragmas),
+                "transaction_mode": transaction_mode,
+            }
+            counts = run_concurrent_workload(db_handler, args.readers, args.writers, args.seconds)
+            print(f"{name:<18} {counts['reads'] / args.seconds:9.1f} {counts['writes'] / args.seconds:9.1f} "
+                  f"{counts['read_errors']:>10} {counts['write_errors']:>11}")
+    finally:
+        connections.close_all()
+        remove_database_files(db_path)
+
+
+def bench_mapping(args):
+    """
+    Compares per-point map_lat_lon_to_pixels() calls against one
+    map_lat_lon_to_pixels_batch() call, and the heatmap rebuild with each.
+    """
+    import numpy as np
+    from HeatmapAggregate import HeatmapAggregate
+    from Routes import MIN_LAT, MAX_LAT, MIN_LON, MAX_LON, map_lat_lon_to_pixels, map_lat_lon_to_pixels_batch
+
+    # Points spread a little beyond the floor plan so clamping is exercised too.
+    rng = random.Random(args.points)
+    lat_margin = (MAX_LAT - MIN_LAT) * 0.1
+    lon_margin = (MAX_LON - MIN_LON) * 0.1
+    latitudes = [rng.uniform(MIN_LAT - lat_margin, MAX_LAT + lat_margin) for _ in range(args.points)]
+    longitudes = [rng.uniform(MIN_LON - lon_margin, MAX_LON + lon_margin) for _ in range(args.points)]
+    rows = [(i, 100.0, 20.0, 15.0, lat, lon) for i, (lat, lon) in enumerate(zip(latitudes, longitudes))]
+
+    results = {}
+
+    def scalar():
+        results["scalar"] = [map_lat_lon_to_pixels(lat, lon) for lat, lon in zip(latitudes, longitudes)]
+
+    def batch():
+        results["batch"] = map_lat_lon_to_pixels_batch(latitudes, longitudes)
+
+    def batch_array():
+        map_lat_lon_to_pixels_batch(np.asarray(latitudes), np.asarray(longitudes))
+
+    candidates = [
+        ("scalar map_lat_lon_to_pixels loop", scalar),
+        ("batch (Python lists)", batch),
+        ("batch (NumPy arrays)", batch_array),
+        ("heatmap rebuild, scalar mapping", lambda: HeatmapAggregate(map_lat_lon_to_pixels).rebuild(rows)),
+        ("heatmap rebuild, batch mapping",
+         lambda: HeatmapAggregate(map_lat_lon_to_pixels, map_lat_lon_to_pixels_batch).rebuild(rows)),
+    ]
+    print(f"{'points':>9}  {'path':<36} {'seconds':>9}")
+    for name, func in candidates:
+        elapsed, _ = measure(func, with_memory=False)
+        print(f"{args.points:>9}  {name:<36} {elapsed:9.3f}")
+
+    # Both paths must agree point for point.
+    xs, ys, in_bounds = results["batch"]
+    identical = results["scalar"] == list(zip(xs.tolist(), ys.tolist(), in_bounds.tolist()))
+    print(f"results identical: {identical}")
+
+
+def bench_position_log(args):
+    """
+    Measures appending fixes to the binary position log and reading them back
+    through the memory-mapped reader: a full scan, one session, and a time slice.
+    """
+    import shutil
+    from PositionLog import PositionLogWriter, replay
+
+    directory = tempfile.mkdtemp(prefix="accesspointer-positions-")
+    try:
+        sessions = [f"session-{i}" for i in range(100)]
+        writer = PositionLogWriter(directory)
+
+        def append():
+            for i in range(args.fixes):
+                writer.append(sessions[i % len(sessions)], 43.0376 + i * 1e-9, -76.1325, timestamp=1000.0 + i * 0.01)
+            writer.close()
+
+        middle = 1000.0 + args.fixes * 0.005
+        candidates = [
+            ("append (buffered, one fsync)", append),
+            ("replay all", lambda: replay(directory)),
+            ("replay one session", lambda: replay(directory, session_id=sessions[0])),
+            ("replay 1% time slice", lambda: replay(directory, since=middle, until=middle + args.fixes * 0.0001)),
+        ]
+        print(f"{'fixes':>9}  {'path':<30} {'seconds':>9}")
+        for name, func in candidates:
+            elapsed, _ = measure(func, with_memory=False)
+            print(f"{args.fixes:>9}  {name:<30} {elapsed:9.3f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_isp_prefixes(args):
+    """
+    Measures loading a CIDR-to-ISP table into PrefixTableLookup and looking random
+    IPv4 addresses up in it, against a linear scan of the same prefixes.
+    """
+    import csv
+    import ipaddress
+    import shutil
+    from IspLookup import PrefixTableLookup
+
+    directory = tempfile.mkdtemp(prefix="accesspointer-prefixes-")
+    try:
+        rng = random.Random(0)
+        networks = set()
+        while len(networks) < args.prefixes:
+            prefix_length = rng.randint(16, 24)
+            networks.add(ipaddress.IPv4Network((rng.getrandbits(32) >> (32 - prefix_length) << (32 - prefix_length), prefix_length)))
+        path = os.path.join(directory, "prefixes.csv")
+        with open(path, "w", newline="") as table_file:
+            writer = csv.writer(table_file)
+            writer.writerow(["network", "isp"])
+            for i, network in enumerate(networks):
+                writer.writerow([str(network), f"ISP {i}"])
+        addresses = [str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(args.lookups)]
+        table = PrefixTableLookup(path)
+        scan = [(int(network.network_address), int(network.broadcast_address)) for network in networks]
+
+        def linear(address):
+            value = int(ipaddress.IPv4Address(address))
+            return next((first for first, last in scan if first <= value <= last), None)
+
+        candidates = [
+            ("load table", lambda: PrefixTableLookup(path)),
+            ("binary search lookups", lambda: [table.lookup(address) for address in addresses]),
+            ("linear scan (1% of lookups)", lambda: [linear(address) for address in addresses[:len(addresses) // 100]]),
+        ]
+        print(f"{'prefixes':>9}  {'path':<30} {'seconds':>9}")
+        for name, func in candidates:
+            elapsed, _ = measure(func, with_memory=False)
+            print(f"{args.prefixes:>9}  {name:<30} {elapsed:9.3f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(argv=None):
+    """Parses command-line arguments and runs the selected benchmark."""
+    parser = argparse.ArgumentParser(description="AccessPointer performance benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    read_path = subparsers.add_parser("read-path", help="Database read path: get_data() vs iter_data()")
+    read_path.add_argument("--sizes", type=int, nargs="+", default=READ_PATH_SIZES,
+                           help="Row counts to benchmark (default: %(default)s)")
+    read_path.add_argument("--no-memory", action="store_true",
+                           help="Skip the tracemalloc pass (faster for large sizes)")
+    read_path.set_defaults(func=bench_read_path)
+
+    concurrency = subparsers.add_parser("sqlite-concurrency",
+                                        help="Concurrent reader/writer throughput: SQLite defaults vs settings profile")
+    concurrency.add_argument("--rows", type=int, default=20000, help="Rows scanned per read (default: %(default)s)")
+    concurrency.add_argument("--readers", type=int, default=4, help="Reader threads (default: %(default)s)")
+    concurrency.add_argument("--writers", type=int, default=4, help="Writer threads (default: %(default)s)")
+    concurrency.add_argument("--seconds", type=float, default=5.0, help="Duration per profile (default: %(default)s)")
+    concurrency.set_defaults(func=bench_sqlite_concurrency)
+
+    mapping = subparsers.add_parser("mapping", help="Coordinate mapping: scalar loop vs vectorized batch")
+    mapping.add_argument("--points", type=int, default=MAPPING_POINTS,
+                         help="Number of coordinates to map (default: %(default)s)")
+    mapping.set_defaults(func=bench_mapping)
+
+    position_log = subparsers.add_parser("position-log", help="Binary position log: append and mmap replay")
+    position_log.add_argument("--fixes", type=int, default=POSITION_LOG_FIXES,
+                              help="Number of fixes to log (default: %(default)s)")
+    position_log.set_defaults(func=bench_position_log)
+
+    isp_prefixes = subparsers.add_parser("isp-prefixes", help="Offline ISP prefix table: binary search vs linear scan")
+    isp_prefixes.add_argument("--prefixes", type=int, default=ISP_PREFIXES,
+                              help="Number of CIDR prefixes in the table (default: %(default)s)")
+    isp_prefixes.add_argument("--lookups", type=int, default=ISP_LOOKUPS,
+                              help="Number of addresses to look up (default: %(default)s)")
+    isp_prefixes.set_defaults(func=bench_isp_prefixes)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
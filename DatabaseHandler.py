@@ -4,6 +4,10 @@
 import os
 import django
 import sys
+import threading # Used by the background write buffer.
+import time # Used for flush deadlines.
+import weakref # Used to flush buffered writes when a handler is freed or the interpreter exits.
+from collections import deque
 
 # Add the parent directory of 'database' to the Python path
 # This allows Django to find the settings module.
@@ -17,112 +21,367 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "database.settings")
 django.setup()
 
 # Import models after Django setup.
+from django.db import connection, transaction
+from django.db.models import Max
 from myapp.models import Location, Internet
 
+# Column order of the tuples yielded by DatabaseHandler.iter_data().
+DATA_COLUMNS = ("unique_id", "download", "upload", "ping", "latitude", "longitude")
+# Default number of rows fetched from the database per round trip when streaming.
+DEFAULT_CHUNK_SIZE = 2000
+
+# --- Write Buffer Configuration ---
+# Durability modes for save_location/save_speed_test:
+# - "commit": return only after the batch containing the record has been committed.
+# - "enqueue": return as soon as the record is queued (faster, but queued records
+#   are lost if the process is killed before the next flush).
+# The mode of handlers created without one (e.g. by Routes) comes from the
+# ACCESSPOINTER_DB_DURABILITY environment variable, then DEFAULT_DURABILITY.
+DURABILITY_COMMIT = "commit"
+DURABILITY_ENQUEUE = "enqueue"
+DEFAULT_DURABILITY = DURABILITY_COMMIT
+# Maximum time a queued record waits for more records before its batch is flushed.
+FLUSH_INTERVAL_MS = 10
+# Maximum number of records written per transaction.
+FLUSH_BATCH_SIZE = 200
+# Maximum time a "commit" mode save waits for its batch before reporting failure.
+COMMIT_WAIT_TIMEOUT_SECONDS = 10
+
+
+class PendingWrite:
+    """A model instance queued in the WriteBuffer, plus the outcome of its batch."""
+    __slots__ = ("instance", "description", "done", "saved")
+
+    def __init__(self, instance, description: str):
+        self.instance = instance
+        # Human-readable summary used for log messages.
+        self.description = description
+        # Set once the batch containing this record has been written (or failed).
+        self.done = threading.Event()
+        self.saved = False
+
+
+class WriteBuffer:
+    """
+    Group-commit buffer for model inserts.
+    A background thread collects queued records for up to `flush_interval_ms`
+    (or until `batch_size` records are waiting) and writes them with bulk_create
+    inside a single transaction, so concurrent saves share one commit.
+    """
+    def __init__(self, flush_interval_ms: int = FLUSH_INTERVAL_MS, batch_size: int = FLUSH_BATCH_SIZE,
+                 on_saved=None):
+        """
+        Args:
+            flush_interval_ms: Maximum time a record waits for its batch to fill.
+            batch_size: Maximum number of records per transaction.
+            on_saved: Optional callback, called with the number of records
+                      saved after each batch is written.
+        """
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.batch_size = batch_size
+        self.on_saved = on_saved
+        # Records waiting to be written, oldest first.
+        self.queue = deque()
+        # Condition used to wake the flush thread and to protect queue/state.
+        self.condition = threading.Condition()
+        # Background flush thread, started on the first submitted record.
+        self.thread = None
+        self.closed = False
+
+    def submit(self, instance, description: str) -> PendingWrite:
+        """Queues a model instance for insertion and returns its PendingWrite."""
+        pending = PendingWrite(instance, description)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Write buffer is closed")
+            # Start the flush thread lazily so read-only handlers never spawn one.
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="db-write-buffer", daemon=True)
+                self.thread.start()
+            self.queue.append(pending)
+            self.condition.notify()
+        return pending
+
+    def close(self):
+        """Flushes every queued record and stops the flush thread."""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+            thread = self.thread
+        # The flush thread can end up here itself if it drops the last reference to
+        # its handler; it exits on its own once the queue is empty.
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        """Flush loop: waits for records, gathers a batch, writes it, repeats until closed."""
+        while True:
+            with self.condition:
+                # Sleep until there is something to write.
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue and self.closed:
+                    break
+                # Give concurrent writers a short window to join this batch.
+                deadline = time.monotonic() + self.flush_interval
+                while len(self.queue) < self.batch_size and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            self._write_batch(batch)
+        # Release this thread's database connection.
+        connection.close()
+
+    def _write_batch(self, batch: list):
+        """Writes a batch in one transaction, falling back to per-record saves on error."""
+        try:
+            # Group records by model so each table gets a single bulk insert.
+            by_model = {}
+            for pending in batch:
+                by_model.setdefault(type(pending.instance), []).append(pending.instance)
+            with transaction.atomic():
+                for model, instances in by_model.items():
+                    model.objects.bulk_create(instances)
+            for pending in batch:
+                pending.saved = True
+        except Exception as e:
+            # Isolate the failing record(s) so one bad row does not drop the batch.
+            print(f"Error writing batch of {len(batch)} records: {e}. Retrying individually.")
+            for pending in batch:
+                try:
+                    pending.instance.save()
+                    pending.saved = True
+                except Exception as record_error:
+                    print(f"Error saving {pending.description}: {record_error}")
+        finally:
+            saved_count = 0
+            for pending in batch:
+                if pending.saved:
+                    saved_count += 1
+                    print(f"Saved {pending.description}")
+            # Report before waking the callers, so their acknowledgement implies the report.
+            if saved_count and self.on_saved is not None:
+                self.on_saved(saved_count)
+            for pending in batch:
+                pending.done.set()
+
+
 class DatabaseHandler:
     """
     Handles database operations for Location and Internet speed test data.
     Provides methods to save and retrieve data using Django ORM.
+    Saves go through a WriteBuffer that groups concurrent inserts into one transaction.
     """
-    def __init__(self):
-        """Initializes the DatabaseHandler."""
+    def __init__(self, durability: str = None,
+                 flush_interval_ms: int = FLUSH_INTERVAL_MS, batch_size: int = FLUSH_BATCH_SIZE):
+        """
+        Initializes the DatabaseHandler.
+        Args:
+            durability: DURABILITY_COMMIT (acknowledge after commit) or
+                        DURABILITY_ENQUEUE (acknowledge after queueing); defaults to the
+                        ACCESSPOINTER_DB_DURABILITY environment variable, then DEFAULT_DURABILITY.
+            flush_interval_ms: Maximum time a record waits for its batch to fill.
+            batch_size: Maximum number of records per transaction.
+        Raises:
+            ValueError: If the durability mode is unknown.
+        """
+        durability = durability or os.environ.get("ACCESSPOINTER_DB_DURABILITY", DEFAULT_DURABILITY)
+        if durability not in (DURABILITY_COMMIT, DURABILITY_ENQUEUE):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.durability = durability
+        # Monotonically increasing data version, advanced by the number of records saved.
+        # Lets readers (e.g. /heatmap-data ETags) detect changes without querying.
+        # Seeded from the highest row IDs, which only grow, so it keeps increasing
+        # across restarts instead of starting over at zero.
+        self.data_version = self._stored_data_version()
+        self.version_lock = threading.Lock()
+        # Buffer that batches inserts from concurrent requests. Its thread reaches the
+        # handler only through a weak reference, so an unused handler can be freed.
+        handler_ref = weakref.ref(self)
+
+        def on_saved(saved_count: int):
+            handler = handler_ref()
+            if handler is not None:
+                handler._bump_data_version(saved_count)
+
+        self.write_buffer = WriteBuffer(flush_interval_ms, batch_size, on_saved=on_saved)
+        # Flush queued records and stop the thread when the handler is closed, freed,
+        # or still alive at interpreter exit (the finalizer holds no reference to it).
+        self._finalizer = weakref.finalize(self, self.write_buffer.close)
         # Indicate successful initialization.
         print("Database Handler initialized")
 
+    def _bump_data_version(self, saved_count: int):
+        """Advances data_version after `saved_count` records were committed."""
+        with self.version_lock:
+            self.data_version += saved_count
+
+    def _stored_data_version(self) -> int:
+        """Returns the sum of the highest Location and Internet row IDs (0 if unavailable)."""
+        try:
+            return sum(model.objects.aggregate(max_id=Max("id"))["max_id"] or 0 for model in (Location, Internet))
+        # Handle a missing or unreadable database; versions then start at zero.
+        except Exception as e:
+            print(f"Error reading data version: {e}")
+            return 0
+
+    def _save(self, instance, description: str) -> bool:
+        """
+        Queues a model instance in the write buffer.
+        In commit mode, waits for its batch and returns whether it was saved;
+        in enqueue mode, returns True once the record is queued.
+        """
+        pending = self.write_buffer.submit(instance, description)
+        if self.durability == DURABILITY_ENQUEUE:
+            return True
+        # Wait for the flush thread to commit (or fail) the batch.
+        if not pending.done.wait(COMMIT_WAIT_TIMEOUT_SECONDS):
+            print(f"Timed out waiting to save {description}")
+            return False
+        return pending.saved
+
     def save_location(self, latitude: float, longitude: float, unique_id: int):
         """
         Saves location data (latitude, longitude, unique_id) to the database.
         Handles potential exceptions during the save operation.
+        Returns True if the record was saved (or queued, in enqueue mode), False otherwise.
         """
-        # Try to create and save a new Location record.
+        # Try to create and queue a new Location record.
         try:
             # Create a new Location model instance.
             location = Location(latitude=latitude, longitude=longitude, unique_id=unique_id)
-            # Save the instance to the database.
-            location.save()
-            # Log successful save operation.
-            print(f"Saved location: Latitude {latitude}, Longitude {longitude}, ID {unique_id}")
+            # Queue the instance; the buffer logs the save once it is written.
+            return self._save(location, f"location: Latitude {latitude}, Longitude {longitude}, ID {unique_id}")
         # Catch any exception during the save process.
         except Exception as e:
             # Log the error if saving fails.
             print(f"Error saving location: {e}")
+            return False
 
     def save_speed_test(self, download: float, upload: float, ping: float, unique_id: int):
         """
         Saves internet speed test results (download, upload, ping, unique_id) to the database.
         Handles potential exceptions during the save operation.
+        Returns True if the record was saved (or queued, in enqueue mode), False otherwise.
         """
-        # Try to create and save a new Internet record.
+        # Try to create and queue a new Internet record.
         try:
             # Create a new Internet model instance.
             internet = Internet(download=download, upload=upload, ping=ping, unique_id=unique_id)
-            # Save the instance to the database.
-            internet.save()
-            # Log successful save operation.
-            print(f"Saved speed test: {download} Mbps / {upload} Mbps / {ping} ms (ID: {unique_id})")
+            # Queue the instance; the buffer logs the save once it is written.
+            return self._save(internet, f"speed test: {download} Mbps / {upload} Mbps / {ping} ms (ID: {unique_id})")
         # Catch any exception during the save process.
         except Exception as e:
             # Log the error if saving fails.
             print(f"Error saving speed test: {e}")
+            return False
+
+    def close(self):
+        """Flushes any buffered writes and stops the write buffer's thread (once)."""
+        self._finalizer()
+
+    def _joined_data_query(self, since=None, until=None) -> tuple[str, list]:
+        """
+        Builds the SQL (and parameters) that joins every Internet row to the most
+        recent Location row with the same unique_id. The models have no ForeignKey
+        between them, so the join is written against their table/column names from
+        Django's metadata. Optional since/until bounds filter on the indexed
+        Internet.created_at column, so time windows are range scans.
+        """
+        internet_table = Internet._meta.db_table
+        location_table = Location._meta.db_table
+        # Join only the latest Location per unique_id (an index seek on unique_id per
+        # row), so duplicate location rows never multiply the result and a narrow
+        # time window does not touch the rest of the location table.
+        sql = (
+            f"SELECT i.unique_id, i.download, i.upload, i.ping, l.latitude, l.longitude "
+            f"FROM {internet_table} i "
+            f"LEFT JOIN {location_table} l "
+            f"ON l.id = (SELECT MAX(id) FROM {location_table} WHERE unique_id = i.unique_id)"
+        )
+        # Add the time window; datetimes are adapted to the stored column format.
+        conditions, params = [], []
+        if since is not None:
+            conditions.append("i.created_at >= %s")
+            params.append(connection.ops.adapt_datetimefield_value(since))
+        if until is not None:
+            conditions.append("i.created_at < %s")
+            params.append(connection.ops.adapt_datetimefield_value(until))
+        if conditions:
+            # Ordering by created_at lets SQLite walk the created_at index for the range.
+            sql += " WHERE " + " AND ".join(conditions) + " ORDER BY i.created_at, i.id"
+        else:
+            sql += " ORDER BY i.id"
+        return sql, params
+
+    def iter_data(self, chunk_size: int = DEFAULT_CHUNK_SIZE, since=None, until=None):
+        """
+        Streams combined speed test and location data using a single joined query.
+        Yields plain tuples in DATA_COLUMNS order:
+            (unique_id, download, upload, ping, latitude, longitude)
+        latitude/longitude are None for speed tests without a saved location.
+        Rows are fetched `chunk_size` at a time, so no full result list is held in memory.
+        Args:
+            chunk_size: Rows fetched per database round trip.
+            since: Optional aware datetime; only speed tests saved at or after it.
+            until: Optional aware datetime; only speed tests saved before it.
+            Speed tests saved before timestamps were recorded are excluded by either bound.
+        """
+        sql, params = self._joined_data_query(since, until)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            # Fetch rows in chunks until the result set is exhausted.
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
 
     def get_data(self) -> dict:
         """
         Fetches all Location and Internet data from the database.
         Combines the data based on the 'unique_id'.
         Returns a dictionary where keys are unique_ids and values contain speed and location info.
+        Prefer iter_data() for large tables; this builds the whole dictionary in memory.
         """
-        # Fetch all records from both tables.
-        internet_data = Internet.objects.all() # Query all Internet entries.
-        location_data = Location.objects.all() # Query all Location entries.
-
         # Dictionary to store the combined data, keyed by unique_id.
         combined_data = {}
 
-        # Process Internet data first, creating entries in the dictionary.
-        for internet_entry in internet_data:
-            unique_id = internet_entry.unique_id
-            # Initialize entry for this unique_id.
+        # Stream joined rows; later rows for a repeated unique_id overwrite earlier ones.
+        for unique_id, download, upload, ping, latitude, longitude in self.iter_data():
             combined_data[unique_id] = {
-                'download': internet_entry.download,
-                'upload': internet_entry.upload,
-                'ping': internet_entry.ping,
-                'location': None # Placeholder for location data.
-            }
-
-        # Process Location data, adding it to existing entries in the dictionary.
-        for location_entry in location_data:
-            unique_id = location_entry.unique_id
-            # Check if a corresponding Internet entry exists.
-            if unique_id in combined_data:
-                # Add location details to the existing entry.
-                combined_data[unique_id]['location'] = {
-                    'latitude': location_entry.latitude,
-                    'longitude': location_entry.longitude
+                'download': download,
+                'upload': upload,
+                'ping': ping,
+                # Location is None if no matching Location entry exists.
+                'location': None if latitude is None else {
+                    'latitude': latitude,
+                    'longitude': longitude
                 }
-            # Optional: Handle locations without matching speed tests if needed.
-            # else:
-            #     combined_data[unique_id] = { 'download': None, ..., 'location': {...}}
+            }
 
         # Return the combined data structure.
         return combined_data
 
     def print_data(self):
         """
-        Fetches combined data using get_data() and prints it to the console.
+        Streams combined data using iter_data() and prints it to the console.
         Formats the output for readability.
         """
-        # Retrieve the combined data.
-        data = self.get_data()
-        # Iterate through the combined data dictionary.
-        for unique_id, info in data.items():
+        # Iterate through the joined rows without materializing the tables.
+        for unique_id, download, upload, ping, latitude, longitude in self.iter_data():
             # Print the unique identifier.
             print(f"Unique ID: {unique_id}")
             # Print internet speed test results.
-            print(f"  Internet Data: {info.get('download', 'N/A')} download, {info.get('upload', 'N/A')} upload, {info.get('ping', 'N/A')} ping")
+            print(f"  Internet Data: {download} download, {upload} upload, {ping} ping")
             # Check if location data exists for this ID.
-            if info.get('location') is not None:
+            if latitude is not None:
                 # Print location coordinates if available.
-                print(f"  Location Data: Latitude: {info['location'].get('latitude', 'N/A')}, Longitude: {info['location'].get('longitude', 'N/A')}")
+                print(f"  Location Data: Latitude: {latitude}, Longitude: {longitude}")
             else:
                 # Indicate if location data is missing.
                 print("  Location Data: Not available")
@@ -17,8 +17,9 @@ from BackendRoutes import backend_bp # Blueprint for backend API routes.
 # --- Configuration Constants ---
 # Session timeout duration in seconds (e.g., 30 minutes).
 SESSION_TIMEOUT_SECONDS = 1800
-# Interval for checking and cleaning up inactive sessions (e.g., 5 minutes).
-CLEANUP_INTERVAL_SECONDS = 300
+# Interval for checking and cleaning up inactive sessions (e.g., 30 seconds).
+# Cleanup only visits expired sessions, so it can run often to keep memory tight.
+CLEANUP_INTERVAL_SECONDS = 30
 # Default port for the Flask application.
 DEFAULT_PORT = 8000
 # Paths to SSL certificate and key files (if using HTTPS).
@@ -126,6 +127,8 @@ class FlaskApp:
         configure_logging(self.app, [
             '/save_user_location', # Frequent background update.
             '/get-live-location', # Frequent polling endpoint.
+            '/live-locations',    # Frequent batch polling endpoint.
+            '/occupancy-data',    # Frequent occupancy overlay polling.
             '/backend/garbage',   # High-volume data transfer.
             '/backend/empty'      # Frequent ping/upload endpoint.
         ])
@@ -143,7 +146,8 @@ class FlaskApp:
 
     def run_cleanup_loop(self):
         """
-        Runs in a background thread to periodically clean up inactive user sessions.
+        Runs in a background thread to periodically clean up inactive user sessions
+        and flush the position log to disk.
         Uses the `cleanup_inactive_sessions` method of the `Routes` instance.
         """
         print("Starting background session cleanup thread...")
@@ -159,6 +163,11 @@ class FlaskApp:
             except Exception as e:
                 # Log any errors encountered during cleanup.
                 print(f"Error during session cleanup: {e}")
+            try:
+                # Persist logged positions here, off the request path (even if cleanup failed).
+                self.routes_instance.position_log.flush()
+            except Exception as e:
+                print(f"Error flushing the position log: {e}")
 
     def run(self, port=DEFAULT_PORT):
         """
@@ -246,13 +255,10 @@ class FlaskApp:
 
                     # Check if location data was found.
                     if lat is not None and lon is not None:
-                        # Retrieve the timestamp for the last update from the Routes instance.
-                        # Acquire lock for thread safety when accessing shared session data.
-                        with self.routes_instance.session_lock:
-                            # Access session data safely.
-                            session_data = self.routes_instance.user_sessions.get(selected_sid)
-                            # Extract timestamp if data structure is valid.
-                            last_seen_timestamp = session_data[2] if session_data and len(session_data) == 3 else 0
+                        # Retrieve the timestamp for the last update from the session store.
+                        session_data = self.routes_instance.sessions.get_location(selected_sid)
+                        # Extract timestamp if the session is still tracked.
+                        last_seen_timestamp = session_data[2] if session_data else 0
                         # Format the timestamp for display.
                         last_seen_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_seen_timestamp)) if last_seen_timestamp else "N/A"
                         # Print the location and last seen time.
@@ -0,0 +1,267 @@
+# HeatmapAggregate.py
+# Maintains the in-memory heatmap served by /heatmap-data.
+# Built once from the database at startup and then updated in place as
+# location/speed pairs complete, so requests never rescan the tables.
+
+import json
+import threading
+from collections import OrderedDict, deque
+
+# Maximum number of half-complete entries (a location without its speed result,
+# or vice versa) kept while waiting for the matching half to arrive.
+MAX_PENDING_ENTRIES = 10000
+# Number of rows mapped per vectorized call while rebuilding.
+REBUILD_CHUNK_SIZE = 10000
+# Number of recent point changes kept for derived structures that update incrementally
+# (see changes_since()); one further behind has to rebuild from a snapshot.
+MAX_CHANGE_LOG_ENTRIES = 10000
+
+
+def parse_download_speed(value, unique_id=None) -> float:
+    """
+    Converts a stored download value to float.
+    Returns 0.0 (and logs a warning) for missing or non-numeric values such as "Fail".
+    """
+    # Missing values count as 0.0 without a warning.
+    if value is None:
+        return 0.0
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        print(f"Warning: Could not convert download speed '{value}' for ID {unique_id} to float. Using 0.")
+        return 0.0
+
+
+class HeatmapAggregate:
+    """
+    Thread-safe in-memory heatmap keyed by unique test ID.
+    Each completed pair (location + speed result) contributes one point
+    { "x": int, "y": int, "value": float }. The serialized JSON payload is
+    cached and only rebuilt after the point set changes.
+    """
+    def __init__(self, map_func, map_batch_func=None):
+        """
+        Initializes an empty aggregate.
+        Args:
+            map_func: Function mapping (latitude, longitude) to (x, y, in_bounds),
+                      normally Routes.map_lat_lon_to_pixels.
+            map_batch_func: Optional vectorized equivalent used by rebuild(), mapping
+                            (latitudes, longitudes) to (x, y, in_bounds) arrays with
+                            negative pixels for unmappable points, normally
+                            Routes.map_lat_lon_to_pixels_batch.
+        """
+        self.map_func = map_func
+        self.map_batch_func = map_batch_func
+        # Completed points: {unique_id: (x, y, speed)}.
+        self.points = {}
+        # Halves waiting for their counterpart: {unique_id: (lat, lon)} / {unique_id: speed}.
+        self.pending_locations = OrderedDict()
+        self.pending_speeds = OrderedDict()
+        # Highest download speed among the completed points.
+        self.max_speed = 0.0
+        # Cached JSON body for /heatmap-data, None when it needs rebuilding.
+        self._payload = None
+        # Incremented whenever the point set changes; lets derived caches detect staleness.
+        self.version = 0
+        # Recent changes as (version, old_point, new_point), either point None for an
+        # insert or a removal, and the version the log starts after.
+        self._changes = deque(maxlen=MAX_CHANGE_LOG_ENTRIES)
+        self._changes_base = 0
+        # Lock protecting all of the above.
+        self.lock = threading.Lock()
+
+    def rebuild(self, rows):
+        """
+        Replaces the aggregate contents with the given rows, as streamed by
+        DatabaseHandler.iter_data(): (unique_id, download, upload, ping, latitude, longitude).
+        Rows without a location are kept as pending speed results.
+        """
+        points = {}
+        pending_speeds = OrderedDict()
+        # Map every complete row outside the lock; only the swap below is locked.
+        for chunk in self._mapped_chunks(rows):
+            for unique_id, speed, located, point in chunk:
+                # Later rows for a repeated unique_id replace earlier ones.
+                if point is not None:
+                    points[unique_id] = point
+                    pending_speeds.pop(unique_id, None)
+                else:
+                    points.pop(unique_id, None)
+                    if not located:
+                        pending_speeds[unique_id] = speed
+
+        with self.lock:
+            self.points = points
+            self.pending_locations = OrderedDict()
+            self.pending_speeds = pending_speeds
+            self._trim_pending(self.pending_speeds)
+            self.max_speed = max((p[2] for p in points.values()), default=0.0)
+            self._invalidate()
+            # Not expressible as changes: consumers have to rebuild.
+            self._changes.clear()
+            self._changes_base = self.version
+
+    def add_location(self, unique_id: int, latitude: float, longitude: float):
+        """Records a saved location and completes the pair if its speed result is known."""
+        with self.lock:
+            if unique_id in self.pending_speeds:
+                speed = self.pending_speeds.pop(unique_id)
+                self._complete(unique_id, latitude, longitude, speed)
+            elif unique_id in self.points:
+                # A repeated location for a completed test replaces the old position.
+                self._complete(unique_id, latitude, longitude, self.points[unique_id][2])
+            else:
+                self.pending_locations[unique_id] = (latitude, longitude)
+                self._trim_pending(self.pending_locations)
+
+    def add_speed_test(self, unique_id: int, download):
+        """Records a saved speed result and completes the pair if its location is known."""
+        speed = parse_download_speed(download, unique_id)
+        with self.lock:
+            if unique_id in self.pending_locations:
+                latitude, longitude = self.pending_locations.pop(unique_id)
+                self._complete(unique_id, latitude, longitude, speed)
+            elif unique_id in self.points:
+                # Mirrors get_data(): the latest speed result for an ID wins.
+                x_pixel, y_pixel, _ = self.points[unique_id]
+                self._set_point(unique_id, (x_pixel, y_pixel, speed))
+            else:
+                self.pending_speeds[unique_id] = speed
+                self._trim_pending(self.pending_speeds)
+
+    def payload_json(self) -> str:
+        """
+        Returns the /heatmap-data JSON body: {"max": float, "data": list[dict]}.
+        Served from cache unless the point set changed since the last call.
+        """
+        with self.lock:
+            if self._payload is None:
+                data = [{"x": x, "y": y, "value": speed} for x, y, speed in self.points.values()]
+                self._payload = json.dumps({"max": self._max_value(), "data": data})
+            return self._payload
+
+    def snapshot(self) -> tuple[int, list, float]:
+        """
+        Returns (version, points, max_value) where points is a list of (x, y, speed)
+        tuples and max_value follows the same rules as the JSON payload.
+        """
+        with self.lock:
+            return self.version, list(self.points.values()), self._max_value()
+
+    def changes_since(self, version: int) -> tuple[int, list] | None:
+        """
+        Returns (current version, [(old_point, new_point), ...]) for the point changes
+        made after `version`, in order, with old_point None for an insert and new_point
+        None for a removal; or None if the log no longer reaches back that far (or the
+        aggregate was rebuilt since), in which case use snapshot().
+        """
+        with self.lock:
+            if version == self.version:
+                return self.version, []
+            if not self._changes_base <= version < self.version:
+                return None
+            # Versions in the log are consecutive, so the first wanted entry is at a known offset.
+            first = version - self._changes_base
+            return self.version, [(old, new) for _, old, new in list(self._changes)[first:]]
+
+    def __len__(self) -> int:
+        """Returns the number of completed heatmap points."""
+        with self.lock:
+            return len(self.points)
+
+    # --- Internal helpers (caller holds self.lock where noted) ---
+
+    def _map_point(self, latitude, longitude, speed: float):
+        """Maps a location to pixels, returning (x, y, speed) or None if mapping fails."""
+        x_pixel, y_pixel, _ = self.map_func(latitude, longitude)
+        if x_pixel is None or y_pixel is None:
+            return None
+        return x_pixel, y_pixel, speed
+
+    def _mapped_chunks(self, rows):
+        """
+        Yields lists of (unique_id, speed, has_location, point_or_None) for the rows,
+        mapping REBUILD_CHUNK_SIZE locations per map_batch_func call when available.
+        """
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= REBUILD_CHUNK_SIZE:
+                yield self._map_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield self._map_chunk(chunk)
+
+    def _map_chunk(self, chunk: list) -> list:
+        """Maps one chunk of iter_data() rows for _mapped_chunks()."""
+        speeds = [parse_download_speed(row[1], row[0]) for row in chunk]
+        located = [row[4] is not None for row in chunk]
+        if self.map_batch_func is None:
+            points = [
+                self._map_point(row[4], row[5], speed) if has_location else None
+                for row, speed, has_location in zip(chunk, speeds, located)
+            ]
+        else:
+            # Rows without a location map to negative pixels and are left unmapped.
+            xs, ys, _ = self.map_batch_func([row[4] for row in chunk], [row[5] for row in chunk])
+            points = [
+                (x, y, speed) if has_location and x >= 0 and y >= 0 else None
+                for x, y, speed, has_location in zip(xs.tolist(), ys.tolist(), speeds, located)
+            ]
+        return [(row[0], speed, has_location, point)
+                for row, speed, has_location, point in zip(chunk, speeds, located, points)]
+
+    def _complete(self, unique_id: int, latitude, longitude, speed: float):
+        """Maps the location and adds or replaces the point for unique_id. Caller holds self.lock."""
+        point = self._map_point(latitude, longitude, speed)
+        if point is None:
+            self._remove_point(unique_id)
+        else:
+            self._set_point(unique_id, point)
+
+    def _set_point(self, unique_id: int, point: tuple):
+        """Stores a mapped point and keeps max_speed current. Caller holds self.lock."""
+        previous = self.points.get(unique_id)
+        self.points[unique_id] = point
+        if previous is not None and previous[2] >= self.max_speed:
+            # The old maximum may have been replaced; recompute from scratch.
+            self.max_speed = max(p[2] for p in self.points.values())
+        elif point[2] > self.max_speed:
+            self.max_speed = point[2]
+        self._invalidate()
+        self._log_change(previous, point)
+
+    def _remove_point(self, unique_id: int):
+        """Drops the point for unique_id if present. Caller holds self.lock."""
+        removed = self.points.pop(unique_id, None)
+        if removed is None:
+            return
+        if removed[2] >= self.max_speed:
+            self.max_speed = max((p[2] for p in self.points.values()), default=0.0)
+        self._invalidate()
+        self._log_change(removed, None)
+
+    def _max_value(self) -> float:
+        """
+        Returns the 'max' reported to heatmap renderers. Caller holds self.lock.
+        Ensures max is at least 1.0 if no points exist or all speeds are 0 or less.
+        """
+        return self.max_speed if self.points and self.max_speed > 0 else 1.0
+
+    def _invalidate(self):
+        """Marks cached output as stale after the point set changed. Caller holds self.lock."""
+        self._payload = None
+        self.version += 1
+
+    def _log_change(self, old_point, new_point):
+        """Records the change that produced the current version. Caller holds self.lock."""
+        if len(self._changes) == self._changes.maxlen:
+            # The oldest entry is about to drop out of the log.
+            self._changes_base += 1
+        self._changes.append((self.version, old_point, new_point))
+
+    @staticmethod
+    def _trim_pending(pending: OrderedDict):
+        """Evicts the oldest pending halves beyond MAX_PENDING_ENTRIES."""
+        while len(pending) > MAX_PENDING_ENTRIES:
+            pending.popitem(last=False)
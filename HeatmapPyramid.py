@@ -0,0 +1,255 @@
+# HeatmapPyramid.py
+# Multi-resolution grid aggregates of the speed heatmap.
+# Level 0 bins points into 1x1 pixel cells; every following level halves the
+# resolution (2x2 cells of the level below). Each occupied cell stores the
+# count, sum, min and max download speed of the measurements inside it, so
+# /heatmap-data can return one point per cell instead of one per measurement.
+
+import json
+import threading
+
+import numpy as np
+
+
+def levels_for_size(width: int, height: int) -> int:
+    """Returns the number of levels needed until a single cell covers the whole image."""
+    levels = 1
+    while (1 << (levels - 1)) < max(width, height):
+        levels += 1
+    return levels
+
+
+def level_for_cell_size(cell_size: int, num_levels: int) -> int:
+    """
+    Returns the finest level whose cells are at least `cell_size` pixels wide,
+    capped at the coarsest available level.
+    """
+    level = 0
+    while (1 << level) < cell_size and level < num_levels - 1:
+        level += 1
+    return level
+
+
+def merge_cells(cx: np.ndarray, cy: np.ndarray, count: np.ndarray, total: np.ndarray,
+                low: np.ndarray, high: np.ndarray) -> tuple:
+    """
+    Combines entries that share the same (cx, cy) cell.
+    Returns (cx, cy, count, sum, min, max) arrays with one entry per distinct cell.
+    """
+    keys = (cy.astype(np.int64) << 32) | cx.astype(np.int64)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    cells = len(unique_keys)
+    merged_low = np.full(cells, np.inf)
+    merged_high = np.full(cells, -np.inf)
+    np.minimum.at(merged_low, inverse, low)
+    np.maximum.at(merged_high, inverse, high)
+    return (
+        (unique_keys & 0xFFFFFFFF).astype(np.int64),
+        (unique_keys >> 32).astype(np.int64),
+        np.bincount(inverse, weights=count, minlength=cells),
+        np.bincount(inverse, weights=total, minlength=cells),
+        merged_low,
+        merged_high,
+    )
+
+
+class _Level:
+    """
+    Cells of one pyramid level as parallel columns plus a (cx, cy) -> row index, so
+    a full build fills the columns straight from NumPy arrays. Cells that become
+    empty keep their row with a count of 0 (they are skipped in payloads and reused
+    if a point arrives again).
+    """
+    __slots__ = ("index", "cx", "cy", "count", "total", "low", "high")
+
+    def __init__(self, cx: np.ndarray, cy: np.ndarray, count: np.ndarray, total: np.ndarray,
+                 low: np.ndarray, high: np.ndarray):
+        self.cx, self.cy = cx.tolist(), cy.tolist()
+        self.count = count.astype(np.int64).tolist()
+        self.total, self.low, self.high = total.tolist(), low.tolist(), high.tolist()
+        self.index = dict(zip(zip(self.cx, self.cy), range(len(self.cx))))
+
+    def add(self, key: tuple[int, int], speed: float):
+        """Adds one measurement to a cell."""
+        row = self.index.get(key)
+        if row is None:
+            self.index[key] = len(self.cx)
+            for column, value in ((self.cx, key[0]), (self.cy, key[1]), (self.count, 1), (self.total, speed),
+                                  (self.low, speed), (self.high, speed)):
+                column.append(value)
+        elif self.count[row] == 0:
+            self.count[row], self.total[row], self.low[row], self.high[row] = 1, speed, speed, speed
+        else:
+            self.count[row] += 1
+            self.total[row] += speed
+            self.low[row] = min(self.low[row], speed)
+            self.high[row] = max(self.high[row], speed)
+
+    def arrays(self) -> tuple:
+        """Returns (cx, cy, count, sum, min, max) arrays of the occupied cells, ordered by row, then column."""
+        columns = [np.array(column) for column in (self.cx, self.cy, self.count, self.total, self.low, self.high)]
+        occupied = np.flatnonzero(columns[2] > 0)
+        order = occupied[np.lexsort((columns[0][occupied], columns[1][occupied]))]
+        return tuple(column[order] for column in columns)
+
+
+class HeatmapPyramid:
+    """
+    Pyramid of binned aggregates over a HeatmapAggregate.
+    Built once (vectorized) from a snapshot of the aggregate; after that, each point
+    the aggregate adds, moves or removes is folded into the one cell it touches on
+    every level, so a saved measurement costs O(levels) instead of a full rebuild.
+    The JSON body of a level is cached until the next change and rebuilt only for
+    the levels that are requested.
+    """
+    def __init__(self, aggregate, width: int, height: int):
+        """
+        Args:
+            aggregate: The HeatmapAggregate providing (x, y, speed) points.
+            width: Floor plan width in pixels.
+            height: Floor plan height in pixels.
+        """
+        self.aggregate = aggregate
+        self.width = width
+        self.height = height
+        self.num_levels = levels_for_size(width, height)
+        # Version of the aggregate the levels reflect.
+        self._version = None
+        # One _Level per level, finest first.
+        self._levels = []
+        # Speeds of the points in each pixel holding more than one, for recomputing a
+        # level 0 cell's min and max when one of its points leaves.
+        self._pixel_speeds = {}
+        # Cached JSON bodies keyed by level.
+        self._payloads = {}
+        # Number of full rebuilds so far (the first build included).
+        self.rebuilds = 0
+        # Lock protecting the levels and cached payloads.
+        self.lock = threading.Lock()
+
+    def payload_json(self, level: int) -> str:
+        """
+        Returns the /heatmap-data JSON body for the given level:
+        {"max": float, "level": int, "cell_size": int, "data": list[dict]} with one
+        point { "x", "y", "value" (mean download), "count", "min", "max" } per occupied cell.
+        """
+        if not 0 <= level < self.num_levels:
+            raise ValueError(f"level must be between 0 and {self.num_levels - 1}")
+        with self.lock:
+            self._refresh()
+            if level not in self._payloads:
+                self._payloads[level] = json.dumps(self._build_payload(level))
+            return self._payloads[level]
+
+    # --- Internal helpers (caller holds self.lock) ---
+
+    def _refresh(self):
+        """Applies the aggregate's changes since the last refresh, or rebuilds if they are unavailable."""
+        if self._version == self.aggregate.version:
+            return
+        changes = None if self._version is None else self.aggregate.changes_since(self._version)
+        if changes is None:
+            self._rebuild()
+            return
+        version, point_changes = changes
+        for old_point, new_point in point_changes:
+            if old_point is not None:
+                self._remove_point(*old_point)
+            if new_point is not None:
+                self._add_point(*new_point)
+        self._payloads = {}
+        self._version = version
+
+    def _rebuild(self):
+        """Rebuilds every level from a snapshot of the aggregate."""
+        version, points, _ = self.aggregate.snapshot()
+        data = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        # Level 0: one cell per pixel, merging measurements that map to the same pixel.
+        speeds = data[:, 2]
+        current = merge_cells(
+            data[:, 0].astype(np.int64), data[:, 1].astype(np.int64),
+            np.ones(len(speeds)), speeds, speeds, speeds
+        )
+        levels = [_Level(*current)]
+        # Each coarser level merges 2x2 blocks of the level below.
+        for _ in range(1, self.num_levels):
+            cx, cy, count, total, low, high = current
+            current = merge_cells(cx >> 1, cy >> 1, count, total, low, high)
+            levels.append(_Level(*current))
+        self._levels = levels
+        # Group the speeds by pixel; only pixels with several points need their list.
+        keys = (data[:, 1].astype(np.int64) << 32) | data[:, 0].astype(np.int64)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        sizes = np.diff(np.r_[starts, len(sorted_keys)])
+        sorted_speeds = speeds[order].tolist()
+        self._pixel_speeds = {
+            (key & 0xFFFFFFFF, key >> 32): sorted_speeds[start:start + size]
+            for key, start, size in zip(sorted_keys[starts[sizes > 1]].tolist(), starts[sizes > 1].tolist(),
+                                        sizes[sizes > 1].tolist())
+        }
+        self._payloads = {}
+        self._version = version
+        self.rebuilds += 1
+
+    def _add_point(self, x: int, y: int, speed: float):
+        """Folds one point into its cell on every level."""
+        x, y = int(x), int(y)
+        pixels = self._levels[0]
+        row = pixels.index.get((x, y))
+        if row is not None and pixels.count[row] >= 2:
+            self._pixel_speeds[(x, y)].append(speed)
+        elif row is not None and pixels.count[row] == 1:
+            self._pixel_speeds[(x, y)] = [pixels.low[row], speed]
+        for level, cells in enumerate(self._levels):
+            cells.add((x >> level, y >> level), speed)
+
+    def _remove_point(self, x: int, y: int, speed: float):
+        """Takes one point out of its cell on every level."""
+        x, y = int(x), int(y)
+        # The speeds left in the pixel (None if the pixel held only this point).
+        speeds = self._pixel_speeds.get((x, y))
+        if speeds is not None:
+            speeds.remove(speed)
+            if len(speeds) == 1:
+                del self._pixel_speeds[(x, y)]
+        for level, cells in enumerate(self._levels):
+            key = (x >> level, y >> level)
+            row = cells.index[key]
+            cells.count[row] -= 1
+            if cells.count[row] == 0:
+                cells.total[row] = 0.0
+                continue
+            cells.total[row] -= speed
+            if speed <= cells.low[row] or speed >= cells.high[row]:
+                # The point may have been the extreme: recompute from the pixel's
+                # speeds, or from the occupied cells (at most four) of the level below.
+                if level == 0:
+                    cells.low[row], cells.high[row] = min(speeds), max(speeds)
+                else:
+                    below = self._levels[level - 1]
+                    children = [below.index.get((key[0] * 2 + dx, key[1] * 2 + dy)) for dx in (0, 1) for dy in (0, 1)]
+                    children = [child for child in children if child is not None and below.count[child] > 0]
+                    cells.low[row] = min(below.low[child] for child in children)
+                    cells.high[row] = max(below.high[child] for child in children)
+
+    def _build_payload(self, level: int) -> dict:
+        """Converts a level's cells into heatmap points at the cell centers."""
+        cx, cy, count, total, low, high = self._levels[level].arrays()
+        cell_size = 1 << level
+        xs = np.minimum(cx * cell_size + cell_size // 2, self.width - 1)
+        ys = np.minimum(cy * cell_size + cell_size // 2, self.height - 1)
+        means = total / np.maximum(count, 1)
+        data = [
+            {"x": int(x), "y": int(y), "value": float(v), "count": int(n), "min": float(lo), "max": float(hi)}
+            for x, y, v, n, lo, hi in zip(xs, ys, means, count, low, high)
+        ]
+        # Same fallback as the raw payload: max is at least 1.0 when empty or non-positive.
+        max_mean = float(means.max()) if len(means) else 0.0
+        return {
+            "max": max_mean if max_mean > 0 else 1.0,
+            "level": level,
+            "cell_size": cell_size,
+            "data": data,
+        }
@@ -0,0 +1,133 @@
+# HeatmapRaster.py
+# Server-side rendering of the speed heatmap as a transparent PNG overlay.
+# Points are binned onto the floor-plan pixel grid and blurred with a Gaussian
+# kernel using NumPy, so the rendering cost depends on the image size rather
+# than on the number of stored measurements.
+
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+# Rendering parameters, matching the heatmap.js configuration in templates/index.html.
+HEATMAP_RADIUS = 100 # Influence radius of each data point (pixels).
+HEATMAP_MAX_OPACITY = 0.6 # Maximum opacity of the overlay.
+# Color gradient: blue (low) -> cyan -> white -> yellow -> red (high).
+HEATMAP_GRADIENT = [
+    (0.0, (0, 0, 255)),
+    (0.25, (0, 255, 255)),
+    (0.5, (255, 255, 255)),
+    (0.75, (255, 255, 0)),
+    (1.0, (255, 0, 0)),
+]
+
+
+def gaussian_kernel(radius: int) -> np.ndarray:
+    """
+    Returns a 1-D Gaussian kernel of length 2 * radius + 1 with a peak of 1.0.
+    The standard deviation is radius / 3, so the kernel fades out at the radius.
+    """
+    offsets = np.arange(-radius, radius + 1, dtype=np.float64)
+    sigma = max(radius / 3.0, 1e-6)
+    return np.exp(-0.5 * (offsets / sigma) ** 2)
+
+
+def blur(grid: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """
+    Convolves a 2-D grid with a separable kernel along both axes ('same' output size).
+    Uses FFTs so the cost is independent of how many cells are occupied.
+    """
+    radius = len(kernel) // 2
+    for axis in (0, 1):
+        length = grid.shape[axis]
+        # Zero-pad to avoid wrap-around between opposite image edges.
+        size = length + 2 * radius
+        spectrum = np.fft.rfft(grid, n=size, axis=axis) * np.fft.rfft(kernel, n=size).reshape(
+            (-1, 1) if axis == 0 else (1, -1)
+        )
+        full = np.fft.irfft(spectrum, n=size, axis=axis)
+        # Keep the window aligned with the original grid.
+        grid = np.take(full, np.arange(radius, radius + length), axis=axis)
+    return grid
+
+
+def gradient_lut(gradient: list = HEATMAP_GRADIENT) -> np.ndarray:
+    """Builds a 256 x 3 uint8 color lookup table by interpolating the gradient stops."""
+    positions = np.linspace(0.0, 1.0, 256)
+    stops = [stop for stop, _ in gradient]
+    channels = [np.interp(positions, stops, [color[c] for _, color in gradient]) for c in range(3)]
+    return np.stack(channels, axis=1).round().astype(np.uint8)
+
+
+def encode_png(rgba: np.ndarray) -> bytes:
+    """Encodes an H x W x 4 uint8 array as a PNG image (RGBA, 8 bits per channel)."""
+    height, width, _ = rgba.shape
+    # Each scanline is prefixed with filter type 0 (None).
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n" +
+        chunk(b"IHDR", header) +
+        chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) +
+        chunk(b"IEND", b"")
+    )
+
+
+def render_heatmap_rgba(points: list, max_value: float, width: int, height: int,
+                        radius: int = HEATMAP_RADIUS) -> np.ndarray:
+    """
+    Renders (x, y, value) points into an H x W x 4 RGBA array.
+    Each point contributes a Gaussian splat weighted by value / max_value; the summed
+    intensity (clipped to 1.0) selects the gradient color and scales the opacity.
+    """
+    intensity = np.zeros(height * width, dtype=np.float64)
+    if points:
+        data = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        xs = np.clip(data[:, 0].astype(np.int64), 0, width - 1)
+        ys = np.clip(data[:, 1].astype(np.int64), 0, height - 1)
+        weights = np.clip(data[:, 2] / max_value, 0.0, 1.0)
+        # Bin all points onto the pixel grid in one pass.
+        intensity = np.bincount(ys * width + xs, weights=weights, minlength=height * width)
+    intensity = np.clip(blur(intensity.reshape(height, width), gaussian_kernel(radius)), 0.0, 1.0)
+
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    rgba[..., :3] = gradient_lut()[(intensity * 255).astype(np.uint8)]
+    rgba[..., 3] = (intensity * HEATMAP_MAX_OPACITY * 255).astype(np.uint8)
+    return rgba
+
+
+class HeatmapRenderer:
+    """
+    Renders a HeatmapAggregate to PNG and caches the encoded image until the
+    aggregate's version changes, so repeated requests cost a cache lookup.
+    """
+    def __init__(self, aggregate, width: int, height: int):
+        """
+        Args:
+            aggregate: The HeatmapAggregate to render.
+            width: Output image width in pixels (floor plan width).
+            height: Output image height in pixels (floor plan height).
+        """
+        self.aggregate = aggregate
+        self.width = width
+        self.height = height
+        # Cached (version, png_bytes) for the last rendered aggregate state.
+        self._cache = (None, None)
+        # Lock so concurrent requests for a stale image render it only once.
+        self.lock = threading.Lock()
+
+    def png(self) -> bytes:
+        """Returns the PNG overlay for the aggregate's current contents."""
+        with self.lock:
+            # Comparing versions is O(1); points are only copied when a re-render is due.
+            if self._cache[0] != self.aggregate.version:
+                version, points, max_value = self.aggregate.snapshot()
+                rgba = render_heatmap_rgba(points, max_value, self.width, self.height)
+                self._cache = (version, encode_png(rgba))
+            return self._cache[1]
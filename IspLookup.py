@@ -0,0 +1,301 @@
+# IspLookup.py
+# ISP lookups for /backend/getIP.
+# The speed test asks for the client's ISP when it starts, and the same office IPs
+# come back all day. Lookups go through a pluggable backend: the ipinfo.io API over
+# a pooled HTTP session or a local JSON file standing in for it, both behind an LRU
+# cache with a time-to-live so repeated IPs never leave the process and failing
+# lookups are not retried on every request; or, for offline sites, a local table
+# of network prefixes searched in memory.
+
+import bisect
+import csv
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+# Timeout in seconds for one ipinfo.io request.
+API_TIMEOUT_SECONDS = 2
+# Number of IPs kept in the cache; the least recently used are dropped first.
+DEFAULT_CACHE_ENTRIES = 4096
+# Seconds a successful lookup is reused.
+DEFAULT_TTL_SECONDS = 6 * 3600
+# Seconds a failed lookup (or one without an ISP) is remembered before retrying.
+DEFAULT_NEGATIVE_TTL_SECONDS = 300
+# Upper 96 bits of an IPv4-mapped IPv6 address (::ffff:a.b.c.d).
+IPV4_MAPPED_PREFIX = 0xFFFF
+
+
+def isp_from_ipinfo(data: dict) -> str | None:
+    """Returns the ISP name from an ipinfo.io-style record, or None if it has none."""
+    # Prefer the organization name, without its 'AS' prefix.
+    if "org" in data:
+        return data["org"].replace("AS", "").strip()
+    # Fallback to the ASN name if 'org' is not present.
+    if "asn" in data and "name" in data["asn"]:
+        return data["asn"]["name"]
+    return None
+
+
+class IpinfoLookup:
+    """
+    Looks IPs up with the ipinfo.io API.
+    Requests share one requests.Session, so the TCP/TLS connection to ipinfo.io is
+    kept alive and reused instead of being set up for every lookup.
+    """
+    def __init__(self, api_key: str, base_url: str = "https://ipinfo.io", timeout: float = API_TIMEOUT_SECONDS):
+        """
+        Args:
+            api_key: ipinfo.io access token.
+            base_url: API root; a local fixture server can stand in for ipinfo.io.
+            timeout: Timeout in seconds for one request.
+        """
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        # Pooled HTTP session (thread-safe for simple GETs).
+        self.session = requests.Session()
+
+    def lookup(self, ip_address: str) -> tuple[str | None, dict] | None:
+        """
+        Returns (isp, raw_record) for an IP, or None if the lookup failed.
+        isp is None when the record has no ISP name.
+        """
+        try:
+            # Make the request with a timeout.
+            res = self.session.get(f"{self.base_url}/{ip_address}/json", params={"token": self.api_key},
+                                   timeout=self.timeout)
+            if not res.ok:
+                print(f"ipinfo.io lookup for {ip_address} failed with status {res.status_code}")
+                return None
+            data = res.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # Log API call failure (or an unreadable response), but continue.
+            print(f"ipinfo.io API call failed: {e}")
+            return None
+        return isp_from_ipinfo(data), data
+
+
+class FileLookup:
+    """
+    Looks IPs up in a JSON file of ipinfo.io-style records: {"<ip>": {"org": ...}, ...}.
+    Stands in for ipinfo.io in tests and on sites without internet access.
+    """
+    def __init__(self, path: str):
+        """
+        Args:
+            path: JSON file to load (read once, here).
+        """
+        self.path = path
+        with open(path, encoding="utf-8") as records_file:
+            self.records = json.load(records_file)
+
+    def lookup(self, ip_address: str) -> tuple[str | None, dict] | None:
+        """Returns (isp, raw_record) for an IP, or None if the file has no record for it."""
+        data = self.records.get(ip_address)
+        if data is None:
+            return None
+        return isp_from_ipinfo(data), data
+
+
+def parse_cidr(text: str) -> tuple[int, int, int]:
+    """
+    Returns (ip_version, first_address, last_address) of a CIDR network such as
+    '203.0.113.0/24' or '2001:db8::/32' (host bits are ignored; no length means a
+    single address). Parses with inet_pton, several times faster than ipaddress
+    objects when loading large tables.
+    Raises:
+        ValueError: If the text is not a network.
+    """
+    address, _, length = text.strip().partition("/")
+    family, version, bits = (socket.AF_INET6, 6, 128) if ":" in address else (socket.AF_INET, 4, 32)
+    try:
+        value = int.from_bytes(socket.inet_pton(family, address), "big")
+        prefix_length = int(length) if length else bits
+    except (OSError, ValueError):
+        raise ValueError(f"invalid network '{text}'") from None
+    if not 0 <= prefix_length <= bits:
+        raise ValueError(f"invalid prefix length in '{text}'")
+    host_mask = (1 << (bits - prefix_length)) - 1
+    first = value & ~host_mask
+    return version, first, first | host_mask
+
+
+class PrefixTableLookup:
+    """
+    Looks IPs up in a local table of network prefixes, without any network access.
+    The table is a CSV file with a header row naming at least the columns 'network'
+    (CIDR, IPv4 or IPv6) and 'isp'; other columns (e.g. 'asn') are passed through in
+    the raw record. Nested prefixes resolve to the most specific one.
+    At load time the prefixes of each IP version are flattened into sorted, disjoint
+    integer intervals, so a lookup is one binary search, O(log n) in the table size.
+    """
+    def __init__(self, path: str):
+        """
+        Args:
+            path: CSV file to load (read once, here).
+        Raises:
+            ValueError: If the header lacks a required column or a network is invalid.
+        """
+        self.path = path
+        # Raw record per table row: {"network": str, "org": str, ...extra columns}.
+        self.records = []
+        # {ip_version: list of (first_address, last_address, record_index)}.
+        ranges = {4: [], 6: []}
+        with open(path, newline="", encoding="utf-8") as table_file:
+            reader = csv.DictReader(table_file)
+            missing = {"network", "isp"} - set(reader.fieldnames or ())
+            if missing:
+                raise ValueError(f"{path}: missing column(s) {', '.join(sorted(missing))}")
+            for row in reader:
+                network = (row["network"] or "").strip()
+                try:
+                    version, first, last = parse_cidr(network)
+                except ValueError as e:
+                    raise ValueError(f"{path}, line {reader.line_num}: {e}") from None
+                record = {key: value for key, value in row.items() if key not in ("network", "isp") and key is not None}
+                record.update(network=network, org=(row["isp"] or "").strip())
+                ranges[version].append((first, last, len(self.records)))
+                self.records.append(record)
+        # {ip_version: (starts, ends, record_indexes)} of disjoint intervals sorted by start.
+        self.tables = {version: self._flatten(version_ranges) for version, version_ranges in ranges.items()}
+
+    def lookup(self, ip_address: str) -> tuple[str | None, dict] | None:
+        """Returns (isp, raw_record) for an IP, or None if no prefix covers it (or it is not an IP)."""
+        if "/" in ip_address:
+            return None
+        try:
+            version, value, _ = parse_cidr(ip_address)
+        except ValueError:
+            return None
+        # IPv4 clients reaching an IPv6 socket show up as ::ffff:a.b.c.d.
+        if version == 6 and value >> 32 == IPV4_MAPPED_PREFIX:
+            version, value = 4, value & 0xFFFFFFFF
+        starts, ends, record_indexes = self.tables[version]
+        # Last interval starting at or before the address.
+        position = bisect.bisect_right(starts, value) - 1
+        if position < 0 or value > ends[position]:
+            return None
+        record = self.records[record_indexes[position]]
+        return record["org"] or None, dict(record, ip=ip_address)
+
+    def __len__(self) -> int:
+        """Returns the number of prefixes in the table."""
+        return len(self.records)
+
+    @staticmethod
+    def _flatten(ranges: list[tuple[int, int, int]]) -> tuple[list, list, list]:
+        """
+        Turns CIDR ranges, which are either nested or disjoint, into disjoint intervals
+        labelled with the innermost range covering them (the later row for duplicates).
+        Returns (starts, ends, record_indexes), sorted by start.
+        """
+        starts, ends, record_indexes = [], [], []
+
+        def emit(first, last, record_index):
+            if first <= last:
+                starts.append(first)
+                ends.append(last)
+                record_indexes.append(record_index)
+
+        # Outer ranges sort before the ranges nested at their start.
+        ranges.sort(key=lambda item: (item[0], -item[1], item[2]))
+        # Ranges enclosing the current position, innermost last, and the first
+        # address not yet emitted.
+        open_ranges = []
+        cursor = 0
+        for first, last, record_index in ranges:
+            # Close the ranges that end before this one starts.
+            while open_ranges and open_ranges[-1][1] < first:
+                _, closed_last, closed_index = open_ranges.pop()
+                emit(cursor, closed_last, closed_index)
+                cursor = max(cursor, closed_last + 1)
+            # The enclosing range covers the gap up to this one.
+            if open_ranges:
+                emit(cursor, first - 1, open_ranges[-1][2])
+            open_ranges.append((first, last, record_index))
+            cursor = first
+        while open_ranges:
+            _, closed_last, closed_index = open_ranges.pop()
+            emit(cursor, closed_last, closed_index)
+            cursor = max(cursor, closed_last + 1)
+        return starts, ends, record_indexes
+
+
+class CachedIspLookup:
+    """
+    Thread-safe LRU cache with a time-to-live in front of a lookup backend (any object
+    with lookup(ip) -> (isp, raw_record) | None, such as IpinfoLookup or FileLookup).
+    Failed lookups and records without an ISP are cached for the shorter negative TTL.
+    The backend is called outside the lock, so a slow lookup does not block others.
+    """
+    def __init__(self, backend, max_entries: int = DEFAULT_CACHE_ENTRIES, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 negative_ttl_seconds: float = DEFAULT_NEGATIVE_TTL_SECONDS):
+        """
+        Args:
+            backend: Lookup backend queried on cache misses.
+            max_entries: Number of IPs kept.
+            ttl_seconds: Seconds a lookup with an ISP is reused.
+            negative_ttl_seconds: Seconds a failed lookup, or one without an ISP, is reused.
+        """
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        # {ip: (expires_at, (isp, raw_record))}, least recently used first.
+        self.entries = OrderedDict()
+        # Lock protecting entries.
+        self.lock = threading.Lock()
+
+    def lookup(self, ip_address: str, now: float = None) -> tuple[str | None, dict | None]:
+        """Returns (isp, raw_record) for an IP; both are None if nothing is known about it."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.entries.get(ip_address)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(ip_address)
+                return entry[1]
+
+        result = self.backend.lookup(ip_address) or (None, None)
+        ttl = self.ttl_seconds if result[0] else self.negative_ttl_seconds
+        with self.lock:
+            self.entries[ip_address] = (now + ttl, result)
+            self.entries.move_to_end(ip_address)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return result
+
+    def __len__(self) -> int:
+        """Returns the number of cached IPs (including expired ones not yet replaced)."""
+        with self.lock:
+            return len(self.entries)
+
+
+def create_isp_lookup(path: str = None, api_key: str = None,
+                      prefix_table: str = None) -> CachedIspLookup | PrefixTableLookup | None:
+    """
+    Creates the configured ISP lookup, or None if ISP lookups are not configured.
+    Every lookup has lookup(ip) -> (isp, raw_record) | None.
+    Args:
+        path: JSON records file for FileLookup; defaults to the ACCESSPOINTER_ISP_FILE
+              environment variable. Takes precedence over the others.
+        api_key: ipinfo.io token for IpinfoLookup; defaults to IPINFO_APIKEY.
+        prefix_table: CSV prefix table for PrefixTableLookup; defaults to
+                      ACCESSPOINTER_ISP_PREFIXES. Takes precedence over the API, so a
+                      site with a table never calls out. Served uncached, as a table
+                      lookup is cheaper than a cache hit.
+    """
+    path = path or os.environ.get("ACCESSPOINTER_ISP_FILE")
+    if path:
+        return CachedIspLookup(FileLookup(path))
+    prefix_table = prefix_table or os.environ.get("ACCESSPOINTER_ISP_PREFIXES")
+    if prefix_table:
+        return PrefixTableLookup(prefix_table)
+    api_key = api_key or os.environ.get("IPINFO_APIKEY")
+    if api_key:
+        return CachedIspLookup(IpinfoLookup(api_key))
+    return None
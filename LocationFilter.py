@@ -0,0 +1,126 @@
+# LocationFilter.py
+# Streaming smoothing of live location fixes (/save_user_location).
+# Indoor phone GPS jitters by several meters between fixes; a constant-velocity
+# Kalman filter per session turns the raw fixes into a smoothed track, so the
+# live dot stops jumping and jitter no longer counts as movement downstream.
+
+import math
+
+from LocationUpdatePolicy import BASE_UPDATE_INTERVAL_MS, MAX_UPDATE_INTERVAL_MS
+from SpatialIndex import LocalProjection
+
+# Assumed fix accuracy (1-sigma, meters) when the client does not report one.
+DEFAULT_ACCURACY_METERS = 8.0
+# Fix accuracies are clamped to this range (meters); browsers sometimes report 0
+# or thousands of meters for coarse network fixes.
+MIN_ACCURACY_METERS = 1.0
+MAX_ACCURACY_METERS = 100.0
+# Process noise: how quickly a walking user's velocity can change (m^2/s^3).
+PROCESS_NOISE = 0.1
+# Velocity variance ((m/s)^2) assumed for a newly started track.
+INITIAL_VELOCITY_VARIANCE = 4.0
+# A track is restarted from the raw fix after a gap longer than this (seconds): twice
+# the longest update interval the server suggests, so the fixes of a backed-off
+# device still arrive (network latency included) within the gap and keep its track.
+MAX_GAP_SECONDS = 2 * MAX_UPDATE_INTERVAL_MS / 1000
+# Gap (seconds) beyond which a fix is checked against the track at rest: longer than
+# the interval suggested to moving devices, so only backed-off devices are checked.
+REST_CHECK_MIN_GAP_SECONDS = 2 * BASE_UPDATE_INTERVAL_MS / 1000
+# Speed (m/s) below which a track counts as at rest.
+REST_SPEED_METERS_PER_SECOND = 0.5
+# A fix lying within this many standard deviations of a track at rest is taken as
+# the device still being there. Over the long gaps of a backed-off device the
+# constant-velocity model alone lets the position drift freely, so without this
+# check GPS jitter would pass through unsmoothed and count as movement.
+REST_GATE_SIGMAS = 3.0
+
+
+class PositionFilter:
+    """
+    Constant-velocity Kalman filter run independently along the east and north axes
+    of a local metric projection.
+    Both axes see the same noise and the same update times, so they share one
+    covariance; the whole per-session state is the 8-float tuple
+    (timestamp, east, north, velocity_east, velocity_north, p_pos, p_pos_vel, p_vel),
+    which the session store keeps with the session. The filter object itself holds
+    only configuration, so one instance serves every session.
+    """
+    def __init__(self, reference_latitude: float, reference_longitude: float,
+                 process_noise: float = PROCESS_NOISE, default_accuracy: float = DEFAULT_ACCURACY_METERS):
+        """
+        Args:
+            reference_latitude: Latitude of the projection origin (e.g. the floor plan center).
+            reference_longitude: Longitude of the projection origin.
+            process_noise: Acceleration noise density in m^2/s^3.
+            default_accuracy: Fix accuracy in meters used when none is reported.
+        """
+        self.projection = LocalProjection(reference_latitude, reference_longitude)
+        self.process_noise = process_noise
+        self.default_accuracy = default_accuracy
+
+    def step(self, state: tuple | None, latitude: float, longitude: float, timestamp: float,
+             accuracy: float = None) -> tuple[tuple | None, float, float]:
+        """
+        Feeds one raw fix into a session's filter.
+        Args:
+            state: The session's previous state, or None to start a new track.
+            latitude: Raw fix latitude.
+            longitude: Raw fix longitude.
+            timestamp: Fix time in Unix seconds.
+            accuracy: Reported fix accuracy in meters (1-sigma), or None for the default.
+        Returns:
+            (new_state, smoothed_latitude, smoothed_longitude). Unusable fixes
+            (non-finite coordinates) pass through unchanged and reset the track.
+        """
+        east, north = self.projection.project(latitude, longitude)
+        if not (math.isfinite(east) and math.isfinite(north) and math.isfinite(timestamp)):
+            return None, latitude, longitude
+        variance = self._accuracy(accuracy) ** 2
+
+        dt = None if state is None else timestamp - state[0]
+        if dt is None or dt < 0 or dt > MAX_GAP_SECONDS:
+            # (Re)start the track at the raw fix, at rest.
+            return (timestamp, east, north, 0.0, 0.0, variance, 0.0, INITIAL_VELOCITY_VARIANCE), latitude, longitude
+
+        _, x, y, vx, vy, p00, p01, p11 = state
+        if dt > REST_CHECK_MIN_GAP_SECONDS and vx * vx + vy * vy < REST_SPEED_METERS_PER_SECOND ** 2 and \
+                (east - x) ** 2 + (north - y) ** 2 <= REST_GATE_SIGMAS ** 2 * (p00 + variance):
+            # Still at rest: average the fix into the position, with no motion since the last fix.
+            dt = vx = vy = p01 = 0.0
+        # Predict: move along the estimated velocity and grow the uncertainty.
+        q = self.process_noise
+        x += vx * dt
+        y += vy * dt
+        p00 += 2 * dt * p01 + dt * dt * p11 + q * dt ** 3 / 3
+        p01 += dt * p11 + q * dt * dt / 2
+        p11 += q * dt
+        # Update: blend in the fix according to the Kalman gain.
+        innovation_variance = p00 + variance
+        gain_pos = p00 / innovation_variance
+        gain_vel = p01 / innovation_variance
+        dx = east - x
+        dy = north - y
+        x += gain_pos * dx
+        y += gain_pos * dy
+        vx += gain_vel * dx
+        vy += gain_vel * dy
+        p11 -= gain_vel * p01
+        p00 *= 1 - gain_pos
+        p01 *= 1 - gain_pos
+
+        smoothed_latitude, smoothed_longitude = self._unproject(x, y)
+        return (timestamp, x, y, vx, vy, p00, p01, p11), smoothed_latitude, smoothed_longitude
+
+    # --- Internal helpers ---
+
+    def _accuracy(self, accuracy: float | None) -> float:
+        """Returns the reported accuracy clamped to a usable range, or the default."""
+        if accuracy is None or not math.isfinite(accuracy):
+            return self.default_accuracy
+        return min(max(accuracy, MIN_ACCURACY_METERS), MAX_ACCURACY_METERS)
+
+    def _unproject(self, east: float, north: float) -> tuple[float, float]:
+        """Returns the (latitude, longitude) of a projected position."""
+        degrees_per_meter_lat, degrees_per_meter_lon = self.projection.degrees_for_meters(1.0)
+        return (self.projection.reference_latitude + north * degrees_per_meter_lat,
+                self.projection.reference_longitude + east * degrees_per_meter_lon)
@@ -0,0 +1,71 @@
+# LocationUpdatePolicy.py
+# Server-side policy for live location updates (/save_user_location):
+# the movement threshold below which fixes are coalesced, and the suggested
+# interval until a client's next update. Devices that stay put back off
+# exponentially, and every client slows down while the server is busy.
+
+import threading
+import time
+
+# Fixes closer than this to a session's stored position are coalesced (phone GPS
+# jitters by a few meters even when the device is not moving).
+MOVEMENT_THRESHOLD_METERS = 2.0
+# Interval suggested to moving devices (the frontend's original fixed interval).
+BASE_UPDATE_INTERVAL_MS = 2000
+# Longest interval suggested to stationary devices or under heavy load.
+MAX_UPDATE_INTERVAL_MS = 30000
+# Update rate (per second, across all sessions) the server aims to stay below.
+TARGET_UPDATES_PER_SECOND = 50.0
+# Window over which the update rate is measured.
+LOAD_WINDOW_SECONDS = 5
+
+
+class RateMeter:
+    """
+    Counts events over a sliding window of whole seconds using one bucket per second,
+    so recording an event and reading the rate are both O(1).
+    """
+    def __init__(self, window_seconds: int = LOAD_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        # Event counts per second, indexed by (second % window_seconds).
+        self.buckets = [0] * window_seconds
+        # The second each bucket currently counts.
+        self.bucket_seconds = [0] * window_seconds
+        # Lock protecting the buckets.
+        self.lock = threading.Lock()
+
+    def record(self, now: float = None):
+        """Counts one event."""
+        second = int(time.time() if now is None else now)
+        index = second % self.window_seconds
+        with self.lock:
+            if self.bucket_seconds[index] != second:
+                # The bucket still holds a count from an older window; reuse it.
+                self.bucket_seconds[index] = second
+                self.buckets[index] = 0
+            self.buckets[index] += 1
+
+    def rate(self, now: float = None) -> float:
+        """Returns the average number of events per second over the window."""
+        second = int(time.time() if now is None else now)
+        with self.lock:
+            total = sum(
+                count for count, bucket_second in zip(self.buckets, self.bucket_seconds)
+                if second - bucket_second < self.window_seconds
+            )
+        return total / self.window_seconds
+
+
+def suggest_update_interval_ms(stationary_updates: int, updates_per_second: float) -> int:
+    """
+    Returns the suggested milliseconds until a client's next location update.
+    Args:
+        stationary_updates: Consecutive fixes coalesced for the session (0 after a move).
+            Each one doubles the interval, up to MAX_UPDATE_INTERVAL_MS.
+        updates_per_second: Current server-wide update rate. Above
+            TARGET_UPDATES_PER_SECOND the interval is stretched proportionally.
+    """
+    interval = BASE_UPDATE_INTERVAL_MS * (2 ** min(stationary_updates, 16))
+    if updates_per_second > TARGET_UPDATES_PER_SECOND:
+        interval *= updates_per_second / TARGET_UPDATES_PER_SECOND
+    return int(min(interval, MAX_UPDATE_INTERVAL_MS))
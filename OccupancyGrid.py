@@ -0,0 +1,135 @@
+# OccupancyGrid.py
+# Live occupancy layer: how many tracked devices are in each area of the floor plan.
+# Session positions are binned into square pixel cells and the per-cell counts are
+# updated as sessions move or expire, so serving the layer never rescans sessions.
+
+import hashlib
+import json
+import threading
+
+import numpy as np
+
+# Edge length of one occupancy cell in floor plan pixels.
+DEFAULT_CELL_SIZE = 20
+
+
+class OccupancyGrid:
+    """
+    Thread-safe grid of device counts per cell.
+    Implements the same update(key, latitude, longitude) / remove(key) interface as
+    SpatialGridIndex, so a session store can keep it current as a position index.
+    Only positions inside the floor plan bounds are counted.
+    """
+    def __init__(self, map_func, width: int, height: int, cell_size: int = DEFAULT_CELL_SIZE):
+        """
+        Args:
+            map_func: Function mapping (latitude, longitude) to (x, y, in_bounds),
+                      normally Routes.map_lat_lon_to_pixels.
+            width: Floor plan width in pixels.
+            height: Floor plan height in pixels.
+            cell_size: Edge length of one cell in pixels.
+        """
+        self.map_func = map_func
+        self.width = width
+        self.height = height
+        self.cell_size = cell_size
+        # Device counts per cell, indexed [cell_y, cell_x].
+        self.counts = np.zeros((-(-height // cell_size), -(-width // cell_size)), dtype=np.int32)
+        # Cell currently counted for each session: {key: (cell_y, cell_x)}.
+        self.cells = {}
+        # Incremented whenever a count changes.
+        self.version = 0
+        # Cached JSON body and its ETag, None when they need rebuilding.
+        self._payload = None
+        self._etag = None
+        # Lock protecting all of the above.
+        self.lock = threading.Lock()
+
+    def update(self, key, latitude: float, longitude: float):
+        """Moves a session's count to the cell of its new position (or drops it if unmappable/out of bounds)."""
+        cell = self._cell(latitude, longitude)
+        with self.lock:
+            previous = self.cells.get(key)
+            if previous == cell:
+                return
+            if previous is not None:
+                self.counts[previous] -= 1
+            if cell is None:
+                self.cells.pop(key, None)
+            else:
+                self.counts[cell] += 1
+                self.cells[key] = cell
+            self._invalidate()
+
+    def remove(self, key):
+        """Stops counting a session."""
+        with self.lock:
+            previous = self.cells.pop(key, None)
+            if previous is not None:
+                self.counts[previous] -= 1
+                self._invalidate()
+
+    def reset(self, locations: dict):
+        """Replaces all counts with the given {key: (latitude, longitude, timestamp)} positions."""
+        cells = {}
+        for key, location in locations.items():
+            cell = self._cell(location[0], location[1])
+            if cell is not None:
+                cells[key] = cell
+        counts = np.zeros_like(self.counts)
+        if cells:
+            np.add.at(counts, tuple(np.array(list(cells.values())).T), 1)
+        with self.lock:
+            self.cells = cells
+            self.counts = counts
+            self._invalidate()
+
+    def payload_json(self) -> str:
+        """
+        Returns the /occupancy-data JSON body in heatmap.js format:
+        {"max": int, "cell_size": int, "sessions": int, "data": [{"x", "y", "value"}]}
+        with one point per occupied cell, at the cell center.
+        """
+        return self.payload_with_etag()[0]
+
+    def payload_with_etag(self) -> tuple[str, str]:
+        """
+        Returns (payload_json, etag), rebuilt only after a count changed. The ETag is
+        derived from the content rather than the version, so worker processes holding
+        the same counts agree on it.
+        """
+        with self.lock:
+            if self._payload is None:
+                cell_ys, cell_xs = np.nonzero(self.counts)
+                values = self.counts[cell_ys, cell_xs]
+                half = self.cell_size // 2
+                data = [
+                    {"x": int(min(cx * self.cell_size + half, self.width - 1)),
+                     "y": int(min(cy * self.cell_size + half, self.height - 1)),
+                     "value": int(value)}
+                    for cy, cx, value in zip(cell_ys, cell_xs, values)
+                ]
+                self._payload = json.dumps({
+                    # Same fallback as the speed heatmap: max is at least 1 when empty.
+                    "max": int(values.max()) if len(values) else 1,
+                    "cell_size": self.cell_size,
+                    "sessions": len(self.cells),
+                    "data": data,
+                })
+                self._etag = hashlib.blake2b(self._payload.encode(), digest_size=8).hexdigest()
+            return self._payload, self._etag
+
+    # --- Internal helpers ---
+
+    def _cell(self, latitude, longitude) -> tuple[int, int] | None:
+        """Returns the (cell_y, cell_x) of a position, or None if it is unmappable or out of bounds."""
+        x_pixel, y_pixel, is_within_bounds = self.map_func(latitude, longitude)
+        if x_pixel is None or y_pixel is None or not is_within_bounds:
+            return None
+        return y_pixel // self.cell_size, x_pixel // self.cell_size
+
+    def _invalidate(self):
+        """Marks the cached payload stale after a count changed. Caller holds self.lock."""
+        self._payload = None
+        self._etag = None
+        self.version += 1
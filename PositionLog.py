@@ -0,0 +1,308 @@
+# PositionLog.py
+# Persistent append-only log of the live location fixes accepted by /save_user_location,
+# so survey walks can be replayed after the fact (and after a restart).
+# Every fix is one fixed-size little-endian binary record:
+#     session hash (uint64), timestamp (float64, Unix seconds), latitude (float64), longitude (float64)
+# Files rotate by age and size, and old files are deleted once they pass the
+# retention age or the directory outgrows its size budget; each worker process
+# writes its own files. Reading
+# maps a file into memory and views it as a NumPy record array, so scans and
+# time slices over millions of fixes involve no parsing.
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+# Default directory for log files, next to the database (independent of the working directory).
+DEFAULT_POSITION_LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database", "positions")
+# Start a new file after this many seconds...
+DEFAULT_ROTATE_SECONDS = 3600
+# ...or once the current file reaches this size.
+DEFAULT_ROTATE_BYTES = 64 * 1024 * 1024
+# Files whose fixes are all older than this many seconds are deleted...
+DEFAULT_RETAIN_SECONDS = 30 * 24 * 3600
+# ...as are the oldest files while the directory holds more than this many bytes.
+DEFAULT_RETAIN_BYTES = 2 * 1024 * 1024 * 1024
+# Record layout; the struct and the NumPy dtype must describe the same bytes.
+RECORD_FORMAT = struct.Struct("<Qddd")
+RECORD_DTYPE = np.dtype([("session", "<u8"), ("timestamp", "<f8"), ("latitude", "<f8"), ("longitude", "<f8")])
+RECORD_SIZE = RECORD_FORMAT.size
+# Fixes are written to the OS in batches of this many records (flush() writes the rest).
+WRITE_BUFFER_RECORDS = 256
+# File names: positions-<start time in ms>-<pid>.bin, so names sort by start time.
+FILE_PREFIX = "positions-"
+FILE_SUFFIX = ".bin"
+
+
+def session_hash(session_id: str) -> int:
+    """Returns the stable 64-bit hash identifying a session in the log (the same in every process)."""
+    return int.from_bytes(hashlib.blake2b(session_id.encode(), digest_size=8).digest(), "little")
+
+
+def log_file_start(path: str) -> float:
+    """Returns the Unix time of the first fix in a log file, from its name."""
+    return _parse_log_file_name(path)[0]
+
+
+def _parse_log_file_name(path: str) -> tuple[float, int]:
+    """Returns (start time, writer pid) from a log file's name."""
+    start_ms, pid = os.path.basename(path)[len(FILE_PREFIX):-len(FILE_SUFFIX)].split("-")
+    return int(start_ms) / 1000, int(pid)
+
+
+class PositionLogWriter:
+    """
+    Thread-safe appender for one process's log files.
+    Appends only pack a record into a buffer; the buffer reaches the OS every
+    WRITE_BUFFER_RECORDS fixes, and flush() (called periodically off the request
+    path) writes the rest and fsyncs, so no request waits for the disk.
+    """
+    def __init__(self, directory: str = None, rotate_seconds: float = DEFAULT_ROTATE_SECONDS,
+                 rotate_bytes: int = DEFAULT_ROTATE_BYTES, retain_seconds: float = DEFAULT_RETAIN_SECONDS,
+                 retain_bytes: int = DEFAULT_RETAIN_BYTES):
+        """
+        Args:
+            directory: Directory holding the log files (created on first write); defaults to
+                       the ACCESSPOINTER_POSITION_LOG_DIR environment variable, then
+                       DEFAULT_POSITION_LOG_DIR. Every worker process may share it.
+            rotate_seconds: Maximum age of a file before a new one is started.
+            rotate_bytes: Maximum size of a file before a new one is started.
+            retain_seconds: Files whose fixes are all older than this (relative to the
+                            newest fix written) are deleted at each rotation.
+            retain_bytes: At each rotation, the oldest files are deleted while the
+                          directory holds more than this many bytes.
+        """
+        self.directory = directory or os.environ.get("ACCESSPOINTER_POSITION_LOG_DIR", DEFAULT_POSITION_LOG_DIR)
+        self.rotate_seconds = rotate_seconds
+        self.rotate_bytes = rotate_bytes
+        self.retain_seconds = retain_seconds
+        self.retain_bytes = retain_bytes
+        # Current file (opened lazily), its start time and bytes written to it so far.
+        self.file = None
+        self.file_start = None
+        self.file_bytes = 0
+        # Records packed but not yet handed to the OS.
+        self.buffer = bytearray()
+        # Lock protecting all of the above.
+        self.lock = threading.Lock()
+
+    def append(self, session_id: str, latitude: float, longitude: float, timestamp: float = None):
+        """Appends one fix to the log. Fixes are stamped with the current time by default."""
+        key = session_hash(session_id)
+        with self.lock:
+            # Stamped under the lock, so each file is in timestamp order.
+            timestamp = time.time() if timestamp is None else timestamp
+            self.buffer += RECORD_FORMAT.pack(key, timestamp, latitude, longitude)
+            if len(self.buffer) >= WRITE_BUFFER_RECORDS * RECORD_SIZE:
+                self._write_buffer()
+
+    def flush(self, sync: bool = True):
+        """Writes buffered fixes to the OS and, with sync, forces the current file to disk."""
+        with self.lock:
+            self._write_buffer()
+            if sync and self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        """Flushes and closes the current file."""
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    # --- Internal helpers (caller holds self.lock) ---
+
+    def _write_buffer(self):
+        """Hands buffered records to the OS, rotating the file first if it is due."""
+        if not self.buffer:
+            return
+        # The oldest buffered fix; a new file is named after it.
+        first_timestamp = RECORD_FORMAT.unpack_from(self.buffer)[1]
+        if (self.file is None or first_timestamp - self.file_start >= self.rotate_seconds
+                or self.file_bytes >= self.rotate_bytes):
+            self._rotate(first_timestamp)
+        self.file.write(self.buffer)
+        self.file_bytes += len(self.buffer)
+        self.buffer = bytearray()
+
+    def _rotate(self, start: float):
+        """Closes the current file (if any) and starts a new one whose first fix is stamped `start`."""
+        if self.file is not None:
+            self.file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        # Rounded down, so the name never claims a later start than the first fix.
+        name = f"{FILE_PREFIX}{math.floor(start * 1000)}-{os.getpid()}{FILE_SUFFIX}"
+        # Unbuffered: this class already batches records into large writes.
+        self.file = open(os.path.join(self.directory, name), "ab", buffering=0)
+        self.file_start = start
+        self.file_bytes = 0
+        self._apply_retention(start)
+
+    def _apply_retention(self, now: float):
+        """
+        Deletes the files past the retention age, then the oldest files while the
+        directory is over its size budget. Files another writer may still be appending
+        to (its newest file, within rotate_seconds of its start) are kept, as is this
+        writer's current file.
+        """
+        paths = log_files(self.directory)
+        ends = _file_ends(paths)
+        sizes = {}
+        for path in paths:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except FileNotFoundError:
+                # Already deleted by another writer.
+                sizes[path] = 0
+        total_bytes = sum(sizes.values())
+        for path in paths:
+            # A writer rotates at the latest rotate_seconds after a file's start.
+            end = min(ends[path], log_file_start(path) + self.rotate_seconds)
+            if path == self.file.name or (ends[path] == math.inf and end > now):
+                continue
+            if end > now - self.retain_seconds and total_bytes <= self.retain_bytes:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= sizes[path]
+
+
+class PositionLogReader:
+    """
+    Memory-mapped, read-only view of one log file as a NumPy record array with the
+    fields 'session', 'timestamp', 'latitude' and 'longitude'. A partial record left
+    by a crash at the end of the file is ignored. Use as a context manager, or call
+    close() once the arrays it returned are no longer needed.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        count = size // RECORD_SIZE
+        if count:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.records = np.frombuffer(self._map, dtype=RECORD_DTYPE, count=count)
+        else:
+            # Empty files cannot be mapped.
+            self._map = None
+            self.records = np.empty(0, dtype=RECORD_DTYPE)
+        # Fixes are appended in (almost) time order; slices binary-search when they are sorted.
+        timestamps = self.records["timestamp"]
+        self.sorted = bool(np.all(timestamps[1:] >= timestamps[:-1]))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def time_slice(self, since: float = None, until: float = None, session_id: str = None) -> np.ndarray:
+        """
+        Returns the records with since <= timestamp < until (either bound optional),
+        optionally only those of one session. Sorted files are sliced by binary search.
+        """
+        records = self.records
+        if since is not None or until is not None:
+            timestamps = records["timestamp"]
+            if self.sorted:
+                start = 0 if since is None else np.searchsorted(timestamps, since, side="left")
+                end = len(records) if until is None else np.searchsorted(timestamps, until, side="left")
+                records = records[start:end]
+            else:
+                mask = np.ones(len(records), dtype=bool)
+                if since is not None:
+                    mask &= timestamps >= since
+                if until is not None:
+                    mask &= timestamps < until
+                records = records[mask]
+        if session_id is not None:
+            records = records[records["session"] == session_hash(session_id)]
+        return records
+
+    def close(self):
+        """Releases the mapping, or leaves it to the last array still viewing it."""
+        self.records = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Arrays returned by time_slice() still view the mapping; it is
+                # unmapped once they are garbage collected.
+                pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def log_files(directory: str = DEFAULT_POSITION_LOG_DIR) -> list[str]:
+    """Returns the paths of all log files in a directory, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if name.startswith(FILE_PREFIX) and name.endswith(FILE_SUFFIX)]
+    return [os.path.join(directory, name) for name in sorted(names, key=lambda name: log_file_start(name))]
+
+
+def _file_ends(paths: list[str]) -> dict:
+    """
+    Returns {path: end of its time range} for log files sorted oldest first: a file holds
+    fixes from its start time up to the start of the same writer's next file (infinity
+    for a writer's newest file).
+    """
+    ends = {}
+    next_start_by_pid = {}
+    for path in reversed(paths):
+        start, pid = _parse_log_file_name(path)
+        ends[path] = next_start_by_pid.get(pid, math.inf)
+        next_start_by_pid[pid] = start
+    return ends
+
+
+def replay(directory: str = DEFAULT_POSITION_LOG_DIR, since: float = None, until: float = None,
+           session_id: str = None, limit: int = None) -> np.ndarray:
+    """
+    Returns the logged fixes across all files (and processes) with since <= timestamp < until,
+    optionally for one session, as one record array sorted by timestamp; with limit, only
+    the oldest `limit` of them.
+    A file holds fixes from its start time up to the start of the same process's next
+    file, so files entirely outside the range are not opened, and with a limit the scan
+    stops at the first file starting after the limit-th fix found so far.
+    """
+    paths = log_files(directory)
+    ends = _file_ends(paths)
+
+    # Fixes collected so far; with a limit, merged into the oldest `limit` after each file.
+    parts = [np.empty(0, dtype=RECORD_DTYPE)]
+    for path in paths:
+        start = log_file_start(path)
+        if (until is not None and start >= until) or (since is not None and ends[path] <= since):
+            continue
+        if limit is not None and len(parts[0]) >= limit and start > parts[0]["timestamp"][-1]:
+            # Files are in start order, so no later file holds an older fix.
+            break
+        with PositionLogReader(path) as reader:
+            part = reader.time_slice(since, until, session_id)
+            if limit is not None:
+                if not reader.sorted:
+                    part = part[np.argsort(part["timestamp"], kind="stable")]
+                part = part[:limit]
+            # Copy out of the mapping so it can be released.
+            parts.append(part.copy())
+        if limit is not None:
+            parts = [_sorted_by_time(np.concatenate(parts))[:limit]]
+    return _sorted_by_time(np.concatenate(parts))
+
+
+def _sorted_by_time(records: np.ndarray) -> np.ndarray:
+    """Returns records sorted by timestamp (stable, so equal timestamps keep file order)."""
+    return records[np.argsort(records["timestamp"], kind="stable")]
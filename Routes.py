@@ -3,12 +3,24 @@
 # data submission (location, speed test), heatmap data retrieval, and live location tracking.
 # Also includes coordinate mapping logic and session management.
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 import uuid # Used for generating session IDs (though frontend uses crypto.randomUUID).
 import random # Used for generating unique test IDs.
 from DatabaseHandler import DatabaseHandler # Interface for database operations.
-import threading # Used for locks to protect shared data structures.
+from HeatmapAggregate import HeatmapAggregate # In-memory heatmap served by /heatmap-data.
+from HeatmapRaster import HeatmapRenderer # Server-side PNG rendering of the heatmap.
+from HeatmapPyramid import HeatmapPyramid, level_for_cell_size # Grid-binned heatmap levels.
+from OccupancyGrid import OccupancyGrid # Live device counts per floor plan cell.
+from TransferStats import download_ledger, upload_ledger # Server-measured transfer statistics per test run.
+from PositionLog import PositionLogWriter, replay as replay_position_log # Binary log of live location fixes.
+from SessionStore import create_session_store # Session backend for live locations and test IDs.
+from LocationUpdatePolicy import MOVEMENT_THRESHOLD_METERS, RateMeter, suggest_update_interval_ms # Live update coalescing/backoff.
+import math # Used to validate spatial query parameters.
+import os # Used for ETag nonces.
 import time # Used for timestamps and session timeout checks.
+import json # Used to serialize Server-Sent Events payloads.
+from datetime import datetime, timedelta, timezone # Used for heatmap time windows.
+import numpy as np # Used for vectorized batch coordinate mapping.
 
 # --- Coordinate Mapping Configuration ---
 # Dimensions of the floor plan image used for mapping (in pixels).
@@ -95,8 +107,184 @@ def map_lat_lon_to_pixels(latitude: float, longitude: float) -> tuple[int | None
         print(f"DEBUG: Error converting lat/lon ({latitude}, {longitude}) to float: {e}")
         return None, None, False # Indicate mapping failure.
 
+# Pixel value reported by map_lat_lon_to_pixels_batch for points that could not be mapped
+# (the batch equivalent of the scalar function returning None).
+UNMAPPED_PIXEL = -1
+
+def _coordinates_to_float_array(values) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Converts a sequence/buffer of coordinates to a float64 array.
+    Returns (floats, valid) where valid is False for entries that float() would reject
+    (e.g. None or non-numeric strings); those entries are set to 0.0.
+    """
+    array = np.asarray(values)
+    # Numeric buffers convert directly, exactly like float() on each element.
+    if array.dtype.kind in "fiub":
+        return array.astype(np.float64, copy=False).ravel(), np.ones(array.size, dtype=bool)
+    # Mixed/object/string input: convert element by element with the scalar rules.
+    floats = np.zeros(array.size, dtype=np.float64)
+    valid = np.ones(array.size, dtype=bool)
+    for i, value in enumerate(array.ravel()):
+        try:
+            floats[i] = float(value)
+        except (ValueError, TypeError):
+            valid[i] = False
+    return floats, valid
+
+def map_lat_lon_to_pixels_batch(latitudes, longitudes) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Vectorized version of map_lat_lon_to_pixels for many points at once.
+    Gives the same results as calling the scalar function on each (lat, lon) pair.
+
+    Args:
+        latitudes: Sequence, NumPy array or buffer of latitudes.
+        longitudes: Sequence, NumPy array or buffer of longitudes (same length).
+
+    Returns:
+        A tuple of three arrays with one entry per point:
+        - x (int64): Clamped x pixel coordinates, UNMAPPED_PIXEL where mapping failed.
+        - y (int64): Clamped y pixel coordinates, UNMAPPED_PIXEL where mapping failed.
+        - in_bounds (bool): True where the original point was inside the MIN/MAX bounds.
+    """
+    lat, lat_valid = _coordinates_to_float_array(latitudes)
+    lon, lon_valid = _coordinates_to_float_array(longitudes)
+    if lat.shape != lon.shape:
+        raise ValueError("latitudes and longitudes must have the same length")
+    valid = lat_valid & lon_valid
+    epsilon = 1e-9
+
+    # Same failure as the scalar function when the bounds are degenerate.
+    if abs(MAX_LAT - MIN_LAT) < epsilon or abs(MAX_LON - MIN_LON) < epsilon:
+        unmapped = np.full(lat.shape, UNMAPPED_PIXEL, dtype=np.int64)
+        return unmapped, unmapped.copy(), np.zeros(lat.shape, dtype=bool)
+
+    is_within_bounds = (
+        (MIN_LAT - epsilon <= lat) & (lat <= MAX_LAT + epsilon) &
+        (MIN_LON - epsilon <= lon) & (lon <= MAX_LON + epsilon) &
+        valid
+    )
+
+    # Same mapping formulas as map_lat_lon_to_pixels (inf/NaN results are clamped below).
+    with np.errstate(over="ignore", invalid="ignore"):
+        x_pixel_float = ((MAX_LAT - lat) / (MAX_LAT - MIN_LAT)) * IMAGE_WIDTH
+        y_pixel_float = ((MAX_LON - lon) / (MAX_LON - MIN_LON)) * IMAGE_HEIGHT
+
+    # Clamp exactly like max(0.0, min(value, limit)), including its NaN handling
+    # (min keeps NaN, max then returns 0.0), which np.clip would not reproduce.
+    def clamp(values: np.ndarray, limit: float) -> np.ndarray:
+        upper = np.where(limit < values, limit, values)
+        return np.where(upper > 0.0, upper, 0.0)
+
+    x_pixel = clamp(x_pixel_float, float(IMAGE_WIDTH - 1)).astype(np.int64)
+    y_pixel = clamp(y_pixel_float, float(IMAGE_HEIGHT - 1)).astype(np.int64)
+    x_pixel[~valid] = UNMAPPED_PIXEL
+    y_pixel[~valid] = UNMAPPED_PIXEL
+    return x_pixel, y_pixel, is_within_bounds
+
+def map_pixels_to_lat_lon(x_pixel: float, y_pixel: float) -> tuple[float, float]:
+    """
+    Inverse of the (unclamped) map_lat_lon_to_pixels formulas: returns the
+    (latitude, longitude) at a pixel position on the floor plan image.
+    """
+    latitude = MAX_LAT - (x_pixel / IMAGE_WIDTH) * (MAX_LAT - MIN_LAT)
+    longitude = MAX_LON - (y_pixel / IMAGE_HEIGHT) * (MAX_LON - MIN_LON)
+    return latitude, longitude
+
 # --- End Coordinate Mapping Section ---
 
+# --- Live Location Streaming Configuration ---
+# Seconds between keep-alive comments on idle live location streams. Also bounds how
+# long a stream thread waits before noticing that its client has disconnected.
+SSE_KEEPALIVE_SECONDS = 15
+# Reconnect delay (milliseconds) suggested to EventSource clients, matching the old poll interval.
+SSE_RETRY_MILLISECONDS = 2000
+
+# Maximum number of session IDs accepted by one /live-locations request.
+MAX_BATCH_SESSION_IDS = 1000
+# Default and maximum number of fixes returned by one /replay request.
+MAX_REPLAY_POINTS = 50000
+
+# --- Time Window Parsing ---
+
+def parse_timestamp(value: str) -> datetime:
+    """
+    Parses a query-string timestamp into an aware UTC datetime.
+    Accepts Unix seconds (e.g. "1739836800") or ISO 8601 (e.g. "2025-02-18T00:00:00Z");
+    ISO values without a timezone are taken as UTC.
+    Raises ValueError if the value cannot be parsed.
+    """
+    try:
+        return datetime.fromtimestamp(float(value), tz=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        pass
+    # Python 3.10 fromisoformat() does not accept a trailing 'Z'.
+    parsed = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+def parse_epoch_seconds(value: str) -> float:
+    """
+    Parses a query-string timestamp into Unix seconds.
+    Numeric values are returned as is, at full float precision (datetimes only keep
+    microseconds), so a client can page with a timestamp it was sent; ISO 8601
+    values go through parse_timestamp().
+    Raises ValueError if the value cannot be parsed or is not finite.
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        return parse_timestamp(value).timestamp()
+    if not math.isfinite(seconds):
+        raise ValueError(f"timestamp must be finite, got '{value}'")
+    return seconds
+
+def parse_time_window(args) -> tuple[datetime | None, datetime | None]:
+    """
+    Reads the optional 'since', 'until' and 'hours' query parameters.
+    'hours' selects the last N hours and cannot be combined with 'since'.
+    Returns (since, until); either may be None. Raises ValueError on invalid input.
+    """
+    since_str = args.get("since")
+    until_str = args.get("until")
+    hours_str = args.get("hours")
+    if hours_str is not None and since_str is not None:
+        raise ValueError("use either 'since' or 'hours', not both")
+    since = parse_timestamp(since_str) if since_str is not None else None
+    until = parse_timestamp(until_str) if until_str is not None else None
+    if hours_str is not None:
+        hours = float(hours_str)
+        # Comparisons with NaN are False, so this also rejects 'nan'.
+        if not (0 < hours < math.inf):
+            raise ValueError("hours must be a positive finite number")
+        try:
+            since = datetime.now(timezone.utc) - timedelta(hours=hours)
+        # Windows reaching back past year 1 cannot be represented.
+        except OverflowError:
+            raise ValueError("hours is too large") from None
+    if since is not None and until is not None and since >= until:
+        raise ValueError("'since' must be earlier than 'until'")
+    return since, until
+
+def parse_time_window_seconds(args) -> tuple[float | None, float | None]:
+    """
+    Reads 'since', 'until' and 'hours' like parse_time_window(), but returns Unix
+    seconds, with 'since'/'until' parsed by parse_epoch_seconds() so numeric bounds
+    are exact. Raises ValueError on invalid input.
+    """
+    since, until = parse_time_window(args)
+    if args.get("since") is not None:
+        since = parse_epoch_seconds(args["since"])
+    elif since is not None:
+        since = since.timestamp()
+    if until is not None:
+        until = parse_epoch_seconds(args["until"])
+    if since is not None and until is not None and since >= until:
+        raise ValueError("'since' must be earlier than 'until'")
+    return since, until
+
+# --- End Time Window Parsing ---
+
 
 class Routes:
     """
@@ -112,14 +300,29 @@ class Routes:
         self.app = app
         # Instantiate the database handler for database interactions.
         self.db_handler = DatabaseHandler()
-        # Dictionary to map session IDs (from frontend) to unique test IDs generated per test run.
-        self.session_ids_to_generated_ids = {}
-        # Lock to protect access to session_ids_to_generated_ids dictionary from concurrent requests.
-        self.id_lock = threading.Lock()
-        # Dictionary to store live user session data: {session_id: (latitude, longitude, timestamp)}.
-        self.user_sessions = {}
-        # Lock to protect access to user_sessions dictionary from concurrent requests/threads.
-        self.session_lock = threading.Lock()
+        # In-memory heatmap, built once here and updated as location/speed pairs complete.
+        self.heatmap = HeatmapAggregate(map_lat_lon_to_pixels, map_lat_lon_to_pixels_batch)
+        self.rebuild_heatmap()
+        # Random prefix keeping this instance's heatmap ETags apart from any other's.
+        self.etag_nonce = os.urandom(4).hex()
+        # PNG renderer for the same heatmap, cached until the aggregate changes.
+        self.heatmap_renderer = HeatmapRenderer(self.heatmap, IMAGE_WIDTH, IMAGE_HEIGHT)
+        # Multi-resolution binned aggregates for /heatmap-data?level=... queries.
+        self.heatmap_pyramid = HeatmapPyramid(self.heatmap, IMAGE_WIDTH, IMAGE_HEIGHT)
+        # Per-session state: live location (latitude, longitude, timestamp) and the
+        # unique test ID generated for the current test run. Internally locked.
+        # The backend (in-memory or shared SQLite) comes from ACCESSPOINTER_SESSION_BACKEND;
+        # proximity queries are measured from the floor plan center.
+        self.sessions = create_session_store((MIN_LAT + MAX_LAT) / 2, (MIN_LON + MAX_LON) / 2)
+        # Live occupancy counts for /occupancy-data, kept current by the session store
+        # as sessions move, are removed or expire.
+        self.occupancy = OccupancyGrid(map_lat_lon_to_pixels, IMAGE_WIDTH, IMAGE_HEIGHT)
+        self.sessions.add_position_index(self.occupancy)
+        # Rate of /save_user_location requests, used to slow clients down under load.
+        self.location_update_rate = RateMeter()
+        # Append-only log of every accepted fix, for /replay after the fact.
+        # Flushed to disk by the background cleanup loop, never per request.
+        self.position_log = PositionLogWriter()
         # Call the method to define and register Flask routes.
         self.setup_routes()
 
@@ -155,13 +358,11 @@ class Routes:
             if not session_id:
                 return jsonify({"error": "Missing session_id parameter"}), 400
 
-            # Acquire lock before accessing shared dictionary.
-            with self.id_lock:
-                # Generate a new unique test ID.
-                new_id = self._generate_unique_test_id()
-                # Store the mapping (overwrites if session_id already exists).
-                # Consider alternative logic if overwriting is not desired.
-                self.session_ids_to_generated_ids[session_id] = new_id
+            # Generate a new unique test ID.
+            new_id = self._generate_unique_test_id()
+            # Store the mapping (overwrites if session_id already exists).
+            # Consider alternative logic if overwriting is not desired.
+            self.sessions.set_test_id(session_id, new_id)
             # Return the newly generated ID.
             return jsonify({"id": new_id}), 200
 
@@ -200,7 +401,9 @@ class Routes:
                 lon_float = float(longitude)
                 unique_id_int = int(unique_test_id)
                 # Call database handler to save the location.
-                self.db_handler.save_location(lat_float, lon_float, unique_id_int)
+                if self.db_handler.save_location(lat_float, lon_float, unique_id_int):
+                    # Fold the saved location into the in-memory heatmap.
+                    self.heatmap.add_location(unique_id_int, lat_float, lon_float)
                 # Return success response.
                 return jsonify({"message": "Location saved successfully!", "id": unique_id_int}), 200
             # Handle errors during data conversion.
@@ -217,7 +420,12 @@ class Routes:
             POST /save_user_location
             Receives and updates the latest known location for a specific user session (live tracking).
             Expects JSON payload: {"latitude": float, "longitude": float, "session_id": str}
-            Stores this data in the in-memory `user_sessions` dictionary.
+            plus optionally "accuracy": float (the fix's reported accuracy in meters).
+            Stores this data in the session store, which smooths the fixes of each session
+            with a Kalman filter (noisier fixes count for less). Smoothed positions within
+            MOVEMENT_THRESHOLD_METERS of the stored one only refresh the session's timestamp.
+            Returns JSON: {"status": str, "session_id": str, "moved": bool, "next_update_ms": int},
+            where next_update_ms is the suggested delay before the client's next update.
             """
             # Get JSON data, handle potential non-JSON request gracefully.
             data = request.get_json(silent=True)
@@ -237,17 +445,27 @@ class Routes:
                     # Convert coordinates to float.
                     lat_float = float(latitude)
                     lon_float = float(longitude)
-                    # Get current time for timestamp.
-                    current_time = time.time()
-                    # Acquire lock before modifying shared session dictionary.
-                    with self.session_lock:
-                        # Update or add the session entry with new location and timestamp.
-                        self.user_sessions[session_id] = (lat_float, lon_float, current_time)
+                    accuracy = data.get("accuracy")
+                    accuracy_float = float(accuracy) if accuracy is not None else None
+                    # Update or add the session entry, coalescing sub-threshold movement.
+                    moved, stationary_updates = self.sessions.record_fix(
+                        session_id, lat_float, lon_float, MOVEMENT_THRESHOLD_METERS, accuracy=accuracy_float
+                    )
+                    # Log the fix as reported, coalesced or not, so walks can be replayed exactly.
+                    self.position_log.append(session_id, lat_float, lon_float)
+                    self.location_update_rate.record()
+                    # Stationary devices and a busy server both stretch the next interval.
+                    next_update_ms = suggest_update_interval_ms(stationary_updates, self.location_update_rate.rate())
                     # Return success response.
-                    return jsonify({"status": "User location updated", "session_id": session_id}), 200
+                    return jsonify({
+                        "status": "User location updated",
+                        "session_id": session_id,
+                        "moved": moved,
+                        "next_update_ms": next_update_ms
+                    }), 200
                 # Handle errors during float conversion.
                 except (TypeError, ValueError):
-                    return jsonify({"error": "Invalid latitude/longitude format"}), 400
+                    return jsonify({"error": "Invalid latitude/longitude/accuracy format"}), 400
             else:
                 # Identify and report missing fields.
                 missing_fields = [f for f in ['latitude', 'longitude', 'session_id'] if data.get(f) is None]
@@ -261,6 +479,10 @@ class Routes:
             Expects JSON payload containing speed metrics and 'session_id'.
             Retrieves the corresponding unique test ID using the session_id and saves
             the speed results linked to that test ID in the database.
+            The response's 'server_download_mbps' and 'server_upload_mbps' are the rates the
+            server itself measured for the test run on /backend/garbage and /backend/empty
+            (None if it saw no such transfer). They are tracked per worker process, so
+            behind several workers they are None when the transfers went to another one.
             """
             # Get JSON data from the request.
             data = request.json
@@ -292,9 +514,7 @@ class Routes:
                 # Optional: return jsonify({"error": "Invalid speed value format."}), 400
 
             # Retrieve the unique test ID associated with this session ID.
-            # Acquire lock for thread safety.
-            with self.id_lock:
-                current_test_id = self.session_ids_to_generated_ids.get(session_id)
+            current_test_id = self.sessions.get_test_id(session_id)
 
             # Check if a test ID was found for this session (i.e., /generate_unique_id was called).
             if current_test_id is None:
@@ -303,9 +523,19 @@ class Routes:
             # Attempt to save speed test results to the database.
             try:
                 # Call database handler with extracted values and the test ID.
-                self.db_handler.save_speed_test(dl_speed, ul_speed, ping_time, current_test_id)
+                if self.db_handler.save_speed_test(dl_speed, ul_speed, ping_time, current_test_id):
+                    # Fold the saved result into the in-memory heatmap.
+                    self.heatmap.add_speed_test(current_test_id, dl_speed)
+                # Cross-check the client's speeds against what the server actually moved.
+                server_download_mbps = self._server_measured_mbps(download_ledger, current_test_id, "Download", dl_speed)
+                server_upload_mbps = self._server_measured_mbps(upload_ledger, current_test_id, "Upload", ul_speed)
                 # Return success response.
-                return jsonify({"message": "Speed test results saved!", "id": current_test_id}), 200
+                return jsonify({
+                    "message": "Speed test results saved!",
+                    "id": current_test_id,
+                    "server_download_mbps": server_download_mbps,
+                    "server_upload_mbps": server_upload_mbps
+                }), 200
             # Handle potential database errors.
             except Exception as e:
                 print(f"DB save speed error for ID {current_test_id}: {e}")
@@ -314,106 +544,361 @@ class Routes:
         @self.app.route("/heatmap-data", methods=["GET"])
         def get_heatmap_data():
             """
-            GET /heatmap-data
-            Retrieves all combined location and speed test data from the database.
-            Maps latitude/longitude to pixel coordinates for each data point.
+            GET /heatmap-data[?level=<int> | ?cell_size=<int>][&since=<ts>][&until=<ts>][&hours=<n>]
+            Returns all combined location and speed test data mapped to pixel coordinates.
+            Served from the in-memory heatmap aggregate, so the cost does not depend on
+            the size of the database tables.
+            Responses carry an ETag derived from the data version; a request whose
+            If-None-Match matches it gets 304 Not Modified with no body.
             Returns JSON suitable for the heatmap.js library: {"max": float, "data": list[dict]}
             where 'max' is the maximum download speed and 'data' is a list of
             points { "x": int, "y": int, "value": float (download speed) }.
+            With 'level' (cells of 2**level pixels) or 'cell_size' (pixels, rounded up to
+            a power of two), returns one point per occupied grid cell instead, with
+            'value' the mean download speed and 'count', 'min', 'max' per cell.
+            With 'since'/'until' (Unix seconds or ISO 8601) or 'hours' (last N hours),
+            only speed tests saved inside the window are included. The window is
+            answered by an indexed range query, and such responses are not cached.
             """
+            # Parse the optional resolution parameters.
+            level = request.args.get("level")
+            cell_size = request.args.get("cell_size")
             try:
-                # Fetch combined data from the database handler.
-                combined_data = self.db_handler.get_data()
-                heatmap_points = []
-                max_speed = 0.0 # Use float for max speed calculation.
-                points_processed = 0
-                points_mapped = 0
-
-                # Iterate through each test entry in the combined data.
-                for unique_id, info in combined_data.items():
-                    points_processed += 1
-                    # Safely extract download speed, default to 0.0 if missing or invalid.
-                    speed = 0.0
-                    try:
-                        dl_value = info.get('download')
-                        # Ensure value exists and is not None before converting.
-                        if dl_value is not None:
-                            speed = float(dl_value)
-                    except (ValueError, TypeError):
-                        # Log warning if conversion fails, use default.
-                        print(f"Warning: Could not convert download speed '{info.get('download')}' for ID {unique_id} to float. Using 0.")
-                        speed = 0.0
-
-                    # Check if location data exists for this entry.
-                    if info.get('location'):
-                        lat = info['location'].get('latitude')
-                        lon = info['location'].get('longitude')
-                        # Map geographic coordinates to pixel coordinates.
-                        x_pixel, y_pixel, _ = map_lat_lon_to_pixels(lat, lon)
-                        # If mapping was successful, add point to heatmap data.
-                        if x_pixel is not None and y_pixel is not None:
-                            points_mapped += 1
-                            heatmap_points.append({"x": x_pixel, "y": y_pixel, "value": speed})
-                            # Update maximum speed found so far.
-                            if speed > max_speed:
-                                max_speed = speed
-
-                # Determine the 'max' value to send to heatmap.js.
-                # Ensure max is at least 1.0 if points exist but max speed is 0 or less.
-                # Default to 1.0 if no points were mapped.
-                if points_mapped > 0 and max_speed <= 0:
-                    max_value_for_heatmap = 1.0
-                elif points_mapped == 0:
-                    max_value_for_heatmap = 1.0
-                else:
-                    max_value_for_heatmap = max_speed
+                if level is not None:
+                    level = int(level)
+                elif cell_size is not None:
+                    cell_size = int(cell_size)
+                    if cell_size < 1:
+                        raise ValueError("cell_size must be at least 1")
+                    level = level_for_cell_size(cell_size, self.heatmap_pyramid.num_levels)
+                if level is not None and not 0 <= level < self.heatmap_pyramid.num_levels:
+                    raise ValueError(f"level must be between 0 and {self.heatmap_pyramid.num_levels - 1}")
+            # Handle non-integer or out-of-range parameters.
+            except ValueError as e:
+                return jsonify({"error": f"Invalid level/cell_size parameter: {e}"}), 400
+
+            # Parse the optional time window.
+            try:
+                since, until = parse_time_window(request.args)
+            except ValueError as e:
+                return jsonify({"error": f"Invalid since/until/hours parameter: {e}"}), 400
 
-                # Return the heatmap data in the expected format.
-                return jsonify({"max": max_value_for_heatmap, "data": heatmap_points}), 200
-            # Handle potential errors during data fetching or processing.
+            # Time-windowed request: aggregate only the rows inside the window.
+            if since is not None or until is not None:
+                try:
+                    window = HeatmapAggregate(map_lat_lon_to_pixels, map_lat_lon_to_pixels_batch)
+                    window.rebuild(self.db_handler.iter_data(since=since, until=until))
+                    if level is None:
+                        body = window.payload_json()
+                    else:
+                        body = HeatmapPyramid(window, IMAGE_WIDTH, IMAGE_HEIGHT).payload_json(level)
+                    return Response(body, status=200, mimetype="application/json")
+                # Handle potential database or processing errors.
+                except Exception as e:
+                    print(f"Error generating time-windowed heatmap data: {e}")
+                    return jsonify({"error": "Failed to generate heatmap data"}), 500
+
+            # Answer conditional requests for unchanged data without building a body.
+            etag = self._heatmap_etag()
+            if etag in request.if_none_match:
+                return self._not_modified(etag)
+
+            try:
+                # Return the cached JSON body for raw points or the requested level.
+                if level is None:
+                    body = self.heatmap.payload_json()
+                else:
+                    body = self.heatmap_pyramid.payload_json(level)
+                response = Response(body, status=200, mimetype="application/json")
+                response.set_etag(etag)
+                # Clients may cache the body but must revalidate it with If-None-Match.
+                response.headers["Cache-Control"] = "no-cache"
+                return response
+            # Handle potential errors while serializing the heatmap.
             except Exception as e:
                 print(f"Error generating heatmap data: {e}")
                 return jsonify({"error": "Failed to generate heatmap data"}), 500
 
+        @self.app.route("/heatmap.png", methods=["GET"])
+        def get_heatmap_png():
+            """
+            GET /heatmap.png
+            Returns the speed heatmap rendered on the server as a transparent PNG
+            of IMAGE_WIDTH x IMAGE_HEIGHT pixels, ready to overlay on static/Floor1.png.
+            The image is re-rendered only after new data arrives; otherwise the
+            cached PNG is returned, so the cost does not depend on the number of points.
+            """
+            # Answer conditional requests for unchanged data without rendering.
+            etag = self._heatmap_etag()
+            if etag in request.if_none_match:
+                return self._not_modified(etag)
+
+            try:
+                png_bytes = self.heatmap_renderer.png()
+                response = Response(png_bytes, status=200, mimetype="image/png")
+                response.set_etag(etag)
+                # Browsers must revalidate, since the image changes as data arrives.
+                response.headers["Cache-Control"] = "no-cache"
+                return response
+            # Handle potential errors during rendering.
+            except Exception as e:
+                print(f"Error rendering heatmap image: {e}")
+                return jsonify({"error": "Failed to render heatmap image"}), 500
+
+        @self.app.route("/occupancy-data", methods=["GET"])
+        def get_occupancy_data():
+            """
+            GET /occupancy-data
+            Returns how many active sessions are currently in each cell of the floor plan,
+            in heatmap.js format: {"max": int, "cell_size": int, "sessions": int, "data": list[dict]}
+            where 'data' holds one point { "x": int, "y": int, "value": int (sessions) }
+            per occupied cell, at the cell center, and 'sessions' is the number counted.
+            Only live locations inside the floor plan bounds are counted.
+            The counts are maintained incrementally as sessions move or expire, so the
+            cost does not depend on the number of sessions. Responses carry an ETag and
+            honour If-None-Match like /heatmap-data.
+            """
+            try:
+                # Picks up other workers' changes when sessions are shared (no-op in memory).
+                self.sessions.sync_position_indexes()
+                body, etag = self.occupancy.payload_with_etag()
+                if etag in request.if_none_match:
+                    return self._not_modified(etag)
+                response = Response(body, status=200, mimetype="application/json")
+                response.set_etag(etag)
+                response.headers["Cache-Control"] = "no-cache"
+                return response
+            # Handle unexpected errors reading the occupancy grid.
+            except Exception as e:
+                print(f"Error generating occupancy data: {e}")
+                return jsonify({"error": "Failed to generate occupancy data"}), 500
+
         @self.app.route("/get-live-location/<session_id>", methods=["GET"])
         def get_live_location(session_id: str):
             """
-            GET /get-live-location/<session_id>
+            GET /get-live-location/<session_id>[?raw=1]
             Retrieves the latest known location for the given session ID from memory.
-            Maps the location to pixel coordinates.
+            Maps the (smoothed) location to pixel coordinates.
             Returns JSON: {"x": int, "y": int, "in_bounds": bool, "found": bool}
             or {"found": False, "reason": str} if no data or mapping fails.
+            With raw=1, a found payload also carries "raw": {"x": int, "y": int, "in_bounds": bool},
+            the last fix exactly as reported (omitted if it cannot be mapped).
             """
             # Validate session ID parameter.
             if not session_id:
                 return jsonify({"error": "Missing session_id"}), 400
 
-            # Acquire lock to safely access shared session data.
-            with self.session_lock:
-                # Retrieve session data (lat, lon, timestamp) for the given ID.
-                session_data = self.user_sessions.get(session_id)
+            # Retrieve session data (lat, lon, timestamp) for the given ID.
+            session_data = self.sessions.get_location(session_id)
+            payload = self._live_location_payload(session_data)
+            if payload["found"] and request.args.get("raw") == "1":
+                raw_data = self.sessions.get_raw_location(session_id)
+                raw_payload = self._live_location_payload(raw_data)
+                if raw_payload["found"]:
+                    payload["raw"] = {key: raw_payload[key] for key in ("x", "y", "in_bounds")}
+            # Return 200 OK even when not found; the payload's "found" flag says so.
+            return jsonify(payload), 200
 
-            # Check if valid session data was found.
-            if session_data and isinstance(session_data, tuple) and len(session_data) == 3:
-                lat, lon, timestamp = session_data
-                # Map the geographic coordinates to pixel coordinates.
-                x_pixel, y_pixel, is_within_bounds = map_lat_lon_to_pixels(lat, lon)
+        @self.app.route("/live-location-stream/<session_id>", methods=["GET"])
+        def live_location_stream(session_id: str):
+            """
+            GET /live-location-stream/<session_id>
+            Server-Sent Events stream of the session's live location. Sends the current
+            state right away, then one event each time /save_user_location moves the
+            session to a different mapped position. Each event's data is the same JSON
+            as /get-live-location. Idle streams receive periodic keep-alive comments.
+            """
+            # Validate session ID parameter.
+            if not session_id:
+                return jsonify({"error": "Missing session_id"}), 400
 
-                # Check if mapping was successful.
-                if x_pixel is not None and y_pixel is not None:
-                    # Return mapped coordinates and bounds status.
-                    return jsonify({
-                        "x": x_pixel,
-                        "y": y_pixel,
-                        "in_bounds": is_within_bounds,
-                        "found": True
-                    }), 200
-                else:
-                    # Indicate mapping failure.
-                    return jsonify({"found": False, "reason": "Coordinate mapping failed"}), 200 # Return 200 OK, but indicate not found via payload
+            def generate():
+                # Suggest a reconnect delay to EventSource clients.
+                yield f"retry: {SSE_RETRY_MILLISECONDS}\n\n"
+                sequence, last_payload = None, None
+                while True:
+                    # Wait (without polling) until the stored position changes.
+                    new_sequence, session_data = self.sessions.wait_for_location_change(
+                        session_id, sequence, SSE_KEEPALIVE_SECONDS
+                    )
+                    if new_sequence == sequence:
+                        # Timed out: keep the connection (and any proxies) alive.
+                        yield ": keep-alive\n\n"
+                        continue
+                    sequence = new_sequence
+                    payload = self._live_location_payload(session_data)
+                    # Moves within the same pixel do not produce an event.
+                    if payload != last_payload:
+                        last_payload = payload
+                        yield f"data: {json.dumps(payload)}\n\n"
+
+            response = Response(generate(), mimetype="text/event-stream")
+            response.headers["Cache-Control"] = "no-cache"
+            # Ask reverse proxies not to buffer the stream.
+            response.headers["X-Accel-Buffering"] = "no"
+            return response
+
+        @self.app.route("/live-locations", methods=["GET", "POST"])
+        def live_locations():
+            """
+            GET  /live-locations[?session_id=<id>&session_id=<id>...][&since=<time>]
+            POST /live-locations  {"session_ids": [str, ...], "since": <time>}  (both optional)
+            Returns the mapped live locations of many sessions in one response.
+            Without session IDs every session with a location is returned. With 'since'
+            (Unix seconds or ISO 8601) only sessions updated after that time are included;
+            clients can pass back the returned "server_time" to receive only changes.
+            Returns JSON: {"server_time": float, "sessions": {session_id: {"x": int, "y": int,
+            "in_bounds": bool, "found": True, "last_seen": float} or {"found": False, "reason": str}}}
+            """
+            # Read parameters from the JSON body (POST) or the query string (GET).
+            if request.method == "POST":
+                data = request.get_json(silent=True)
+                if not isinstance(data, dict):
+                    return jsonify({"error": "Invalid or empty JSON payload"}), 400
+                session_ids = data.get("session_ids")
+                since_value = data.get("since")
             else:
-                # Indicate no recent data found for the session.
-                return jsonify({"found": False, "reason": "No recent data for session"}), 200 # Return 200 OK, indicate not found
+                session_ids = request.args.getlist("session_id") or None
+                since_value = request.args.get("since")
+
+            # Validate the requested session IDs.
+            if session_ids is not None:
+                if not isinstance(session_ids, list) or not all(isinstance(sid, str) and sid for sid in session_ids):
+                    return jsonify({"error": "session_ids must be a list of non-empty strings"}), 400
+                if len(session_ids) > MAX_BATCH_SESSION_IDS:
+                    return jsonify({"error": f"At most {MAX_BATCH_SESSION_IDS} session IDs per request"}), 400
+            # Parse the optional 'since' timestamp.
+            try:
+                since = parse_epoch_seconds(str(since_value)) if since_value is not None else None
+            except ValueError:
+                return jsonify({"error": "Invalid 'since' timestamp"}), 400
+
+            # Read the clock before the snapshot so the next 'since' cannot skip an update.
+            server_time = time.time()
+            snapshot = self.sessions.locations(session_ids, since)
+            return jsonify({"server_time": server_time, "sessions": self._live_location_payloads(snapshot)}), 200
+
+        @self.app.route("/trail/<session_id>", methods=["GET"])
+        def get_trail(session_id: str):
+            """
+            GET /trail/<session_id>[?limit=N]
+            Returns the session's most recent distinct positions (up to the store's trail
+            capacity, or the last N with 'limit'), oldest first, mapped to pixels.
+            Returns JSON: {"found": True, "points": [{"x": int, "y": int, "in_bounds": bool,
+            "timestamp": float}, ...]} or {"found": False, "reason": str}.
+            """
+            # Parse the optional limit.
+            limit_str = request.args.get("limit")
+            try:
+                limit = int(limit_str) if limit_str is not None else None
+                if limit is not None and limit < 1:
+                    raise ValueError
+            except ValueError:
+                return jsonify({"error": "limit must be a positive integer"}), 400
+
+            trail = self.sessions.get_trail(session_id, limit)
+            if trail is None:
+                return jsonify({"found": False, "reason": "No recent data for session"}), 200
+
+            # Map the whole trail in one vectorized pass.
+            latitudes, longitudes, timestamps = trail
+            xs, ys, in_bounds = map_lat_lon_to_pixels_batch(latitudes, longitudes)
+            points = [
+                {"x": x_pixel, "y": y_pixel, "in_bounds": is_within_bounds, "timestamp": timestamp}
+                for x_pixel, y_pixel, is_within_bounds, timestamp
+                in zip(xs.tolist(), ys.tolist(), in_bounds.tolist(), timestamps)
+            ]
+            return jsonify({"found": True, "points": points}), 200
+
+        @self.app.route("/replay/<session_id>", methods=["GET"])
+        def replay_session(session_id: str):
+            """
+            GET /replay/<session_id>[?since=<ts>][&until=<ts>][&hours=<n>][&limit=N]
+            Returns every fix the session reported through /save_user_location (as reported,
+            before smoothing), read back from the binary position log, so it survives restarts.
+            'since'/'until' (Unix seconds or ISO 8601) or 'hours' limit the time range; at most
+            'limit' (default and at most MAX_REPLAY_POINTS) of the oldest matching fixes are returned.
+            Returns JSON: {"points": [{"x": int, "y": int, "in_bounds": bool, "timestamp": float}, ...],
+            "truncated": bool}
+            """
+            try:
+                # Exact bounds, so paging with since=<last timestamp> keeps that fix.
+                since, until = parse_time_window_seconds(request.args)
+                limit = int(request.args.get("limit", MAX_REPLAY_POINTS))
+                if limit < 1:
+                    raise ValueError("limit must be a positive integer")
+                limit = min(limit, MAX_REPLAY_POINTS)
+            except ValueError as e:
+                return jsonify({"error": f"Invalid replay parameters: {e}"}), 400
+
+            # Make this process's buffered fixes readable (no fsync needed for that).
+            self.position_log.flush(sync=False)
+            # One fix past the limit tells whether the result is truncated.
+            records = replay_position_log(self.position_log.directory, since, until, session_id, limit + 1)
+            truncated = len(records) > limit
+            records = records[:limit]
+            # Map the whole walk in one vectorized pass.
+            xs, ys, in_bounds = map_lat_lon_to_pixels_batch(records["latitude"], records["longitude"])
+            points = [
+                {"x": x_pixel, "y": y_pixel, "in_bounds": is_within_bounds, "timestamp": timestamp}
+                for x_pixel, y_pixel, is_within_bounds, timestamp
+                in zip(xs.tolist(), ys.tolist(), in_bounds.tolist(), records["timestamp"].tolist())
+            ]
+            return jsonify({"points": points, "truncated": truncated}), 200
+
+        @self.app.route("/sessions/nearby", methods=["GET"])
+        def sessions_nearby():
+            """
+            GET /sessions/nearby?latitude=<lat>&longitude=<lon>&radius=<meters>
+            GET /sessions/nearby?x=<px>&y=<px>&radius=<meters>
+            Returns the sessions whose live location is within 'radius' meters of a
+            geographic point or floor plan pixel, nearest first.
+            Returns JSON: {"sessions": [{"session_id": str, "distance_m": float, "x": int,
+            "y": int, "in_bounds": bool}, ...]}
+            """
+            try:
+                radius = float(request.args["radius"])
+                if "x" in request.args or "y" in request.args:
+                    latitude, longitude = map_pixels_to_lat_lon(float(request.args["x"]), float(request.args["y"]))
+                else:
+                    latitude, longitude = float(request.args["latitude"]), float(request.args["longitude"])
+                # The range checks also reject NaN and infinities.
+                if not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and 0 <= radius < math.inf):
+                    raise ValueError
+            except KeyError as e:
+                return jsonify({"error": f"Missing parameter: {e.args[0]}"}), 400
+            except ValueError:
+                return jsonify({"error": "Parameters must be finite numbers, the point a valid latitude/longitude "
+                                         "and radius non-negative"}), 400
+
+            matches = self.sessions.within_radius(latitude, longitude, radius)
+            return jsonify({"sessions": self._spatial_results(matches)}), 200
+
+        @self.app.route("/sessions/in-rect", methods=["GET"])
+        def sessions_in_rect():
+            """
+            GET /sessions/in-rect?x1=<px>&y1=<px>&x2=<px>&y2=<px>
+            Returns the sessions whose live location lies inside the floor plan pixel
+            rectangle spanning pixels x1..x2 and y1..y2 (inclusive, any corner order).
+            Locations outside the mapped area are not clamped into edge pixels here.
+            Returns JSON: {"sessions": [{"session_id": str, "x": int, "y": int, "in_bounds": bool}, ...]}
+            """
+            try:
+                x1, y1, x2, y2 = (float(request.args[name]) for name in ("x1", "y1", "x2", "y2"))
+                if not all(math.isfinite(value) for value in (x1, y1, x2, y2)):
+                    raise ValueError
+            except KeyError as e:
+                return jsonify({"error": f"Missing parameter: {e.args[0]}"}), 400
+            except ValueError:
+                return jsonify({"error": "Parameters must be finite numbers"}), 400
+
+            # A pixel covers [x, x + 1), so the far edge of the last pixel is included.
+            lat_a, lon_a = map_pixels_to_lat_lon(min(x1, x2), min(y1, y2))
+            lat_b, lon_b = map_pixels_to_lat_lon(max(x1, x2) + 1, max(y1, y2) + 1)
+            matches = self.sessions.within_bounds(
+                min(lat_a, lat_b), min(lon_a, lon_b), max(lat_a, lat_b), max(lon_a, lon_b)
+            )
+            return jsonify({"sessions": self._spatial_results(matches)}), 200
 
         @self.app.route("/get_all_sessions", methods=["GET"])
         def get_all_sessions_route():
@@ -422,18 +907,13 @@ class Routes:
             (Primarily for debugging/admin)
             Returns a JSON object listing all currently tracked user sessions and their last seen timestamp.
             """
-            # Acquire lock for safe access to shared session data.
-            with self.session_lock:
-                # Create a dictionary comprehension to format session data.
-                # Filters out potentially malformed entries as a safeguard.
-                active_sessions = {
-                    sid: time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(sdata[2]))
-                    for sid, sdata in self.user_sessions.items()
-                    # Basic validation of session data format.
-                    if isinstance(sdata, tuple) and len(sdata) == 3 and isinstance(sdata[2], (int, float))
-                }
-                # Return the dictionary as JSON.
-                return jsonify(active_sessions), 200
+            # Create a dictionary comprehension to format session data.
+            active_sessions = {
+                sid: time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(sdata[2]))
+                for sid, sdata in self.sessions.locations().items()
+            }
+            # Return the dictionary as JSON.
+            return jsonify(active_sessions), 200
 
         @self.app.route("/get_location/<session_id>", methods=["GET"])
         def get_location_route(session_id: str):
@@ -442,25 +922,115 @@ class Routes:
             (Primarily for debugging/admin)
             Returns the raw latitude, longitude, and last seen timestamp for a specific session ID.
             """
-            # Acquire lock for safe access.
-            with self.session_lock:
-                # Retrieve session data.
-                session_data = self.user_sessions.get(session_id)
-                # Validate session data format.
-                if session_data and isinstance(session_data, tuple) and len(session_data) == 3:
-                    lat, lon, last_seen_ts = session_data
-                    # Format timestamp safely.
-                    try:
-                        last_seen_str = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(last_seen_ts))
-                    except (ValueError, TypeError):
-                        last_seen_str = "Invalid timestamp"
-                    # Return location and timestamp.
-                    return jsonify({"latitude": lat, "longitude": lon, "last_seen": last_seen_str}), 200
-                # Return error if session not found or data is invalid.
-                return jsonify({"error": "Session ID not found or data invalid"}), 404
+            # Retrieve session data.
+            session_data = self.sessions.get_location(session_id)
+            if session_data is not None:
+                lat, lon, last_seen_ts = session_data
+                # Format timestamp safely.
+                try:
+                    last_seen_str = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(last_seen_ts))
+                except (ValueError, TypeError):
+                    last_seen_str = "Invalid timestamp"
+                # Return location and timestamp.
+                return jsonify({"latitude": lat, "longitude": lon, "last_seen": last_seen_str}), 200
+            # Return error if session not found or data is invalid.
+            return jsonify({"error": "Session ID not found or data invalid"}), 404
 
     # --- Helper Methods (accessible by FlaskApp instance) ---
 
+    def _heatmap_etag(self) -> str:
+        """
+        Returns the ETag for heatmap responses: the database data version (advanced by
+        every successful save) combined with the in-memory heatmap version, so a save
+        that is committed but not yet folded into the heatmap cannot pin stale data.
+        The heatmap version is a per-instance counter, so the ETag is prefixed with a
+        random nonce and the process ID: an ETag issued by another worker, or before
+        a restart or fork, never matches.
+        """
+        return f"{self.etag_nonce}-{os.getpid()}-{self.db_handler.data_version}-{self.heatmap.version}"
+
+    def _live_location_payload(self, session_data) -> dict:
+        """
+        Builds the live location JSON body from (lat, lon, timestamp) or None:
+        {"x": int, "y": int, "in_bounds": bool, "found": True}
+        or {"found": False, "reason": str} if no data or mapping fails.
+        """
+        # Indicate no recent data found for the session.
+        if session_data is None:
+            return {"found": False, "reason": "No recent data for session"}
+        lat, lon, timestamp = session_data
+        # Map the geographic coordinates to pixel coordinates.
+        x_pixel, y_pixel, is_within_bounds = map_lat_lon_to_pixels(lat, lon)
+        # Indicate mapping failure.
+        if x_pixel is None or y_pixel is None:
+            return {"found": False, "reason": "Coordinate mapping failed"}
+        # Return mapped coordinates and bounds status.
+        return {"x": x_pixel, "y": y_pixel, "in_bounds": is_within_bounds, "found": True}
+
+    def _live_location_payloads(self, snapshot: dict) -> dict:
+        """
+        Builds live location payloads for {session_id: (lat, lon, timestamp) or None},
+        mapping all locations in one vectorized pass. Payloads match
+        _live_location_payload() plus a "last_seen" Unix timestamp.
+        """
+        located = [(sid, location) for sid, location in snapshot.items() if location is not None]
+        xs, ys, in_bounds = map_lat_lon_to_pixels_batch(
+            [location[0] for _, location in located], [location[1] for _, location in located]
+        )
+        payloads = {sid: {"found": False, "reason": "No recent data for session"}
+                    for sid, location in snapshot.items() if location is None}
+        for (sid, location), x_pixel, y_pixel, is_within_bounds in zip(located, xs.tolist(), ys.tolist(), in_bounds.tolist()):
+            if x_pixel == UNMAPPED_PIXEL or y_pixel == UNMAPPED_PIXEL:
+                payloads[sid] = {"found": False, "reason": "Coordinate mapping failed"}
+            else:
+                payloads[sid] = {"x": x_pixel, "y": y_pixel, "in_bounds": is_within_bounds,
+                                 "found": True, "last_seen": location[2]}
+        return payloads
+
+    def _spatial_results(self, matches: list) -> list[dict]:
+        """
+        Converts spatial index matches [(session_id, lat, lon[, distance_m]), ...] into
+        JSON-ready dicts with pixel positions, mapped in one vectorized pass.
+        """
+        xs, ys, in_bounds = map_lat_lon_to_pixels_batch([m[1] for m in matches], [m[2] for m in matches])
+        results = []
+        for match, x_pixel, y_pixel, is_within_bounds in zip(matches, xs.tolist(), ys.tolist(), in_bounds.tolist()):
+            result = {"session_id": match[0], "x": x_pixel, "y": y_pixel, "in_bounds": is_within_bounds}
+            if len(match) > 3:
+                result["distance_m"] = match[3]
+            results.append(result)
+        return results
+
+    def _server_measured_mbps(self, ledger, test_id: int, direction: str, client_mbps: float) -> float | None:
+        """
+        Returns the server-measured rate of a test run from a TransferLedger (None if it
+        recorded nothing), logging it next to the client's value.
+        """
+        stats = ledger.summary(str(test_id))
+        server_mbps = stats["mbps"] if stats is not None else None
+        if server_mbps is not None:
+            print(f"{direction} for test ID {test_id}: client {client_mbps:.2f} Mbps, server {server_mbps:.2f} Mbps")
+        return server_mbps
+
+    def _not_modified(self, etag: str) -> Response:
+        """Builds an empty 304 Not Modified response carrying the given ETag."""
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    def rebuild_heatmap(self):
+        """
+        Rebuilds the in-memory heatmap from the full contents of the database.
+        Called once at startup; afterwards the aggregate is updated incrementally
+        by /save_location and /submit-speed.
+        """
+        try:
+            self.heatmap.rebuild(self.db_handler.iter_data())
+        # Start with an empty heatmap rather than failing app startup.
+        except Exception as e:
+            print(f"Error building heatmap aggregate: {e}")
+
     def get_user_session_location(self, session_id: str) -> tuple[float | None, float | None]:
         """
         Retrieves the latest latitude and longitude for a given session ID.
@@ -470,23 +1040,20 @@ class Routes:
         Returns:
             A tuple (latitude, longitude), or (None, None) if not found or invalid.
         """
-        # Acquire lock for safe access.
-        with self.session_lock:
-            # Retrieve session data.
-            session_data = self.user_sessions.get(session_id)
-            # Validate data format (tuple of 3 elements).
-            if session_data and isinstance(session_data, tuple) and len(session_data) == 3:
-                # Further validate that lat/lon are likely numeric before returning.
-                try:
-                    lat = float(session_data[0])
-                    lon = float(session_data[1])
-                    return lat, lon
-                except (ValueError, TypeError):
-                    # Log warning if conversion fails.
-                    print(f"Warning: Invalid lat/lon format in session data for {session_id}")
-                    return None, None
-            # Return None if session not found or format is wrong.
-            return None, None
+        # Retrieve session data.
+        session_data = self.sessions.get_location(session_id)
+        if session_data is not None:
+            # Further validate that lat/lon are likely numeric before returning.
+            try:
+                lat = float(session_data[0])
+                lon = float(session_data[1])
+                return lat, lon
+            except (ValueError, TypeError):
+                # Log warning if conversion fails.
+                print(f"Warning: Invalid lat/lon format in session data for {session_id}")
+                return None, None
+        # Return None if session not found.
+        return None, None
 
     def get_all_sessions(self) -> list[str]:
         """
@@ -495,67 +1062,22 @@ class Routes:
         Returns:
             A list of session ID strings.
         """
-        # Acquire lock for safe access.
-        with self.session_lock:
-            # Return a list of keys from the user_sessions dictionary.
-            return list(self.user_sessions.keys())
+        # Return the IDs of sessions that have reported a live location.
+        return self.sessions.session_ids()
 
     def cleanup_inactive_sessions(self, timeout_seconds: int):
         """
-        Removes sessions from `user_sessions` and `session_ids_to_generated_ids`
-        that haven't been updated within the specified timeout period.
+        Removes sessions (live location and generated test ID) that haven't been
+        updated within the specified timeout period.
         Called periodically by the background cleanup thread in FlaskApp.py.
+        The session store keeps sessions in expiry order, so only expired sessions are visited.
         Args:
             timeout_seconds: The maximum inactivity time allowed before cleanup.
         """
-        # Get the current time.
-        current_time = time.time()
-        inactive_session_ids = []
-
-        # --- Identify Inactive/Invalid Sessions ---
-        # Acquire lock to safely read session keys. Operate on a copy to avoid issues
-        # if the dictionary changes during iteration (though less likely with lock).
-        with self.session_lock:
-            all_session_ids = list(self.user_sessions.keys())
-
-        # Iterate through the copied list of session IDs.
-        for session_id in all_session_ids:
-            # Re-acquire lock to safely access the data for the current session ID.
-            with self.session_lock:
-                sdata = self.user_sessions.get(session_id)
-
-            # Check if data exists and matches the expected format (tuple, 3 elements, valid timestamp).
-            if not (sdata and isinstance(sdata, tuple) and len(sdata) == 3 and isinstance(sdata[2], (int, float))):
-                # Mark sessions with invalid format for cleanup.
-                inactive_session_ids.append(session_id)
-                print(f"Marking session {session_id} for cleanup due to invalid format.")
-            # Check if the session has timed out based on its last timestamp.
-            elif (current_time - sdata[2]) > timeout_seconds:
-                # Mark timed-out sessions for cleanup.
-                inactive_session_ids.append(session_id)
-
-        # --- Perform Cleanup ---
-        # Proceed only if there are sessions marked for cleanup.
+        inactive_session_ids = self.sessions.expire(timeout_seconds)
+        # Log only when something was removed.
         if inactive_session_ids:
-            print(f"Cleaning up inactive/invalid sessions: {inactive_session_ids}")
-            # Acquire lock to safely modify the user_sessions dictionary.
-            with self.session_lock:
-                # Remove each inactive session. Use pop with default None for safety.
-                for session_id in inactive_session_ids:
-                    self.user_sessions.pop(session_id, None)
-            # Acquire lock to safely modify the ID mapping dictionary.
-            with self.id_lock:
-                # Remove the corresponding generated ID mapping for cleaned-up sessions.
-                for session_id in inactive_session_ids:
-                    self.session_ids_to_generated_ids.pop(session_id, None)
-
-            # Log remaining sessions after cleanup (acquire lock for consistency).
-            with self.session_lock:
-                remaining_sessions = list(self.user_sessions.keys())
-            print(f"Cleanup complete. Remaining active sessions: {remaining_sessions}")
-        # else:
-            # Optional: Log if no sessions needed cleanup.
-            # print("Cleanup check complete. No inactive sessions found.")
+            print(f"Cleaned up inactive sessions: {inactive_session_ids}. Remaining sessions: {len(self.sessions)}")
 
 
 # --- Factory Function ---
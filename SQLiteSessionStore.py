@@ -0,0 +1,462 @@
+# SQLiteSessionStore.py
+# Session backend shared between processes through one SQLite file.
+# Every worker process opens the same file, so a test ID generated by one
+# worker is visible to /submit-speed on another, and live locations, trails
+# and proximity queries see the sessions of all workers. Change notification
+# for streaming clients is local-first with a short cross-process poll.
+
+import math
+import sqlite3
+import struct
+import threading
+import time
+import weakref
+
+from SessionStore import SessionBackend, DEFAULT_TRAIL_CAPACITY
+from SpatialIndex import LocalProjection
+
+# Connection profile: WAL so readers never block the writer, and a busy timeout
+# so concurrent writers from other processes wait instead of failing.
+SESSION_DB_PRAGMAS = {
+    "busy_timeout": 5000, # Milliseconds to wait for another process's write lock (set first).
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL", # Session state is soft state; fsync at checkpoints is enough.
+}
+# How often wait_for_location_change() re-reads the database for changes made
+# by other processes (changes made by this process wake waiters immediately).
+CHANGE_POLL_INTERVAL_SECONDS = 0.5
+# Maximum number of bound parameters per IN (...) lookup.
+MAX_QUERY_PARAMETERS = 500
+# Binary layout of a PositionFilter state tuple in the filter_state column.
+FILTER_STATE_FORMAT = struct.Struct("<8d")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    latitude REAL,
+    longitude REAL,
+    timestamp REAL,
+    test_id INTEGER,
+    last_active REAL NOT NULL,
+    location_sequence INTEGER NOT NULL DEFAULT 0,
+    trail_count INTEGER NOT NULL DEFAULT 0,
+    stationary_updates INTEGER NOT NULL DEFAULT 0,
+    raw_latitude REAL,
+    raw_longitude REAL,
+    filter_state BLOB
+);
+CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions (last_active);
+CREATE INDEX IF NOT EXISTS sessions_timestamp ON sessions (timestamp);
+CREATE INDEX IF NOT EXISTS sessions_position ON sessions (latitude, longitude);
+CREATE TABLE IF NOT EXISTS trail (
+    session_id TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    timestamp REAL NOT NULL,
+    PRIMARY KEY (session_id, slot)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('location_sequence', 0);
+"""
+# Columns added to the sessions table after its first release, added in place to
+# session files created by older versions: {column: definition}.
+ADDED_SESSION_COLUMNS = {
+    "stationary_updates": "INTEGER NOT NULL DEFAULT 0",
+    "raw_latitude": "REAL",
+    "raw_longitude": "REAL",
+    "filter_state": "BLOB",
+}
+
+
+class SQLiteSessionStore(SessionBackend):
+    """
+    SessionBackend storing sessions in a SQLite file shared by all worker processes.
+    Each thread uses its own connection. Writes run in BEGIN IMMEDIATE transactions,
+    so read-modify-write updates are atomic across processes.
+    Trails are kept as ring buffers of trail_capacity rows per session (fixed size),
+    expiry uses the last_active index (O(expired)), and proximity queries use the
+    (latitude, longitude) index plus an exact distance check.
+    """
+    def __init__(self, path: str, reference_latitude: float, reference_longitude: float,
+                 trail_capacity: int = DEFAULT_TRAIL_CAPACITY, location_filter=None):
+        """
+        Args:
+            path: SQLite file shared by every worker process (created if missing).
+            reference_latitude: Projection origin for distance calculations.
+            reference_longitude: Projection origin for distance calculations.
+            trail_capacity: Number of past positions kept per session.
+            location_filter: Optional PositionFilter smoothing incoming fixes; its
+                             per-session state is stored in the sessions table.
+        """
+        self.path = path
+        self.projection = LocalProjection(reference_latitude, reference_longitude)
+        self.trail_capacity = trail_capacity
+        self.location_filter = location_filter
+        # One connection per thread, held by a _ThreadConnection in thread-local storage:
+        # it is closed when its thread exits, and close() releases the ones still open.
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+        # Wakes this process's waiters as soon as this process writes a change.
+        self.changed = threading.Condition()
+        # Position indexes are local to this process; sync_position_indexes() reloads
+        # them when the shared change counter moved since their last load.
+        self.position_indexes = []
+        self._indexed_sequence = None
+        self._index_lock = threading.Lock()
+        self._create_schema()
+
+    def record_fix(self, session_id: str, latitude: float, longitude: float,
+                   min_distance_meters: float = 0.0, timestamp: float = None,
+                   accuracy: float = None) -> tuple[bool, int]:
+        """Records a location fix and marks the session active (see SessionBackend.record_fix)."""
+        raw_latitude, raw_longitude = latitude, longitude
+        with self._write() as db:
+            # Stamped once the write lock is held, like the in-memory store.
+            timestamp = time.time() if timestamp is None else timestamp
+            row = db.execute(
+                "SELECT latitude, longitude, timestamp, last_active, trail_count, stationary_updates, filter_state "
+                "FROM sessions WHERE session_id = ?",
+                (session_id,)
+            ).fetchone()
+            filter_blob = None
+            if self.location_filter is not None:
+                filter_state = FILTER_STATE_FORMAT.unpack(row[6]) if row is not None and row[6] is not None else None
+                filter_state, latitude, longitude = self.location_filter.step(
+                    filter_state, latitude, longitude, timestamp, accuracy
+                )
+                filter_blob = FILTER_STATE_FORMAT.pack(*filter_state) if filter_state is not None else None
+            previous = tuple(row[:3]) if row is not None and row[2] is not None else None
+            last_active = timestamp if row is None else max(row[3], timestamp)
+            if not self._is_move(previous, latitude, longitude, min_distance_meters):
+                # Coalesced: keep the stored position, only refresh the timestamps and the filter.
+                db.execute(
+                    "UPDATE sessions SET timestamp = ?, last_active = ?, stationary_updates = ?, "
+                    "raw_latitude = ?, raw_longitude = ?, filter_state = ? WHERE session_id = ?",
+                    (timestamp, last_active, row[5] + 1, raw_latitude, raw_longitude, filter_blob, session_id)
+                )
+                return False, row[5] + 1
+
+            sequence = self._next_sequence(db)
+            trail_count = 0 if row is None else row[4]
+            # The trail is a ring buffer: position N overwrites slot N % capacity.
+            db.execute(
+                "INSERT OR REPLACE INTO trail (session_id, slot, position, latitude, longitude, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, trail_count % self.trail_capacity, trail_count, latitude, longitude, timestamp)
+            )
+            db.execute(
+                "INSERT INTO sessions (session_id, latitude, longitude, timestamp, last_active, location_sequence, "
+                "trail_count, raw_latitude, raw_longitude, filter_state) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET latitude = excluded.latitude, longitude = excluded.longitude, "
+                "timestamp = excluded.timestamp, last_active = excluded.last_active, "
+                "location_sequence = excluded.location_sequence, trail_count = excluded.trail_count, "
+                "stationary_updates = 0, raw_latitude = excluded.raw_latitude, "
+                "raw_longitude = excluded.raw_longitude, filter_state = excluded.filter_state",
+                (session_id, latitude, longitude, timestamp, last_active, sequence, trail_count + 1,
+                 raw_latitude, raw_longitude, filter_blob)
+            )
+        self._notify()
+        return True, 0
+
+    def set_test_id(self, session_id: str, test_id: int, timestamp: float = None):
+        """Stores the current test ID for a session (replacing any previous one) and marks it active."""
+        with self._write() as db:
+            timestamp = time.time() if timestamp is None else timestamp
+            db.execute(
+                "INSERT INTO sessions (session_id, test_id, last_active) VALUES (?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET test_id = excluded.test_id, "
+                "last_active = MAX(sessions.last_active, excluded.last_active)",
+                (session_id, test_id, timestamp)
+            )
+
+    def get_location(self, session_id: str) -> tuple[float, float, float] | None:
+        """Returns (latitude, longitude, timestamp) for a session, or None if unknown."""
+        row = self._connection().execute(
+            "SELECT latitude, longitude, timestamp FROM sessions WHERE session_id = ? AND timestamp IS NOT NULL",
+            (session_id,)
+        ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def get_raw_location(self, session_id: str) -> tuple[float, float, float] | None:
+        """Returns the last fix exactly as reported, as (latitude, longitude, timestamp), or None."""
+        row = self._connection().execute(
+            "SELECT raw_latitude, raw_longitude, timestamp FROM sessions WHERE session_id = ? AND timestamp IS NOT NULL",
+            (session_id,)
+        ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def get_test_id(self, session_id: str) -> int | None:
+        """Returns the current test ID for a session, or None if none was generated."""
+        row = self._connection().execute("SELECT test_id FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_trail(self, session_id: str, limit: int = None) -> tuple[list, list, list] | None:
+        """Returns (latitudes, longitudes, timestamps) of the last `limit` distinct positions, oldest first."""
+        limit = self.trail_capacity if limit is None else max(0, min(limit, self.trail_capacity))
+        # One read transaction, so the trail matches the session row.
+        with self._read() as db:
+            exists = db.execute(
+                "SELECT 1 FROM sessions WHERE session_id = ? AND timestamp IS NOT NULL", (session_id,)
+            ).fetchone()
+            if exists is None:
+                return None
+            rows = db.execute(
+                "SELECT latitude, longitude, timestamp FROM trail WHERE session_id = ? ORDER BY position DESC LIMIT ?",
+                (session_id, limit)
+            ).fetchall()
+        rows.reverse()
+        return [row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows]
+
+    def wait_for_location_change(self, session_id: str, last_sequence: int | None,
+                                 timeout: float) -> tuple[int, tuple[float, float, float] | None]:
+        """
+        Blocks until the session's position differs from the state identified by
+        last_sequence (None means "return immediately"), or until timeout seconds pass.
+        Returns (sequence, location); the sequence is -1 while the session has no location.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            state = self._location_state(session_id)
+            remaining = deadline - time.monotonic()
+            if state[0] != last_sequence or remaining <= 0:
+                return state
+            # Woken early by writes from this process; otherwise poll for other processes.
+            with self.changed:
+                self.changed.wait(min(remaining, CHANGE_POLL_INTERVAL_SECONDS))
+
+    def locations(self, session_ids=None, since: float = None) -> dict:
+        """
+        Returns {session_id: (latitude, longitude, timestamp)} from one read transaction.
+        Requested sessions without a location map to None; 'since' keeps only locations
+        reported after that Unix time.
+        """
+        result = {}
+        with self._read() as db:
+            if session_ids is None:
+                if since is None:
+                    rows = db.execute("SELECT session_id, latitude, longitude, timestamp FROM sessions "
+                                      "WHERE timestamp IS NOT NULL")
+                else:
+                    # Served by the timestamp index.
+                    rows = db.execute("SELECT session_id, latitude, longitude, timestamp FROM sessions "
+                                      "WHERE timestamp > ?", (since,))
+                return {row[0]: tuple(row[1:]) for row in rows}
+
+            session_ids = list(dict.fromkeys(session_ids))
+            for start in range(0, len(session_ids), MAX_QUERY_PARAMETERS):
+                chunk = session_ids[start:start + MAX_QUERY_PARAMETERS]
+                placeholders = ", ".join("?" * len(chunk))
+                found = {
+                    row[0]: tuple(row[1:]) if row[3] is not None else None
+                    for row in db.execute(
+                        f"SELECT session_id, latitude, longitude, timestamp FROM sessions WHERE session_id IN ({placeholders})",
+                        chunk
+                    )
+                }
+                for session_id in chunk:
+                    location = found.get(session_id)
+                    if location is None:
+                        result[session_id] = None
+                    elif since is None or location[2] > since:
+                        result[session_id] = location
+        return result
+
+    def within_radius(self, latitude: float, longitude: float, radius_meters: float) -> list[tuple]:
+        """Returns [(session_id, latitude, longitude, distance_meters), ...] within the radius, nearest first."""
+        lat_span, lon_span = self.projection.degrees_for_meters(radius_meters)
+        east, north = self.projection.project(latitude, longitude)
+        results = []
+        for session_id, key_lat, key_lon in self._in_box(latitude - lat_span, longitude - lon_span,
+                                                         latitude + lat_span, longitude + lon_span):
+            key_east, key_north = self.projection.project(key_lat, key_lon)
+            distance = math.hypot(key_east - east, key_north - north)
+            if distance <= radius_meters:
+                results.append((session_id, key_lat, key_lon, distance))
+        results.sort(key=lambda result: result[3])
+        return results
+
+    def within_bounds(self, min_latitude: float, min_longitude: float,
+                      max_latitude: float, max_longitude: float) -> list[tuple]:
+        """Returns [(session_id, latitude, longitude), ...] inside the latitude/longitude box (inclusive)."""
+        return self._in_box(min_latitude, min_longitude, max_latitude, max_longitude)
+
+    def add_position_index(self, index):
+        """Adds an index reloaded from the shared table by sync_position_indexes()."""
+        with self._index_lock:
+            self.position_indexes.append(index)
+            # Forces the next sync to load the new index.
+            self._indexed_sequence = None
+
+    def sync_position_indexes(self):
+        """
+        Reloads the position indexes if any process moved, removed or expired a
+        session since the last reload. Costs one counter read when nothing changed.
+        """
+        with self._index_lock:
+            if not self.position_indexes:
+                return
+            with self._read() as db:
+                sequence = db.execute("SELECT value FROM counters WHERE name = 'location_sequence'").fetchone()[0]
+                if sequence == self._indexed_sequence:
+                    return
+                snapshot = {row[0]: tuple(row[1:]) for row in db.execute(
+                    "SELECT session_id, latitude, longitude, timestamp FROM sessions WHERE timestamp IS NOT NULL"
+                )}
+            for index in self.position_indexes:
+                index.reset(snapshot)
+            self._indexed_sequence = sequence
+
+    def remove(self, session_id: str) -> bool:
+        """Forgets a session entirely. Returns True if it existed."""
+        with self._write() as db:
+            removed = db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+            db.execute("DELETE FROM trail WHERE session_id = ?", (session_id,))
+            if removed:
+                # Lets other processes' position indexes notice the removal.
+                self._next_sequence(db)
+        if removed:
+            self._notify()
+        return removed
+
+    def expire(self, timeout_seconds: float, now: float = None) -> list[str]:
+        """Removes sessions inactive for more than timeout_seconds (via the last_active index)."""
+        now = time.time() if now is None else now
+        with self._write() as db:
+            expired = [row[0] for row in db.execute(
+                "SELECT session_id FROM sessions WHERE last_active < ?", (now - timeout_seconds,)
+            )]
+            for start in range(0, len(expired), MAX_QUERY_PARAMETERS):
+                chunk = expired[start:start + MAX_QUERY_PARAMETERS]
+                placeholders = ", ".join("?" * len(chunk))
+                db.execute(f"DELETE FROM sessions WHERE session_id IN ({placeholders})", chunk)
+                db.execute(f"DELETE FROM trail WHERE session_id IN ({placeholders})", chunk)
+            if expired:
+                self._next_sequence(db)
+        if expired:
+            self._notify()
+        return expired
+
+    def __len__(self) -> int:
+        """Returns the number of stored sessions (with or without a location)."""
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def close(self):
+        """Closes every connection opened by this store that is still open."""
+        with self._connections_lock:
+            holders = list(self._connections)
+            self._connections = weakref.WeakSet()
+        for holder in holders:
+            holder.close()
+        self._local = threading.local()
+
+    # --- Internal helpers ---
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns this thread's connection, opening and configuring it on first use."""
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            # Autocommit mode: transactions are started explicitly where needed.
+            # The timeout also covers the PRAGMAs below, which can need a lock themselves.
+            connection = sqlite3.connect(self.path, timeout=SESSION_DB_PRAGMAS["busy_timeout"] / 1000,
+                                         isolation_level=None, check_same_thread=False)
+            for name, value in SESSION_DB_PRAGMAS.items():
+                connection.execute(f"PRAGMA {name}={value}")
+            holder = self._local.holder = _ThreadConnection(connection)
+            with self._connections_lock:
+                self._connections.add(holder)
+        return holder.connection
+
+    def _create_schema(self):
+        """Creates the tables if missing and adds columns missing from older session files."""
+        with self._write() as db:
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    db.execute(statement)
+            existing = {row[1] for row in db.execute("PRAGMA table_info(sessions)")}
+            for column, definition in ADDED_SESSION_COLUMNS.items():
+                if column not in existing:
+                    db.execute(f"ALTER TABLE sessions ADD COLUMN {column} {definition}")
+
+    def _read(self):
+        """Returns this thread's connection inside a read transaction (use with 'with')."""
+        connection = self._connection()
+        connection.execute("BEGIN")
+        return _Transaction(connection)
+
+    def _write(self):
+        """Returns this thread's connection inside a BEGIN IMMEDIATE transaction (use with 'with')."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        return _Transaction(connection)
+
+    @staticmethod
+    def _next_sequence(db: sqlite3.Connection) -> int:
+        """
+        Returns a new, never reused location sequence number. Also bumped by removals,
+        so it changes whenever the set of live positions does. Caller holds a write transaction.
+        """
+        db.execute("UPDATE counters SET value = value + 1 WHERE name = 'location_sequence'")
+        return db.execute("SELECT value FROM counters WHERE name = 'location_sequence'").fetchone()[0]
+
+    def _location_state(self, session_id: str) -> tuple[int, tuple[float, float, float] | None]:
+        """Returns (location_sequence, location), or (-1, None) without a location."""
+        row = self._connection().execute(
+            "SELECT location_sequence, latitude, longitude, timestamp FROM sessions "
+            "WHERE session_id = ? AND timestamp IS NOT NULL",
+            (session_id,)
+        ).fetchone()
+        if row is None:
+            return -1, None
+        return row[0], tuple(row[1:])
+
+    def _in_box(self, min_latitude: float, min_longitude: float,
+                max_latitude: float, max_longitude: float) -> list[tuple]:
+        """Returns [(session_id, latitude, longitude), ...] inside the box using the position index."""
+        return [tuple(row) for row in self._connection().execute(
+            "SELECT session_id, latitude, longitude FROM sessions "
+            "WHERE latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?",
+            (min_latitude, max_latitude, min_longitude, max_longitude)
+        )]
+
+    def _notify(self):
+        """Wakes this process's threads waiting in wait_for_location_change()."""
+        with self.changed:
+            self.changed.notify_all()
+
+
+class _ThreadConnection:
+    """
+    Owns one thread's connection. Only the thread-local storage refers to it, so it is
+    collected when the thread exits (Flask's threaded server uses a thread per request)
+    and its finalizer closes the connection, keeping open connections bounded by the
+    number of live threads.
+    """
+    __slots__ = ("connection", "_finalizer", "__weakref__")
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self._finalizer = weakref.finalize(self, connection.close)
+
+    def close(self):
+        """Closes the connection now (later calls do nothing)."""
+        self._finalizer()
+
+
+class _Transaction:
+    """Context manager committing (or rolling back on error) an already started transaction."""
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        return False
@@ -0,0 +1,530 @@
+# SessionStore.py
+# In-memory store for per-session state: the live location reported by
+# /save_user_location and the test ID handed out by /generate_unique_id.
+# Sessions are spread over independently locked shards, and each shard keeps
+# its sessions in last-activity order, so expiring idle sessions only touches
+# the sessions that actually expired. Location changes are signalled on a
+# per-shard condition so streaming clients can wait for them. Incoming fixes
+# can be smoothed by a PositionFilter (LocationFilter.py) before they are stored.
+# SessionBackend describes the interface Routes relies on; create_session_store()
+# picks this in-memory store or the shared SQLite store (SQLiteSessionStore.py).
+
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict
+
+from SpatialIndex import SpatialGridIndex, distance_meters
+from LocationFilter import PositionFilter
+
+# Number of independently locked shards. Requests for different sessions
+# rarely share a lock, and cleanup only holds one shard lock at a time.
+DEFAULT_NUM_SHARDS = 16
+# Number of past positions kept per session (24 bytes each: latitude, longitude, timestamp).
+DEFAULT_TRAIL_CAPACITY = 256
+# Session backend names accepted by create_session_store() / ACCESSPOINTER_SESSION_BACKEND.
+BACKEND_MEMORY = "memory" # Per-process; only valid with a single server process.
+BACKEND_SQLITE = "sqlite" # Shared SQLite file; lets several worker processes share sessions.
+DEFAULT_BACKEND = BACKEND_MEMORY
+# Default location of the shared session database (next to the Django database).
+DEFAULT_SESSION_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database", "sessions.sqlite3")
+
+
+class TrailBuffer:
+    """
+    Fixed-size ring buffer of (latitude, longitude, timestamp) positions.
+    Backed by one preallocated array('d'), so memory per session is constant
+    (3 * 8 bytes * capacity) no matter how long the session is tracked.
+    """
+    __slots__ = ("capacity", "values", "head", "count")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        # Interleaved latitude, longitude, timestamp triples.
+        self.values = array("d", bytes(3 * 8 * capacity))
+        # Slot the next position is written to, and number of valid slots.
+        self.head = 0
+        self.count = 0
+
+    def append(self, latitude: float, longitude: float, timestamp: float):
+        """Stores a position, overwriting the oldest one when the buffer is full."""
+        offset = 3 * self.head
+        self.values[offset] = latitude
+        self.values[offset + 1] = longitude
+        self.values[offset + 2] = timestamp
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def last(self, limit: int = None) -> tuple[list, list, list]:
+        """Returns (latitudes, longitudes, timestamps) of the last `limit` positions, oldest first."""
+        limit = self.count if limit is None else max(0, min(limit, self.count))
+        start = (self.head - limit) % self.capacity
+        # The requested window may wrap around the end of the buffer.
+        if start + limit <= self.capacity:
+            window = self.values[3 * start:3 * (start + limit)]
+        else:
+            window = self.values[3 * start:] + self.values[:3 * (start + limit - self.capacity)]
+        return window[0::3].tolist(), window[1::3].tolist(), window[2::3].tolist()
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class SessionRecord:
+    """State kept for one frontend session."""
+    __slots__ = ("latitude", "longitude", "timestamp", "test_id", "last_active", "location_sequence", "trail",
+                 "stationary_updates", "raw_latitude", "raw_longitude", "filter_state")
+
+    def __init__(self):
+        # Latest live location (smoothed, if the store filters fixes) and the time it
+        # was reported (None until the first report).
+        self.latitude = None
+        self.longitude = None
+        self.timestamp = None
+        # Latest fix exactly as reported by the client.
+        self.raw_latitude = None
+        self.raw_longitude = None
+        # PositionFilter state tuple (None until the first usable fix).
+        self.filter_state = None
+        # Test ID from /generate_unique_id (None until one is generated).
+        self.test_id = None
+        # Time of the last location update or test ID assignment; drives expiry.
+        self.last_active = 0.0
+        # Shard sequence number of the last change to latitude/longitude.
+        self.location_sequence = 0
+        # Recent distinct positions (TrailBuffer), created with the first location.
+        self.trail = None
+        # Number of consecutive fixes coalesced into the current position.
+        self.stationary_updates = 0
+
+    def location(self) -> tuple[float, float, float] | None:
+        """Returns (latitude, longitude, timestamp), or None if no location was reported yet."""
+        if self.timestamp is None:
+            return None
+        return self.latitude, self.longitude, self.timestamp
+
+
+class _Shard:
+    """One lock plus the records it guards, ordered from least to most recently active."""
+    __slots__ = ("lock", "changed", "records", "sequence")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Notified (with self.lock held) whenever a location in this shard changes or a session is removed.
+        self.changed = threading.Condition(self.lock)
+        self.records = OrderedDict()
+        # Incremented on every such change; never reused, even for recreated sessions.
+        self.sequence = 0
+
+
+class SessionBackend(ABC):
+    """
+    Interface for per-session state storage used by Routes.
+    Locations are (latitude, longitude, timestamp) tuples; timestamps are Unix seconds.
+    Implementations must be safe to call from multiple request threads; creating
+    one that leaves an abstract method out raises TypeError.
+    Explicit timestamps may go backwards: sessions still expire by their latest activity.
+    """
+    @abstractmethod
+    def record_fix(self, session_id: str, latitude: float, longitude: float,
+                   min_distance_meters: float = 0.0, timestamp: float = None,
+                   accuracy: float = None) -> tuple[bool, int]:
+        """
+        Records a location fix and marks the session active. With a location filter,
+        the fix first updates the session's filter state and the smoothed position
+        takes its place below; the raw fix is kept for get_raw_location().
+        Positions closer than min_distance_meters to the stored one are coalesced:
+        only the timestamp is refreshed, and trails, indexes and streams are left untouched.
+        Returns (moved, stationary_updates): whether the stored position changed, and
+        how many fixes in a row have now been coalesced (0 after a move).
+        """
+
+    def update_location(self, session_id: str, latitude: float, longitude: float, timestamp: float = None) -> bool:
+        """Stores the latest live location and marks the session active. Returns True if the position changed."""
+        return self.record_fix(session_id, latitude, longitude, 0.0, timestamp)[0]
+
+    @abstractmethod
+    def set_test_id(self, session_id: str, test_id: int, timestamp: float = None):
+        """Stores the current test ID for a session and marks it active."""
+
+    @abstractmethod
+    def get_location(self, session_id: str) -> tuple[float, float, float] | None:
+        """Returns the session's location, or None if unknown."""
+
+    @abstractmethod
+    def get_raw_location(self, session_id: str) -> tuple[float, float, float] | None:
+        """Returns the session's last unfiltered fix as (latitude, longitude, timestamp), or None."""
+
+    @abstractmethod
+    def get_test_id(self, session_id: str) -> int | None:
+        """Returns the session's current test ID, or None."""
+
+    @abstractmethod
+    def get_trail(self, session_id: str, limit: int = None) -> tuple[list, list, list] | None:
+        """Returns (latitudes, longitudes, timestamps) of the last distinct positions, oldest first."""
+
+    @abstractmethod
+    def wait_for_location_change(self, session_id: str, last_sequence: int | None,
+                                 timeout: float) -> tuple[int, tuple[float, float, float] | None]:
+        """Waits up to timeout seconds for the position to change; returns (sequence, location)."""
+
+    @abstractmethod
+    def locations(self, session_ids=None, since: float = None) -> dict:
+        """Returns {session_id: location or None} for the given sessions (default: all with a location)."""
+
+    def session_ids(self) -> list[str]:
+        """Returns the IDs of all sessions that have reported a live location."""
+        return list(self.locations())
+
+    @abstractmethod
+    def within_radius(self, latitude: float, longitude: float, radius_meters: float) -> list[tuple]:
+        """Returns [(session_id, latitude, longitude, distance_meters), ...], nearest first."""
+
+    @abstractmethod
+    def add_position_index(self, index):
+        """
+        Keeps an index of live positions (e.g. an OccupancyGrid) in sync with this store,
+        starting from the sessions already stored. The index must provide
+        update(session_id, latitude, longitude), remove(session_id) and
+        reset({session_id: location}).
+        """
+
+    def sync_position_indexes(self):
+        """Brings added position indexes up to date before they are read. No-op if they always are."""
+
+    @abstractmethod
+    def within_bounds(self, min_latitude: float, min_longitude: float,
+                      max_latitude: float, max_longitude: float) -> list[tuple]:
+        """Returns [(session_id, latitude, longitude), ...] inside the box (inclusive)."""
+
+    @abstractmethod
+    def remove(self, session_id: str) -> bool:
+        """Forgets a session entirely. Returns True if it existed."""
+
+    @abstractmethod
+    def expire(self, timeout_seconds: float, now: float = None) -> list[str]:
+        """Removes sessions inactive for more than timeout_seconds and returns their IDs."""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Returns the number of stored sessions (with or without a location)."""
+
+    @staticmethod
+    def _is_move(previous, latitude: float, longitude: float, min_distance_meters: float) -> bool:
+        """
+        Returns True if a fix at (latitude, longitude) replaces the previous
+        (latitude, longitude, timestamp) location, i.e. it is the first fix, or it
+        differs and is at least min_distance_meters away.
+        """
+        if previous is None or previous[0] is None or previous[1] is None:
+            return True
+        if (previous[0], previous[1]) == (latitude, longitude):
+            return False
+        # Comparisons with NaN are False, so unusable positions always count as moves.
+        return not (min_distance_meters > 0 and
+                    distance_meters(previous[0], previous[1], latitude, longitude) < min_distance_meters)
+
+
+class SessionStore(SessionBackend):
+    """
+    Thread-safe, sharded in-memory session store with an expiry index.
+    Every session shares the same timeout, so the order in which sessions were last
+    touched is also the order in which they expire: each shard's OrderedDict is
+    that expiry queue, and expire() stops at the first session still active.
+    """
+    def __init__(self, num_shards: int = DEFAULT_NUM_SHARDS, trail_capacity: int = DEFAULT_TRAIL_CAPACITY,
+                 spatial_index=None, location_filter=None):
+        """
+        Args:
+            num_shards: Number of lock-striped shards.
+            trail_capacity: Number of past positions kept per session.
+            spatial_index: Optional SpatialGridIndex kept in sync with live locations
+                           (updated on every move, cleared on removal and expiry).
+            location_filter: Optional PositionFilter smoothing incoming fixes; None
+                             stores fixes as reported.
+        """
+        self.shards = [_Shard() for _ in range(num_shards)]
+        self.trail_capacity = trail_capacity
+        self.spatial_index = spatial_index
+        self.location_filter = location_filter
+        # Every index updated incrementally (under the shard lock) as sessions move or go away.
+        self.position_indexes = [spatial_index] if spatial_index is not None else []
+
+    def record_fix(self, session_id: str, latitude: float, longitude: float,
+                   min_distance_meters: float = 0.0, timestamp: float = None,
+                   accuracy: float = None) -> tuple[bool, int]:
+        """
+        Records a location fix for a session and marks it active (see SessionBackend.record_fix).
+        Wakes waiting streams if the position changed.
+        """
+        shard = self._shard(session_id)
+        with shard.lock:
+            # Stamped under the lock, so a reader that took its clock reading before
+            # locking this shard never misses an update carrying an earlier timestamp.
+            timestamp = time.time() if timestamp is None else timestamp
+            record = self._touch(shard, session_id, timestamp)
+            record.raw_latitude = latitude
+            record.raw_longitude = longitude
+            if self.location_filter is not None:
+                # The filter advances on every fix; only its output decides whether the session moved.
+                record.filter_state, latitude, longitude = self.location_filter.step(
+                    record.filter_state, latitude, longitude, timestamp, accuracy
+                )
+            record_location = record.location()
+            record.timestamp = timestamp
+            if not self._is_move(record_location, latitude, longitude, min_distance_meters):
+                record.stationary_updates += 1
+                return False, record.stationary_updates
+            record.latitude = latitude
+            record.longitude = longitude
+            record.stationary_updates = 0
+            # The trail records each distinct position once.
+            if record.trail is None:
+                record.trail = TrailBuffer(self.trail_capacity)
+            record.trail.append(latitude, longitude, timestamp)
+            for index in self.position_indexes:
+                index.update(session_id, latitude, longitude)
+            shard.sequence += 1
+            record.location_sequence = shard.sequence
+            shard.changed.notify_all()
+            return True, 0
+
+    def set_test_id(self, session_id: str, test_id: int, timestamp: float = None):
+        """Stores the current test ID for a session (replacing any previous one) and marks it active."""
+        timestamp = time.time() if timestamp is None else timestamp
+        shard = self._shard(session_id)
+        with shard.lock:
+            self._touch(shard, session_id, timestamp).test_id = test_id
+
+    def get_location(self, session_id: str) -> tuple[float, float, float] | None:
+        """Returns (latitude, longitude, timestamp) for a session, or None if unknown."""
+        shard = self._shard(session_id)
+        with shard.lock:
+            record = shard.records.get(session_id)
+            return record.location() if record is not None else None
+
+    def get_raw_location(self, session_id: str) -> tuple[float, float, float] | None:
+        """Returns the last fix exactly as reported, as (latitude, longitude, timestamp), or None."""
+        shard = self._shard(session_id)
+        with shard.lock:
+            record = shard.records.get(session_id)
+            if record is None or record.timestamp is None:
+                return None
+            return record.raw_latitude, record.raw_longitude, record.timestamp
+
+    def get_test_id(self, session_id: str) -> int | None:
+        """Returns the current test ID for a session, or None if none was generated."""
+        shard = self._shard(session_id)
+        with shard.lock:
+            record = shard.records.get(session_id)
+            return record.test_id if record is not None else None
+
+    def get_trail(self, session_id: str, limit: int = None) -> tuple[list, list, list] | None:
+        """
+        Returns (latitudes, longitudes, timestamps) of the session's last `limit`
+        distinct positions (all kept positions if None), oldest first, or None if
+        the session has no location.
+        """
+        shard = self._shard(session_id)
+        with shard.lock:
+            record = shard.records.get(session_id)
+            if record is None or record.trail is None:
+                return None
+            return record.trail.last(limit)
+
+    def wait_for_location_change(self, session_id: str, last_sequence: int | None,
+                                 timeout: float) -> tuple[int, tuple[float, float, float] | None]:
+        """
+        Blocks until the session's position differs from the state identified by
+        last_sequence (None means "return immediately"), or until timeout seconds pass.
+        Returns (sequence, location) describing the current state; the sequence is -1
+        while the session has no location. Pass it back in to wait for the next change.
+        """
+        shard = self._shard(session_id)
+        with shard.lock:
+            shard.changed.wait_for(lambda: self._location_state(shard, session_id)[0] != last_sequence, timeout)
+            return self._location_state(shard, session_id)
+
+    def locations(self, session_ids=None, since: float = None) -> dict:
+        """
+        Returns {session_id: (latitude, longitude, timestamp)} in one pass, taking
+        each shard lock at most once.
+        Args:
+            session_ids: Sessions to look up, or None for every session with a location.
+                         Requested sessions without a location map to None.
+            since: If given, only locations reported after this Unix time are returned
+                   (requested sessions without a location are still reported as None).
+        """
+        result = {}
+        if session_ids is None:
+            for shard in self.shards:
+                with shard.lock:
+                    for session_id, record in shard.records.items():
+                        location = record.location()
+                        if location is not None and (since is None or location[2] > since):
+                            result[session_id] = location
+            return result
+
+        # Group the requested IDs by shard so each lock is taken once.
+        by_shard = {}
+        for session_id in session_ids:
+            by_shard.setdefault(self._shard_index(session_id), []).append(session_id)
+        for index, shard_session_ids in by_shard.items():
+            shard = self.shards[index]
+            with shard.lock:
+                for session_id in shard_session_ids:
+                    record = shard.records.get(session_id)
+                    location = record.location() if record is not None else None
+                    if location is None:
+                        result[session_id] = None
+                    elif since is None or location[2] > since:
+                        result[session_id] = location
+        return result
+
+    def within_radius(self, latitude: float, longitude: float, radius_meters: float) -> list[tuple]:
+        """Returns [(session_id, latitude, longitude, distance_meters), ...] from the spatial index, nearest first."""
+        return self._require_spatial_index().within_radius(latitude, longitude, radius_meters)
+
+    def within_bounds(self, min_latitude: float, min_longitude: float,
+                      max_latitude: float, max_longitude: float) -> list[tuple]:
+        """Returns [(session_id, latitude, longitude), ...] inside the box, from the spatial index."""
+        return self._require_spatial_index().within_bounds(min_latitude, min_longitude, max_latitude, max_longitude)
+
+    def add_position_index(self, index):
+        """Adds an index updated incrementally on every move, removal and expiry (see SessionBackend)."""
+        # Registered before seeding: a shard updated meanwhile updates the index itself,
+        # and seeding each shard under its lock cannot overwrite a newer position.
+        self.position_indexes.append(index)
+        for shard in self.shards:
+            with shard.lock:
+                for session_id, record in shard.records.items():
+                    if record.location() is not None:
+                        index.update(session_id, record.latitude, record.longitude)
+
+    def remove(self, session_id: str) -> bool:
+        """Forgets a session entirely. Returns True if it existed."""
+        shard = self._shard(session_id)
+        with shard.lock:
+            removed = shard.records.pop(session_id, None) is not None
+            if removed:
+                for index in self.position_indexes:
+                    index.remove(session_id)
+                shard.changed.notify_all()
+            return removed
+
+    def expire(self, timeout_seconds: float, now: float = None) -> list[str]:
+        """
+        Removes sessions inactive for more than timeout_seconds.
+        Only the expired sessions (plus one check per shard) are visited.
+        Returns the removed session IDs.
+        """
+        now = time.time() if now is None else now
+        expired = []
+        for shard in self.shards:
+            with shard.lock:
+                records = shard.records
+                expired_before = len(expired)
+                while records:
+                    # The first entry is the least recently active one.
+                    session_id, record = next(iter(records.items()))
+                    if now - record.last_active <= timeout_seconds:
+                        break
+                    records.popitem(last=False)
+                    expired.append(session_id)
+                    for index in self.position_indexes:
+                        index.remove(session_id)
+                # Let streams watching an expired session report it as gone.
+                if len(expired) > expired_before:
+                    shard.changed.notify_all()
+        return expired
+
+    def __len__(self) -> int:
+        """Returns the number of stored sessions (with or without a location)."""
+        total = 0
+        for shard in self.shards:
+            with shard.lock:
+                total += len(shard.records)
+        return total
+
+    # --- Internal helpers ---
+
+    def _require_spatial_index(self):
+        """Returns the spatial index, raising RuntimeError if the store was built without one."""
+        if self.spatial_index is None:
+            raise RuntimeError("SessionStore was created without a spatial index")
+        return self.spatial_index
+
+    def _shard_index(self, session_id: str) -> int:
+        """Returns the index of the shard responsible for a session ID."""
+        return hash(session_id) % len(self.shards)
+
+    def _shard(self, session_id: str) -> _Shard:
+        """Returns the shard responsible for a session ID."""
+        return self.shards[self._shard_index(session_id)]
+
+    @staticmethod
+    def _location_state(shard: _Shard, session_id: str) -> tuple[int, tuple[float, float, float] | None]:
+        """Returns (location_sequence, location), or (-1, None) without a location. Caller holds shard.lock."""
+        record = shard.records.get(session_id)
+        location = record.location() if record is not None else None
+        if location is None:
+            return -1, None
+        return record.location_sequence, location
+
+    @staticmethod
+    def _touch(shard: _Shard, session_id: str, timestamp: float) -> SessionRecord:
+        """
+        Returns the record for session_id (creating it if needed), marks it active at
+        timestamp and moves it to its place in the expiry order. Caller holds shard.lock.
+        """
+        records = shard.records
+        record = records.get(session_id)
+        if record is None:
+            record = records[session_id] = SessionRecord()
+        else:
+            records.move_to_end(session_id)
+        # Keep last_active monotonic per session even if the wall clock steps back.
+        record.last_active = max(record.last_active, timestamp)
+        # A touch older than others in the shard (an explicit timestamp, or the wall
+        # clock stepping back) moves the newer records behind it, so the shard stays
+        # sorted by last_active. That only visits the records it displaces.
+        newer = []
+        for other_id in reversed(records):
+            if other_id == session_id:
+                continue
+            if records[other_id].last_active <= record.last_active:
+                break
+            newer.append(other_id)
+        for other_id in reversed(newer):
+            records.move_to_end(other_id)
+        return record
+
+
+def create_session_store(reference_latitude: float, reference_longitude: float,
+                         backend: str = None, path: str = None) -> SessionBackend:
+    """
+    Creates the configured session backend.
+    Args:
+        reference_latitude: Projection origin for proximity queries (e.g. the floor plan center).
+        reference_longitude: Projection origin for proximity queries.
+        backend: BACKEND_MEMORY or BACKEND_SQLITE; defaults to the ACCESSPOINTER_SESSION_BACKEND
+                 environment variable, then DEFAULT_BACKEND.
+        path: SQLite file for BACKEND_SQLITE; defaults to ACCESSPOINTER_SESSION_DB, then
+              DEFAULT_SESSION_DB_PATH. Every worker process must use the same file.
+    Raises:
+        ValueError: If the backend name is unknown.
+    """
+    backend = backend or os.environ.get("ACCESSPOINTER_SESSION_BACKEND", DEFAULT_BACKEND)
+    # Both backends smooth incoming fixes around the same origin.
+    location_filter = PositionFilter(reference_latitude, reference_longitude)
+    if backend == BACKEND_MEMORY:
+        return SessionStore(spatial_index=SpatialGridIndex(reference_latitude, reference_longitude),
+                            location_filter=location_filter)
+    if backend == BACKEND_SQLITE:
+        # Imported here because SQLiteSessionStore itself imports this module.
+        from SQLiteSessionStore import SQLiteSessionStore
+        path = path or os.environ.get("ACCESSPOINTER_SESSION_DB", DEFAULT_SESSION_DB_PATH)
+        return SQLiteSessionStore(path, reference_latitude, reference_longitude, location_filter=location_filter)
+    raise ValueError(f"Unknown session backend '{backend}' (expected '{BACKEND_MEMORY}' or '{BACKEND_SQLITE}')")
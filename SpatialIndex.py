@@ -0,0 +1,177 @@
+# SpatialIndex.py
+# Uniform grid index over live session positions.
+# Positions are projected onto a local flat plane in meters around a reference
+# point (accurate over a building-sized area) and bucketed into square cells,
+# so radius and bounding-box queries only visit the cells they overlap instead
+# of every tracked session.
+
+import math
+import threading
+
+# Meters per degree of latitude (and of longitude at the equator).
+METERS_PER_DEGREE = 111320.0
+# Edge length of one grid cell in meters.
+DEFAULT_CELL_SIZE_METERS = 5.0
+# Cell coordinates are clamped to +/- this, so query bounds that project to
+# infinity (e.g. a latitude of 1e308) cover every cell instead of overflowing.
+MAX_CELL_COORDINATE = 2 ** 62
+
+
+def distance_meters(latitude_a: float, longitude_a: float, latitude_b: float, longitude_b: float) -> float:
+    """Returns the approximate distance in meters between two nearby positions (equirectangular)."""
+    meters_per_degree_lon = METERS_PER_DEGREE * math.cos(math.radians((latitude_a + latitude_b) / 2))
+    return math.hypot((longitude_b - longitude_a) * meters_per_degree_lon, (latitude_b - latitude_a) * METERS_PER_DEGREE)
+
+
+class LocalProjection:
+    """
+    Equirectangular projection onto a flat plane in meters around a reference point.
+    Accurate to well under a meter over a building-sized area.
+    """
+    def __init__(self, reference_latitude: float, reference_longitude: float):
+        self.reference_latitude = reference_latitude
+        self.reference_longitude = reference_longitude
+        # A degree of longitude shrinks with the cosine of the latitude.
+        self.meters_per_degree_lon = METERS_PER_DEGREE * math.cos(math.radians(reference_latitude))
+
+    def project(self, latitude: float, longitude: float) -> tuple[float, float]:
+        """Returns (east, north) meters of a position relative to the reference point."""
+        east = (longitude - self.reference_longitude) * self.meters_per_degree_lon
+        north = (latitude - self.reference_latitude) * METERS_PER_DEGREE
+        return east, north
+
+    def degrees_for_meters(self, meters: float) -> tuple[float, float]:
+        """Returns the (latitude, longitude) degree spans covering `meters` in each direction."""
+        return meters / METERS_PER_DEGREE, meters / self.meters_per_degree_lon
+
+
+class SpatialGridIndex:
+    """
+    Thread-safe grid index mapping keys (session IDs) to their latest position.
+    Updates move a key between cells in O(1); queries cost O(cells overlapped + results),
+    capped by the number of occupied cells for very large query regions.
+    """
+    def __init__(self, reference_latitude: float, reference_longitude: float,
+                 cell_size_meters: float = DEFAULT_CELL_SIZE_METERS):
+        """
+        Args:
+            reference_latitude: Latitude of the projection origin (e.g. the floor plan center).
+            reference_longitude: Longitude of the projection origin.
+            cell_size_meters: Edge length of one grid cell in meters.
+        """
+        self.projection = LocalProjection(reference_latitude, reference_longitude)
+        self.cell_size = cell_size_meters
+        # {(cell_x, cell_y): set(keys)} for occupied cells only.
+        self.cells = {}
+        # {key: (latitude, longitude, east_m, north_m, cell)}.
+        self.positions = {}
+        # Lock protecting cells and positions.
+        self.lock = threading.Lock()
+
+    def project(self, latitude: float, longitude: float) -> tuple[float, float]:
+        """Returns (east, north) meters of a position relative to the reference point."""
+        return self.projection.project(latitude, longitude)
+
+    def update(self, key, latitude: float, longitude: float):
+        """Inserts a key or moves it to a new position. Non-finite positions remove the key."""
+        east, north = self.project(latitude, longitude)
+        if not (math.isfinite(east) and math.isfinite(north)):
+            self.remove(key)
+            return
+        cell = self._cell(east, north)
+        with self.lock:
+            previous = self.positions.get(key)
+            if previous is not None and previous[4] != cell:
+                self._discard_from_cell(key, previous[4])
+            if previous is None or previous[4] != cell:
+                self.cells.setdefault(cell, set()).add(key)
+            self.positions[key] = (latitude, longitude, east, north, cell)
+
+    def remove(self, key):
+        """Removes a key from the index if present."""
+        with self.lock:
+            previous = self.positions.pop(key, None)
+            if previous is not None:
+                self._discard_from_cell(key, previous[4])
+
+    def reset(self, locations: dict):
+        """Replaces the whole index with the given {key: (latitude, longitude, ...)} positions."""
+        with self.lock:
+            self.cells = {}
+            self.positions = {}
+        for key, location in locations.items():
+            self.update(key, location[0], location[1])
+
+    def within_radius(self, latitude: float, longitude: float, radius_meters: float) -> list[tuple]:
+        """
+        Returns [(key, latitude, longitude, distance_meters), ...] for keys within
+        radius_meters of the given position, nearest first.
+        """
+        east, north = self.project(latitude, longitude)
+        results = []
+        with self.lock:
+            for key in self._keys_in_cells(east - radius_meters, north - radius_meters,
+                                           east + radius_meters, north + radius_meters):
+                key_lat, key_lon, key_east, key_north, _ = self.positions[key]
+                distance = math.hypot(key_east - east, key_north - north)
+                if distance <= radius_meters:
+                    results.append((key, key_lat, key_lon, distance))
+        results.sort(key=lambda result: result[3])
+        return results
+
+    def within_bounds(self, min_latitude: float, min_longitude: float,
+                      max_latitude: float, max_longitude: float) -> list[tuple]:
+        """Returns [(key, latitude, longitude), ...] for keys inside the latitude/longitude box (inclusive)."""
+        min_east, min_north = self.project(min_latitude, min_longitude)
+        max_east, max_north = self.project(max_latitude, max_longitude)
+        results = []
+        with self.lock:
+            for key in self._keys_in_cells(min_east, min_north, max_east, max_north):
+                key_lat, key_lon = self.positions[key][:2]
+                if min_latitude <= key_lat <= max_latitude and min_longitude <= key_lon <= max_longitude:
+                    results.append((key, key_lat, key_lon))
+        return results
+
+    def __len__(self) -> int:
+        """Returns the number of indexed keys."""
+        with self.lock:
+            return len(self.positions)
+
+    # --- Internal helpers (caller holds self.lock where noted) ---
+
+    def _cell(self, east: float, north: float) -> tuple[int, int]:
+        """Returns the grid cell containing a projected position (clamped for infinite or NaN ones)."""
+        return self._cell_coordinate(east), self._cell_coordinate(north)
+
+    def _cell_coordinate(self, meters: float) -> int:
+        """Returns the cell coordinate along one axis, clamped to +/- MAX_CELL_COORDINATE."""
+        coordinate = meters / self.cell_size
+        if not -MAX_CELL_COORDINATE <= coordinate <= MAX_CELL_COORDINATE:
+            return -MAX_CELL_COORDINATE if coordinate < 0 else MAX_CELL_COORDINATE
+        return math.floor(coordinate)
+
+    def _discard_from_cell(self, key, cell: tuple[int, int]):
+        """Removes a key from a cell, dropping the cell once empty. Caller holds self.lock."""
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(key)
+            if not members:
+                del self.cells[cell]
+
+    def _keys_in_cells(self, min_east: float, min_north: float, max_east: float, max_north: float) -> list:
+        """
+        Returns the keys in every cell overlapping the projected rectangle. Caller holds self.lock.
+        Walks the overlapped cells, or the occupied cells when there are fewer of those.
+        """
+        min_cx, min_cy = self._cell(min_east, min_north)
+        max_cx, max_cy = self._cell(max_east, max_north)
+        keys = []
+        if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) <= len(self.cells):
+            for cx in range(min_cx, max_cx + 1):
+                for cy in range(min_cy, max_cy + 1):
+                    keys.extend(self.cells.get((cx, cy), ()))
+        else:
+            for (cx, cy), members in self.cells.items():
+                if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy:
+                    keys.extend(members)
+        return keys
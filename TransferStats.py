@@ -0,0 +1,114 @@
+# TransferStats.py
+# Server-side accounting of speed test transfers.
+# The speed test's own numbers are measured in the browser; recording what the
+# server actually received per test run gives an independent rate to check
+# submitted results against.
+# The ledgers live in process memory, so the numbers are per worker: with several
+# worker processes, a test run's transfers may be counted by one worker and its
+# results submitted to another, which then reports no server-side rate.
+
+import threading
+from collections import OrderedDict
+
+# Number of test runs whose statistics are kept; the least recently updated are dropped first.
+MAX_TRACKED_TESTS = 4096
+
+
+class TransferStats:
+    """Totals for the streams of one direction (upload or download) of one test run."""
+    __slots__ = ("streams", "completed_streams", "total_bytes", "first_start", "last_finish",
+                 "first_byte_streams", "first_byte_seconds")
+
+    def __init__(self):
+        # Number of finished transfer requests, and how many of them ran to the end
+        # (the speed test cancels downloads still running when its timer expires).
+        self.streams = 0
+        self.completed_streams = 0
+        # Bytes transferred over all streams.
+        self.total_bytes = 0
+        # Wall-clock span covered by the streams (time.monotonic() values).
+        self.first_start = None
+        self.last_finish = None
+        # Number of streams that reported a time to first byte, and the sum of those times.
+        self.first_byte_streams = 0
+        self.first_byte_seconds = 0.0
+
+    def add(self, byte_count: int, started: float, finished: float, first_byte: float = None,
+            completed: bool = True):
+        """
+        Adds one finished stream.
+        Args:
+            byte_count: Bytes actually transferred.
+            started: When the request arrived (time.monotonic()).
+            finished: When the stream ended.
+            first_byte: When the first data went out, if known.
+            completed: False if the stream was cut off before its end.
+        """
+        self.streams += 1
+        self.completed_streams += completed
+        self.total_bytes += byte_count
+        self.first_start = started if self.first_start is None else min(self.first_start, started)
+        self.last_finish = finished if self.last_finish is None else max(self.last_finish, finished)
+        if first_byte is not None:
+            self.first_byte_streams += 1
+            self.first_byte_seconds += first_byte - started
+
+    def summary(self) -> dict:
+        """
+        Returns {"streams": int, "completed_streams": int, "bytes": int, "seconds": float,
+        "mbps": float | None, "mean_ttfb_ms": float | None}.
+        'seconds' is the wall time from the first stream's start to the last one's end,
+        so parallel streams are not double counted; 'mbps' is bytes over that time.
+        'mean_ttfb_ms' is the mean time to first byte of the streams that reported one.
+        """
+        seconds = self.last_finish - self.first_start if self.streams else 0.0
+        return {
+            "streams": self.streams,
+            "completed_streams": self.completed_streams,
+            "bytes": self.total_bytes,
+            "seconds": seconds,
+            "mbps": self.total_bytes * 8 / seconds / 1e6 if seconds > 0 else None,
+            "mean_ttfb_ms": (self.first_byte_seconds / self.first_byte_streams * 1000
+                             if self.first_byte_streams else None),
+        }
+
+
+class TransferLedger:
+    """
+    Thread-safe map from test ID to TransferStats, bounded to MAX_TRACKED_TESTS runs.
+    Test IDs are the ones handed out by /generate_unique_id, as strings.
+    """
+    def __init__(self, max_tests: int = MAX_TRACKED_TESTS):
+        self.max_tests = max_tests
+        # {test_id: TransferStats}, least recently updated first.
+        self.tests = OrderedDict()
+        # Lock protecting tests and the stats inside it.
+        self.lock = threading.Lock()
+
+    def record(self, test_id: str, byte_count: int, started: float, finished: float,
+               first_byte: float = None, completed: bool = True):
+        """Adds one finished stream to a test run (arguments as for TransferStats.add)."""
+        with self.lock:
+            stats = self.tests.get(test_id)
+            if stats is None:
+                stats = self.tests[test_id] = TransferStats()
+                if len(self.tests) > self.max_tests:
+                    self.tests.popitem(last=False)
+            else:
+                self.tests.move_to_end(test_id)
+            stats.add(byte_count, started, finished, first_byte, completed)
+
+    def summary(self, test_id: str) -> dict | None:
+        """Returns the TransferStats summary of a test run, or None if nothing was recorded."""
+        with self.lock:
+            stats = self.tests.get(test_id)
+            return stats.summary() if stats is not None else None
+
+
+# Bytes and wall time the server received per speed test run (keyed by the
+# 'test_id' query parameter of /backend/empty uploads). Shared by the backend
+# routes, which record, and the main routes, which read; per worker process.
+upload_ledger = TransferLedger()
+# Bytes, time to first byte and wall time the server sent per speed test run (keyed
+# by the 'test_id' query parameter of /backend/garbage downloads); per worker process.
+download_ledger = TransferLedger()
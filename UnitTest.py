@@ -3,11 +3,41 @@ Unit tests for the Routes class
 """
 
 import unittest
-from Routes import Routes
+import threading
+from Routes import Routes, IMAGE_WIDTH, IMAGE_HEIGHT, UNMAPPED_PIXEL, map_lat_lon_to_pixels, map_lat_lon_to_pixels_batch
+from Routes import parse_time_window_seconds
+import Routes as routes_module
+from DatabaseHandler import DatabaseHandler, DURABILITY_ENQUEUE, Location, Internet
+from SessionStore import SessionStore, SessionBackend
+from HeatmapAggregate import HeatmapAggregate
+from HeatmapPyramid import HeatmapPyramid
+from SQLiteSessionStore import SQLiteSessionStore
+from SpatialIndex import METERS_PER_DEGREE, distance_meters
+from PositionLog import PositionLogReader, PositionLogWriter, RECORD_FORMAT, RECORD_SIZE, log_files, replay, session_hash
+from LocationFilter import MAX_GAP_SECONDS, PositionFilter
+from LocationUpdatePolicy import BASE_UPDATE_INTERVAL_MS, MAX_UPDATE_INTERVAL_MS, MOVEMENT_THRESHOLD_METERS
+from LocationUpdatePolicy import TARGET_UPDATES_PER_SECOND, suggest_update_interval_ms
+import BackendRoutes
+from BackendRoutes import backend_bp, PREGENERATED_DATA
+from IspLookup import CachedIspLookup, FileLookup, IpinfoLookup, PrefixTableLookup, create_isp_lookup
+import TransferStats
+from TransferStats import TransferLedger
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 from flask import Flask
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+import gc
+import io
+import math
+import os
+import random
+import requests
+import sqlite3
+import tempfile
 import time
 import json
+import struct
+import weakref
 
 
 class TestRoutes(unittest.TestCase):
@@ -25,13 +55,21 @@ class TestRoutes(unittest.TestCase):
 
         # Instantiate the Routes class
         # Connects the Routes class to our Flask App
-        self.routes_instance = Routes(self.app)
+        # Position logs written by the tests go to a temporary directory
+        self.position_log_dir = tempfile.TemporaryDirectory()
+        with patch.dict(os.environ, {"ACCESSPOINTER_POSITION_LOG_DIR": self.position_log_dir.name}):
+            self.routes_instance = Routes(self.app)
 
         # Create test clients from the Flask application.
         # Each client simulates a separate browser session
         self.client1 = self.app.test_client()
         self.client2 = self.app.test_client() 
 
+    def tearDown(self):
+        """Close the position log and delete its temporary directory."""
+        self.routes_instance.position_log.close()
+        self.position_log_dir.cleanup()
+
     def test_generate_id_route_200(self):
         """
         Test if the /generate_unique_id route returns HTTP status 200 (OK)
@@ -164,7 +202,7 @@ class TestRoutes(unittest.TestCase):
         session_id = "submit-test-session-1"
         unique_id = 123456
         # Ensure the session ID exists
-        self.routes_instance.session_ids_to_generated_ids[session_id] = unique_id
+        self.routes_instance.sessions.set_test_id(session_id, unique_id)
         # Mock the database handler method
         self.routes_instance.db_handler.save_speed_test = MagicMock()
 
@@ -201,7 +239,7 @@ class TestRoutes(unittest.TestCase):
         """Test submission with 'Fail' values converted to 0.0."""
         session_id = "submit-test-session-fail"
         unique_id = 654321
-        self.routes_instance.session_ids_to_generated_ids[session_id] = unique_id
+        self.routes_instance.sessions.set_test_id(session_id, unique_id)
         self.routes_instance.db_handler.save_speed_test = MagicMock()
 
         payload = {
@@ -230,7 +268,7 @@ class TestRoutes(unittest.TestCase):
         """Test submission with missing speed values default to 0.0."""
         session_id = "submit-test-session-missing"
         unique_id = 789012
-        self.routes_instance.session_ids_to_generated_ids[session_id] = unique_id
+        self.routes_instance.sessions.set_test_id(session_id, unique_id)
         self.routes_instance.db_handler.save_speed_test = MagicMock()
 
         payload = {
@@ -258,7 +296,7 @@ class TestRoutes(unittest.TestCase):
         """Test submission with invalid non-numeric strings defaulting to 0.0."""
         session_id = "submit-test-session-invalid-str"
         unique_id = 112233
-        self.routes_instance.session_ids_to_generated_ids[session_id] = unique_id
+        self.routes_instance.sessions.set_test_id(session_id, unique_id)
         self.routes_instance.db_handler.save_speed_test = MagicMock()
 
         payload = {
@@ -306,8 +344,7 @@ class TestRoutes(unittest.TestCase):
         """Test submission with a session_id not previously generated."""
         session_id = "unrecognized-session"
         # Ensure this session_id is NOT in the mapping
-        if session_id in self.routes_instance.session_ids_to_generated_ids:
-            del self.routes_instance.session_ids_to_generated_ids[session_id]
+        self.routes_instance.sessions.remove(session_id)
 
         self.routes_instance.db_handler.save_speed_test = MagicMock() # Mock DB just in case
 
@@ -364,7 +401,7 @@ class TestRoutes(unittest.TestCase):
         """Test handling of a database exception during save."""
         session_id = "submit-test-session-db-error"
         unique_id = 445566
-        self.routes_instance.session_ids_to_generated_ids[session_id] = unique_id
+        self.routes_instance.sessions.set_test_id(session_id, unique_id)
 
         # Setup: Mock the database handler to raise an exception
         self.routes_instance.db_handler.save_speed_test = MagicMock(
@@ -509,6 +546,359 @@ class TestRoutes(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn("Missing required fields: session_id", response.get_json().get("error", ""))
 
+    def test_cleanup_inactive_sessions(self):
+        """
+        Test if cleanup removes only sessions idle past the timeout, together with
+        their generated test IDs, while recently active sessions keep their location.
+        """
+        sessions = self.routes_instance.sessions
+        now = time.time()
+        sessions.update_location("idle-session", 43.0376, -76.1325, timestamp=now - 120)
+        sessions.set_test_id("idle-session", 123456, timestamp=now - 120)
+        sessions.update_location("active-session", 43.0377, -76.1326, timestamp=now - 120)
+        # A later update moves the session to the back of the expiry order
+        response = self.client1.post("/save_user_location", json={"session_id": "active-session", "latitude": 43.0378, "longitude": -76.1327})
+        self.assertEqual(response.status_code, 200)
+
+        self.routes_instance.cleanup_inactive_sessions(60)
+
+        self.assertIsNone(sessions.get_location("idle-session"))
+        self.assertIsNone(sessions.get_test_id("idle-session"))
+        self.assertEqual(sessions.get_location("active-session")[:2], (43.0378, -76.1327))
+        self.assertEqual(self.routes_instance.get_all_sessions(), ["active-session"])
+        self.assertTrue(self.client1.get("/get-live-location/active-session").get_json()["found"])
+
+    def test_live_location_stream_pushes_changes(self):
+        """
+        Test if the SSE stream sends the current position immediately, then pushes
+        an event only when /save_user_location moves the session to a new pixel.
+        """
+        session_id = "sse-session"
+        self.routes_instance.sessions.update_location(session_id, 43.0376, -76.1325)
+        response = self.client1.get(f"/live-location-stream/{session_id}", buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        events = (chunk.decode() for chunk in response.response)
+
+        self.assertTrue(next(events).startswith("retry:"))
+        first = next(events)
+        self.assertEqual(json.loads(first[len("data: "):]), self.client1.get(f"/get-live-location/{session_id}").get_json())
+
+        # Report the same position (no event), then a new one from another thread
+        def move():
+            time.sleep(0.1)
+            self.client2.post("/save_user_location", json={"session_id": session_id, "latitude": 43.0376, "longitude": -76.1325})
+            self.client2.post("/save_user_location", json={"session_id": session_id, "latitude": 43.0379, "longitude": -76.1328})
+        mover = threading.Thread(target=move)
+        mover.start()
+        second = next(events)
+        mover.join()
+        response.close()
+
+        self.assertEqual(json.loads(second[len("data: "):]), self.client1.get(f"/get-live-location/{session_id}").get_json())
+        self.assertNotEqual(second, first)
+
+    def test_live_locations_batch(self):
+        """
+        Test if /live-locations returns mapped positions for many sessions at once,
+        matching /get-live-location, and filters by the 'since' timestamp.
+        """
+        sessions = self.routes_instance.sessions
+        now = time.time()
+        sessions.update_location("batch-a", 43.0376, -76.1325, timestamp=now - 30)
+        sessions.update_location("batch-b", 43.0378, -76.1327, timestamp=now - 10)
+        sessions.update_location("batch-out", 50.0, -80.0, timestamp=now - 10)
+
+        # All active sessions
+        data = self.client1.get("/live-locations").get_json()
+        self.assertEqual(set(data["sessions"]), {"batch-a", "batch-b", "batch-out"})
+        for sid, payload in data["sessions"].items():
+            expected = self.client1.get(f"/get-live-location/{sid}").get_json()
+            self.assertEqual({k: v for k, v in payload.items() if k != "last_seen"}, expected)
+        self.assertFalse(data["sessions"]["batch-out"]["in_bounds"])
+
+        # Selected sessions updated after 'since'; unknown IDs are reported as not found
+        response = self.client1.post("/live-locations", json={"session_ids": ["batch-a", "batch-b", "missing"], "since": now - 20})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.get_json()["sessions"]), {"batch-b", "missing"})
+        self.assertFalse(response.get_json()["sessions"]["missing"]["found"])
+
+        # Passing back server_time returns only later changes
+        server_time = response.get_json()["server_time"]
+        self.assertEqual(self.client1.get(f"/live-locations?session_id=batch-a&since={server_time}").get_json()["sessions"], {})
+        self.client1.post("/save_user_location", json={"session_id": "batch-a", "latitude": 43.0377, "longitude": -76.1326})
+        self.assertEqual(set(self.client1.get(f"/live-locations?since={server_time}").get_json()["sessions"]), {"batch-a"})
+        # 'since' is compared at full precision (rounded to microseconds it would equal the fix)
+        sessions.update_location("batch-exact", 43.0376, -76.1325, timestamp=1700000000.123457)
+        exact = self.client1.get("/live-locations?session_id=batch-exact&since=1700000000.1234567").get_json()["sessions"]
+        self.assertEqual(list(exact), ["batch-exact"])
+
+        # Invalid parameters
+        self.assertEqual(self.client1.get("/live-locations?since=soon").status_code, 400)
+        self.assertEqual(self.client1.post("/live-locations", json={"session_ids": "batch-a"}).status_code, 400)
+
+    def test_trail_ring_buffer(self):
+        """
+        Test if /trail returns the last N distinct positions, oldest first and mapped
+        like /get-live-location, and if old positions are overwritten once the
+        fixed-size buffer is full.
+        """
+        self.routes_instance.sessions = SessionStore(trail_capacity=4)
+        session_id = "trail-session"
+        positions = [(43.0373 + i * 0.0001, -76.1329 + i * 0.0001) for i in range(6)]
+        for latitude, longitude in positions:
+            self.client1.post("/save_user_location", json={"session_id": session_id, "latitude": latitude, "longitude": longitude})
+        # Repeating the latest position does not add a trail point
+        self.client1.post("/save_user_location", json={"session_id": session_id, "latitude": positions[-1][0], "longitude": positions[-1][1]})
+
+        data = self.client1.get(f"/trail/{session_id}").get_json()
+        self.assertTrue(data["found"])
+        expected = [map_lat_lon_to_pixels(lat, lon) for lat, lon in positions[-4:]]
+        self.assertEqual([(p["x"], p["y"], p["in_bounds"]) for p in data["points"]], expected)
+
+        # 'limit' returns only the most recent points
+        limited = self.client1.get(f"/trail/{session_id}?limit=2").get_json()["points"]
+        self.assertEqual(limited, data["points"][-2:])
+        self.assertEqual(limited[-1]["x"], self.client1.get(f"/get-live-location/{session_id}").get_json()["x"])
+
+        self.assertFalse(self.client1.get("/trail/unknown-session").get_json()["found"])
+        self.assertEqual(self.client1.get(f"/trail/{session_id}?limit=0").status_code, 400)
+
+    def test_spatial_session_queries(self):
+        """
+        Test if the radius and rectangle endpoints return exactly the sessions a full
+        scan would find, and if moved/removed sessions are kept up to date in the index.
+        """
+        rng = random.Random(7)
+        sessions = self.routes_instance.sessions
+        for i in range(200):
+            sessions.update_location(f"spatial-{i}", 43.0372 + rng.random() * 0.0009, -76.1330 + rng.random() * 0.0009)
+        center_lat, center_lon, radius = 43.0376, -76.1326, 12.0
+
+        # Brute-force distances with the same local projection
+        def distance(lat, lon):
+            east = (lon - center_lon) * METERS_PER_DEGREE * math.cos(math.radians((43.037278 + 43.037944) / 2))
+            return math.hypot(east, (lat - center_lat) * METERS_PER_DEGREE)
+        expected = sorted(sid for sid, (lat, lon, _) in sessions.locations().items() if distance(lat, lon) <= radius)
+
+        response = self.client1.get(f"/sessions/nearby?latitude={center_lat}&longitude={center_lon}&radius={radius}")
+        found = response.get_json()["sessions"]
+        self.assertEqual(sorted(r["session_id"] for r in found), expected)
+        self.assertEqual([r["distance_m"] for r in found], sorted(r["distance_m"] for r in found))
+
+        # Rectangle query matches the mapped pixels of in-bounds sessions
+        rect = (300, 200, 600, 500)
+        in_rect = self.client1.get("/sessions/in-rect?x1=%d&y1=%d&x2=%d&y2=%d" % rect).get_json()["sessions"]
+        expected_rect = sorted(
+            sid for sid, (lat, lon, _) in sessions.locations().items()
+            if (lambda p: p[2] and rect[0] <= p[0] <= rect[2] and rect[1] <= p[1] <= rect[3])(map_lat_lon_to_pixels(lat, lon))
+        )
+        self.assertEqual(sorted(r["session_id"] for r in in_rect), expected_rect)
+
+        # Moving a session and expiring it are reflected in query results (at its smoothed position)
+        self.client1.post("/save_user_location", json={"session_id": "spatial-0", "latitude": center_lat, "longitude": center_lon})
+        moved_lat, moved_lon, _ = sessions.get_location("spatial-0")
+        nearest = self.client1.get(f"/sessions/nearby?latitude={moved_lat}&longitude={moved_lon}&radius=0.5").get_json()["sessions"]
+        self.assertEqual(nearest[0]["session_id"], "spatial-0")
+        sessions.remove("spatial-0")
+        nearest = self.client1.get(f"/sessions/nearby?latitude={moved_lat}&longitude={moved_lon}&radius=0.5").get_json()["sessions"]
+        self.assertNotIn("spatial-0", [r["session_id"] for r in nearest])
+
+        self.assertEqual(self.client1.get("/sessions/nearby?latitude=43.0&longitude=-76.0").status_code, 400)
+        self.assertEqual(self.client1.get("/sessions/in-rect?x1=0&y1=0&x2=nan&y2=5").status_code, 400)
+        # Out-of-range points are rejected instead of overflowing the grid (500)
+        for query in ("latitude=1e308&longitude=-76.0&radius=10", "latitude=43.0&longitude=-1e308&radius=10",
+                      "latitude=90.5&longitude=0&radius=10", "latitude=43.0&longitude=180.5&radius=10",
+                      "x=1e308&y=0&radius=10", "latitude=43.0&longitude=-76.0&radius=inf"):
+            response = self.client1.get(f"/sessions/nearby?{query}")
+            self.assertEqual(response.status_code, 400, query)
+        # Rectangles projecting to infinity cover the whole grid
+        response = self.client1.get("/sessions/in-rect?x1=-1e308&y1=-1e308&x2=1e308&y2=1e308")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()["sessions"]), len(sessions.locations()))
+
+    def test_occupancy_data(self):
+        """
+        Test if /occupancy-data counts active sessions per cell like a full scan would,
+        and if moves, removals and expiry update the counts without a rebuild.
+        """
+        rng = random.Random(11)
+        sessions = self.routes_instance.sessions
+        # Some sessions fall outside the floor plan and must not be counted
+        for i in range(300):
+            sessions.update_location(f"occupancy-{i}", 43.0370 + rng.random() * 0.0013, -76.1332 + rng.random() * 0.0013)
+        cell_size = self.routes_instance.occupancy.cell_size
+
+        def expected_counts():
+            counts = Counter()
+            for lat, lon, _ in sessions.locations().values():
+                x, y, in_bounds = map_lat_lon_to_pixels(lat, lon)
+                if in_bounds:
+                    counts[(x // cell_size, y // cell_size)] += 1
+            return counts
+
+        def served_counts(data):
+            return Counter({(p["x"] // cell_size, p["y"] // cell_size): p["value"] for p in data["data"]})
+
+        response = self.client1.get("/occupancy-data")
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(served_counts(data), expected_counts())
+        self.assertEqual(data["sessions"], sum(expected_counts().values()))
+        self.assertEqual(data["max"], max(expected_counts().values()))
+
+        # Unchanged counts revalidate with 304; a move changes the ETag
+        etag = response.headers["ETag"].strip('"')
+        self.assertEqual(self.client1.get("/occupancy-data", headers={"If-None-Match": f'"{etag}"'}).status_code, 304)
+        self.client1.post("/save_user_location", json={"session_id": "occupancy-0", "latitude": 43.03760, "longitude": -76.13255})
+        sessions.remove("occupancy-1")
+        data = self.client1.get("/occupancy-data", headers={"If-None-Match": f'"{etag}"'}).get_json()
+        self.assertEqual(served_counts(data), expected_counts())
+
+        # Expired sessions leave the grid
+        self.routes_instance.cleanup_inactive_sessions(-1)
+        data = self.client1.get("/occupancy-data").get_json()
+        self.assertEqual((data["sessions"], data["data"], data["max"]), (0, [], 1))
+
+    def test_position_log_replay(self):
+        """
+        Test if accepted fixes are appended to the binary position log (coalesced or not),
+        replayed per session and time range through /replay, and read back by the
+        memory-mapped reader across rotated files, ignoring a torn final record.
+        """
+        walk = [(43.0376 + i * 0.00001, -76.1325) for i in range(5)]
+        for lat, lon in walk:
+            self.client1.post("/save_user_location", json={"session_id": "walker", "latitude": lat, "longitude": lon})
+            self.client1.post("/save_user_location", json={"session_id": "other", "latitude": lat, "longitude": lon})
+        # A fix within the movement threshold is still logged
+        self.client1.post("/save_user_location", json={"session_id": "walker", "latitude": walk[-1][0], "longitude": walk[-1][1]})
+
+        data = self.client1.get("/replay/walker").get_json()
+        self.assertEqual([(p["x"], p["y"]) for p in data["points"]],
+                         [map_lat_lon_to_pixels(lat, lon)[:2] for lat, lon in walk + walk[-1:]])
+        self.assertFalse(data["truncated"])
+        timestamps = [p["timestamp"] for p in data["points"]]
+        self.assertEqual(timestamps, sorted(timestamps))
+        sliced = self.client1.get(f"/replay/walker?since={timestamps[2]}&until={timestamps[4]}&limit=1").get_json()
+        self.assertEqual(([p["timestamp"] for p in sliced["points"]], sliced["truncated"]), ([timestamps[2]], True))
+        # Paging from any returned timestamp starts at that exact fix
+        for timestamp in timestamps[:-1]:
+            page = self.client1.get(f"/replay/walker?since={timestamp}&limit=1").get_json()
+            self.assertEqual(page["points"][0]["timestamp"], timestamp)
+        # Numeric bounds are not rounded to microseconds (a datetime would round this one up)
+        self.assertEqual(parse_time_window_seconds({"since": "1792204910.7693737", "until": "2e9"}), (1792204910.7693737, 2e9))
+        self.assertEqual(self.client1.get("/replay/nobody").get_json()["points"], [])
+        self.assertEqual(self.client1.get("/replay/walker?limit=0").status_code, 400)
+
+        # Rotation by size, replay across files, and a partial record at the end of a file
+        directory = os.path.join(self.position_log_dir.name, "rotated")
+        writer = PositionLogWriter(directory, rotate_bytes=RECORD_SIZE * 1000)
+        for i in range(5000):
+            writer.append(f"s{i % 4}", 43.0 + i * 1e-6, -76.0, timestamp=1000.0 + i)
+        writer.close()
+        paths = log_files(directory)
+        self.assertGreater(len(paths), 1)
+        with open(paths[-1], "ab") as log_file:
+            log_file.write(b"torn")
+        records = replay(directory, since=1500.0, until=4500.0, session_id="s1")
+        self.assertEqual(records["timestamp"].tolist(), [1000.0 + i for i in range(501, 3500, 4)])
+        self.assertTrue((records["session"] == session_hash("s1")).all())
+        self.assertEqual(len(replay(directory)), 5000)
+        with PositionLogReader(paths[-1]) as reader:
+            self.assertTrue(reader.sorted)
+            self.assertEqual(len(reader.time_slice(until=reader.records["timestamp"][0])), 0)
+
+        # A limit stops the scan early, with the same result as truncating a full replay
+        with patch("PositionLog.PositionLogReader", wraps=PositionLogReader) as opened:
+            self.assertEqual(replay(directory, session_id="s2", limit=10)["timestamp"].tolist(),
+                             [1000.0 + i for i in range(2, 40, 4)])
+        self.assertEqual(opened.call_count, 1)
+        other_writer = PositionLogWriter(os.path.join(self.position_log_dir.name, "other"), rotate_bytes=RECORD_SIZE * 700)
+        for i in range(3000):
+            other_writer.append("o", 44.0, -76.0, timestamp=1000.5 + i * 1.5)
+        other_writer.close()
+        for path in log_files(other_writer.directory):
+            start_ms = os.path.basename(path).split("-")[1]
+            os.rename(path, os.path.join(directory, f"positions-{start_ms}-{os.getpid() + 1}.bin"))
+        full = replay(directory)
+        for limit in (1, 999, 1000, 2500, 7999, 8000, 9000):
+            limited = replay(directory, limit=limit)
+            self.assertEqual(limited["timestamp"].tolist(), full["timestamp"][:limit].tolist())
+            self.assertEqual(limited["session"].tolist(), full["session"][:limit].tolist())
+
+        # The default directory sits next to the database, whatever the working directory
+        with patch.dict(os.environ):
+            os.environ.pop("ACCESSPOINTER_POSITION_LOG_DIR", None)
+            self.assertEqual(PositionLogWriter().directory,
+                             os.path.join(os.path.dirname(os.path.abspath(routes_module.__file__)), "database", "positions"))
+
+    def test_position_log_retention(self):
+        """
+        Test if rotated position log files are deleted once all their fixes are older
+        than the retention age, or oldest first while the directory is over its size
+        budget, keeping the current file and files other writers may still append to.
+        """
+        # By age: one file per 10 s, fixes older than 100 s are dropped
+        directory = os.path.join(self.position_log_dir.name, "by-age")
+        os.makedirs(directory)
+        # A file left behind by a writer that has since exited
+        with open(os.path.join(directory, f"positions-500000-{os.getpid() + 1}.bin"), "wb") as stale:
+            stale.write(RECORD_FORMAT.pack(session_hash("gone"), 500.0, 43.0, -76.0))
+        writer = PositionLogWriter(directory, rotate_seconds=10, retain_seconds=100)
+        for i in range(1000):
+            writer.append("walker", 43.0, -76.0, timestamp=1000.0 + i)
+            writer.flush(sync=False)
+        writer.close()
+        timestamps = replay(directory)["timestamp"]
+        self.assertEqual(timestamps[-1], 1999.0)
+        self.assertGreaterEqual(timestamps[0], 1999.0 - 100 - 10)
+        self.assertEqual(len(replay(directory, session_id="gone")), 0)
+
+        # By size: at most the budget plus the file being written
+        directory = os.path.join(self.position_log_dir.name, "by-size")
+        writer = PositionLogWriter(directory, rotate_bytes=RECORD_SIZE * 100, retain_bytes=RECORD_SIZE * 350)
+        for i in range(2000):
+            writer.append("walker", 43.0, -76.0, timestamp=1000.0 + i)
+        writer.close()
+        self.assertLessEqual(sum(os.path.getsize(path) for path in log_files(directory)), RECORD_SIZE * (350 + 256))
+        timestamps = replay(directory)["timestamp"]
+        self.assertEqual(timestamps[-1], 2999.0)
+        self.assertEqual(timestamps.tolist(), [timestamps[0] + i for i in range(len(timestamps))])
+
+    def test_save_user_location_coalescing_and_hints(self):
+        """
+        Test if sub-threshold movements are coalesced (position, trail and streams
+        unchanged) while stationary devices get growing update intervals, and if
+        the interval stretches under load.
+        """
+        session_id = "coalesce-session"
+
+        def post(latitude, longitude):
+            return self.client1.post("/save_user_location", json={"session_id": session_id, "latitude": latitude, "longitude": longitude}).get_json()
+
+        first = post(43.0376, -76.1325)
+        self.assertTrue(first["moved"])
+        self.assertEqual(first["next_update_ms"], BASE_UPDATE_INTERVAL_MS)
+        # About 0.5 m of jitter: coalesced, and each stationary fix doubles the interval
+        hints = []
+        for _ in range(3):
+            result = post(43.0376045, -76.1325)
+            self.assertFalse(result["moved"])
+            hints.append(result["next_update_ms"])
+        self.assertEqual(hints, [BASE_UPDATE_INTERVAL_MS * 2, BASE_UPDATE_INTERVAL_MS * 4, BASE_UPDATE_INTERVAL_MS * 8])
+        self.assertEqual(self.routes_instance.sessions.get_location(session_id)[:2], (43.0376, -76.1325))
+        self.assertEqual(len(self.client1.get(f"/trail/{session_id}").get_json()["points"]), 1)
+
+        # A real move (about 11 m) resets the backoff
+        moved = post(43.0377, -76.1325)
+        self.assertTrue(moved["moved"])
+        self.assertEqual(moved["next_update_ms"], BASE_UPDATE_INTERVAL_MS)
+        self.assertEqual(len(self.client1.get(f"/trail/{session_id}").get_json()["points"]), 2)
+
+        # Load above the target stretches the interval proportionally, within the cap
+        self.assertEqual(suggest_update_interval_ms(0, TARGET_UPDATES_PER_SECOND * 2), BASE_UPDATE_INTERVAL_MS * 2)
+        self.assertEqual(suggest_update_interval_ms(10, TARGET_UPDATES_PER_SECOND * 2), MAX_UPDATE_INTERVAL_MS)
+
     def test_index_route(self):
         """
         Test if the index route returns HTTP status 200 (OK)
@@ -522,11 +912,13 @@ class TestRoutes(unittest.TestCase):
         Test if /heatmap-data returns HTTP 200 and correct data
         when the DB returns multiple valid entries.
         """
-        mock_data = {
-            1: {"download": 10.5, "location": {"latitude": 43.0376, "longitude": -76.1326}},
-            2: {"download": 20.0, "location": {"latitude": 43.0374, "longitude": -76.1324}}
-        }
-        self.routes_instance.db_handler.get_data = MagicMock(return_value=mock_data)
+        # Rows as streamed by iter_data(): (unique_id, download, upload, ping, latitude, longitude)
+        mock_rows = [
+            (1, 10.5, 5.0, 20.0, 43.0376, -76.1326),
+            (2, 20.0, 5.0, 20.0, 43.0374, -76.1324)
+        ]
+        self.routes_instance.db_handler.iter_data = MagicMock(return_value=iter(mock_rows))
+        self.routes_instance.rebuild_heatmap()
 
         response = self.client1.get("/heatmap-data")
         data = response.get_json()
@@ -542,11 +934,12 @@ class TestRoutes(unittest.TestCase):
         """
         Test if /heatmap-data treats 'Fail' download values as 0.0.
         """
-        mock_data = {
-            1: {"download": "Fail", "location": {"latitude": 43.0376, "longitude": -76.1326}},
-            2: {"download": 5.0, "location": {"latitude": 43.0375, "longitude": -76.1325}}
-        }
-        self.routes_instance.db_handler.get_data = MagicMock(return_value=mock_data)
+        mock_rows = [
+            (1, "Fail", 5.0, 20.0, 43.0376, -76.1326),
+            (2, 5.0, 5.0, 20.0, 43.0375, -76.1325)
+        ]
+        self.routes_instance.db_handler.iter_data = MagicMock(return_value=iter(mock_rows))
+        self.routes_instance.rebuild_heatmap()
 
         response = self.client1.get("/heatmap-data")
         data = response.get_json()
@@ -560,11 +953,12 @@ class TestRoutes(unittest.TestCase):
         """
         Test if /heatmap-data skips entries with invalid lat/lon values.
         """
-        mock_data = {
-            1: {"download": 10.0, "location": {"latitude": None, "longitude": None}},
-            2: {"download": 20.0, "location": {"latitude": "bad", "longitude": "data"}},
-        }
-        self.routes_instance.db_handler.get_data = MagicMock(return_value=mock_data)
+        mock_rows = [
+            (1, 10.0, 5.0, 20.0, None, None),
+            (2, 20.0, 5.0, 20.0, "bad", "data"),
+        ]
+        self.routes_instance.db_handler.iter_data = MagicMock(return_value=iter(mock_rows))
+        self.routes_instance.rebuild_heatmap()
 
         response = self.client1.get("/heatmap-data")
         data = response.get_json()
@@ -579,7 +973,8 @@ class TestRoutes(unittest.TestCase):
         """
         Test if /heatmap-data returns an empty list and max = 1.0 when DB returns no data.
         """
-        self.routes_instance.db_handler.get_data = MagicMock(return_value={})
+        self.routes_instance.db_handler.iter_data = MagicMock(return_value=iter([]))
+        self.routes_instance.rebuild_heatmap()
 
         response = self.client1.get("/heatmap-data")
         data = response.get_json()
@@ -589,5 +984,757 @@ class TestRoutes(unittest.TestCase):
         self.assertEqual(data["data"], [])
         self.assertEqual(data["max"], 1.0)
 
+    def test_heatmap_data_incremental_pair(self):
+        """
+        Test if a completed speed/location pair appears in /heatmap-data
+        without the database being re-read.
+        """
+        session_id = "heatmap-incremental-session"
+        unique_id = 246810
+        self.routes_instance.db_handler.iter_data = MagicMock(return_value=iter([]))
+        self.routes_instance.rebuild_heatmap()
+        self.routes_instance.sessions.set_test_id(session_id, unique_id)
+        self.routes_instance.db_handler.save_speed_test = MagicMock(return_value=True)
+        self.routes_instance.db_handler.save_location = MagicMock(return_value=True)
+
+        self.client1.post("/submit-speed", json={"dlStatus": "42.5", "session_id": session_id})
+        # Speed result alone is not a heatmap point yet
+        self.assertEqual(self.client1.get("/heatmap-data").get_json()["data"], [])
+
+        self.client1.post("/save_location", json={"id": unique_id, "latitude": 43.0376, "longitude": -76.1326})
+        data = self.client1.get("/heatmap-data").get_json()
+
+        self.assertEqual(len(data["data"]), 1)
+        self.assertAlmostEqual(data["max"], 42.5)
+        # The aggregate is served from memory, not rebuilt per request
+        self.routes_instance.db_handler.iter_data.assert_called_once()
+
+    def test_heatmap_png_rendered_and_cached(self):
+        """
+        Test if /heatmap.png returns a floor-plan sized PNG that is only
+        re-rendered after the heatmap data changes.
+        """
+        mock_rows = [(1, 10.5, 5.0, 20.0, 43.0376, -76.1326)]
+        self.routes_instance.db_handler.iter_data = MagicMock(return_value=iter(mock_rows))
+        self.routes_instance.rebuild_heatmap()
+
+        response1 = self.client1.get("/heatmap.png")
+        self.assertEqual(response1.status_code, 200)
+        self.assertEqual(response1.mimetype, "image/png")
+        self.assertTrue(response1.data.startswith(b"\x89PNG\r\n\x1a\n"))
+        # IHDR width and height match the floor plan image
+        width, height = struct.unpack(">II", response1.data[16:24])
+        self.assertEqual((width, height), (IMAGE_WIDTH, IMAGE_HEIGHT))
+
+        # Unchanged data returns the cached image
+        response2 = self.client1.get("/heatmap.png")
+        self.assertIs(self.routes_instance.heatmap_renderer.png(), self.routes_instance.heatmap_renderer.png())
+        self.assertEqual(response1.data, response2.data)
+
+        # A new completed pair invalidates the cache
+        self.routes_instance.heatmap.add_speed_test(2, 99.0)
+        self.routes_instance.heatmap.add_location(2, 43.0374, -76.1324)
+        response3 = self.client1.get("/heatmap.png")
+        self.assertNotEqual(response1.data, response3.data)
+
+    def test_heatmap_data_binned_levels(self):
+        """
+        Test if /heatmap-data?level= and ?cell_size= return one aggregated
+        point per occupied grid cell.
+        """
+        # Two measurements share a pixel region, one is far away
+        mock_rows = [
+            (1, 10.0, 5.0, 20.0, 43.0376, -76.1326),
+            (2, 30.0, 5.0, 20.0, 43.0376, -76.1326),
+            (3, 50.0, 5.0, 20.0, 43.0373, -76.1322),
+        ]
+        self.routes_instance.db_handler.iter_data = MagicMock(return_value=iter(mock_rows))
+        self.routes_instance.rebuild_heatmap()
+
+        data = self.client1.get("/heatmap-data?level=4").get_json()
+        self.assertEqual(data["cell_size"], 16)
+        self.assertEqual(len(data["data"]), 2)
+        shared = max(data["data"], key=lambda point: point["count"])
+        self.assertEqual(shared["count"], 2)
+        self.assertAlmostEqual(shared["value"], 20.0)
+        self.assertAlmostEqual(shared["min"], 10.0)
+        self.assertAlmostEqual(shared["max"], 30.0)
+        self.assertAlmostEqual(data["max"], 50.0)
+
+        # cell_size is rounded up to the next level; the coarsest level holds one cell
+        self.assertEqual(self.client1.get("/heatmap-data?cell_size=12").get_json()["level"], 4)
+        coarsest = self.client1.get("/heatmap-data?cell_size=100000").get_json()
+        self.assertEqual([point["count"] for point in coarsest["data"]], [3])
+
+        self.assertEqual(self.client1.get("/heatmap-data?level=99").status_code, 400)
+        self.assertEqual(self.client1.get("/heatmap-data?cell_size=abc").status_code, 400)
+
+        # A saved measurement is folded into the existing levels, not rebuilt from scratch
+        pyramid = self.routes_instance.heatmap_pyramid
+        rebuilds = pyramid.rebuilds
+        self.routes_instance.heatmap.add_speed_test(4, 70.0)
+        self.routes_instance.heatmap.add_location(4, 43.0376, -76.1326)
+        shared = max(self.client1.get("/heatmap-data?level=4").get_json()["data"], key=lambda point: point["count"])
+        self.assertEqual((shared["count"], shared["max"]), (3, 70.0))
+        self.assertEqual(pyramid.rebuilds, rebuilds)
+
+    def test_heatmap_pyramid_incremental_updates(self):
+        """
+        Test if inserts, moves, speed changes and removals applied incrementally leave
+        every pyramid level identical to a pyramid built from scratch, without a full
+        rebuild, and if falling behind the aggregate's change log forces one.
+        """
+        # Pixels straight from the coordinates; negative latitudes cannot be mapped
+        aggregate = HeatmapAggregate(lambda lat, lon: (int(lat), int(lon), True) if lat >= 0 else (None, None, False))
+        aggregate.rebuild([(i, 10.0 + i, 0, 0, i * 7 % 64, i * 13 % 64) for i in range(50)])
+        pyramid = HeatmapPyramid(aggregate, 64, 64)
+        levels = range(pyramid.num_levels)
+        for level in levels:
+            pyramid.payload_json(level)
+        rng = random.Random(5)
+        for step in range(300):
+            unique_id = rng.randrange(80)
+            if rng.random() < 0.5:
+                aggregate.add_speed_test(unique_id, rng.choice([0.0, 5.0, rng.uniform(0, 100)]))
+            lat = rng.choice([-1, rng.randrange(64), rng.randrange(4)])
+            aggregate.add_location(unique_id, lat, rng.randrange(64))
+            if step % 25 == 0:
+                expected = HeatmapPyramid(aggregate, 64, 64)
+                for level in levels:
+                    actual, fresh = json.loads(pyramid.payload_json(level)), json.loads(expected.payload_json(level))
+                    self.assertEqual(len(actual["data"]), len(fresh["data"]))
+                    for point, fresh_point in zip(actual["data"], fresh["data"]):
+                        self.assertEqual({k: v for k, v in point.items() if k != "value"},
+                                         {k: v for k, v in fresh_point.items() if k != "value"})
+                        self.assertAlmostEqual(point["value"], fresh_point["value"])
+        self.assertEqual(pyramid.rebuilds, 1)
+        # After a rebuild of the aggregate (or too many changes) the pyramid rebuilds too
+        aggregate.rebuild([(1, 5.0, 0, 0, 1, 1)])
+        self.assertEqual(json.loads(pyramid.payload_json(0))["data"][0]["count"], 1)
+        self.assertEqual(pyramid.rebuilds, 2)
+
+    def test_heatmap_data_conditional_get(self):
+        """
+        Test if /heatmap-data returns an ETag, answers a matching If-None-Match
+        with 304, and changes the ETag after a successful save.
+        """
+        response = self.client1.get("/heatmap-data")
+        etag = response.headers.get("ETag")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(etag)
+
+        # Unchanged data: 304 with no body
+        not_modified = self.client1.get("/heatmap-data", headers={"If-None-Match": etag})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.data, b"")
+
+        # A committed save bumps the data version
+        db_handler = self.routes_instance.db_handler
+        version = db_handler.data_version
+        unique_id = 9000100
+        try:
+            self.assertTrue(db_handler.save_location(43.0376, -76.1326, unique_id))
+        finally:
+            Location.objects.filter(unique_id=unique_id).delete()
+        self.assertGreater(db_handler.data_version, version)
+
+        modified = self.client1.get("/heatmap-data", headers={"If-None-Match": etag})
+        self.assertEqual(modified.status_code, 200)
+        self.assertNotEqual(modified.headers.get("ETag"), etag)
+
+        # Another instance over the same data (another worker, or this one after a
+        # restart) never reuses an ETag, and its data version starts from the stored rows
+        with patch.dict(os.environ, {"ACCESSPOINTER_POSITION_LOG_DIR": self.position_log_dir.name}):
+            restarted = Routes(Flask(__name__))
+        self.addCleanup(restarted.position_log.close)
+        self.assertEqual(restarted.app.test_client().get("/heatmap-data", headers={"If-None-Match": modified.headers["ETag"]}).status_code, 200)
+        self.assertGreater(restarted.db_handler.data_version, 0)
+
+    def test_heatmap_data_time_window(self):
+        """
+        Test if /heatmap-data?hours= and ?since=/&until= only include
+        speed tests saved inside the window.
+        """
+        db_handler = self.routes_instance.db_handler
+        recent_id, old_id = 9000200, 9000201
+        old_time = datetime.now(timezone.utc) - timedelta(days=30)
+        try:
+            for unique_id, download in ((recent_id, 11.0), (old_id, 22.0)):
+                db_handler.save_speed_test(download, 5.0, 20.0, unique_id)
+                db_handler.save_location(43.0376, -76.1326, unique_id)
+            Internet.objects.filter(unique_id=old_id).update(created_at=old_time)
+
+            recent = self.client1.get("/heatmap-data?hours=1").get_json()
+            self.assertEqual([point["value"] for point in recent["data"]], [11.0])
+
+            since = int((old_time - timedelta(hours=1)).timestamp())
+            until = (old_time + timedelta(hours=1)).isoformat()
+            window = self.client1.get("/heatmap-data", query_string={"since": since, "until": until}).get_json()
+            self.assertEqual([point["value"] for point in window["data"]], [22.0])
+        finally:
+            Internet.objects.filter(unique_id__in=[recent_id, old_id]).delete()
+            Location.objects.filter(unique_id__in=[recent_id, old_id]).delete()
+
+        self.assertEqual(self.client1.get("/heatmap-data?hours=-1").status_code, 400)
+        # Non-finite and unrepresentably long windows are rejected, not a server error
+        for hours in ("nan", "inf", "-inf", "1e8", "1e300"):
+            self.assertEqual(self.client1.get(f"/heatmap-data?hours={hours}").status_code, 400, hours)
+            self.assertEqual(self.client1.get(f"/replay/walker?hours={hours}").status_code, 400, hours)
+        self.assertEqual(self.client1.get("/heatmap-data?since=yesterday").status_code, 400)
+        self.assertEqual(self.client1.get("/heatmap-data?since=0&hours=1").status_code, 400)
+
+    def test_iter_data_matches_model_scan(self):
+        """
+        Test if the single joined query streams the same combined data
+        as scanning both model tables and merging them by unique_id.
+        """
+
+        # Merge the two full scans the way get_data() used to
+        expected = {}
+        for entry in Internet.objects.all():
+            expected[entry.unique_id] = (entry.download, entry.upload, entry.ping, None)
+        for entry in Location.objects.all():
+            if entry.unique_id in expected:
+                expected[entry.unique_id] = expected[entry.unique_id][:3] + ((entry.latitude, entry.longitude),)
+
+        # Stream the joined rows with a small chunk size to cross chunk boundaries
+        streamed = {}
+        for unique_id, download, upload, ping, latitude, longitude in self.routes_instance.db_handler.iter_data(chunk_size=7):
+            streamed[unique_id] = (download, upload, ping, None if latitude is None else (latitude, longitude))
+
+        self.assertEqual(streamed, expected)
+
+    def test_batch_mapping_matches_scalar(self):
+        """
+        Test if the vectorized mapping gives exactly the scalar results, including
+        out-of-bounds clamping, NaN/inf and values the scalar function cannot convert.
+        """
+        rng = random.Random(42)
+        latitudes = [43.037 + rng.uniform(-0.001, 0.002) for _ in range(500)]
+        longitudes = [-76.133 + rng.uniform(-0.001, 0.002) for _ in range(500)]
+        # Edge cases: bounds, non-finite values, numeric strings and unconvertible values
+        latitudes += [43.037278, 43.037944, float("nan"), float("inf"), "43.0375", None, "bad", 43.0375]
+        longitudes += [-76.132944, -76.132194, -76.1325, -76.1325, "-76.1325", -76.1325, -76.1325, float("-inf")]
+
+        xs, ys, in_bounds = map_lat_lon_to_pixels_batch(latitudes, longitudes)
+        with patch("builtins.print"):
+            for i, (lat, lon) in enumerate(zip(latitudes, longitudes)):
+                x_pixel, y_pixel, is_within_bounds = map_lat_lon_to_pixels(lat, lon)
+                batch_x = None if xs[i] == UNMAPPED_PIXEL else int(xs[i])
+                batch_y = None if ys[i] == UNMAPPED_PIXEL else int(ys[i])
+                self.assertEqual((batch_x, batch_y, bool(in_bounds[i])), (x_pixel, y_pixel, is_within_bounds))
+
+class TestDatabaseHandler(unittest.TestCase):
+    """Tests for the buffered write path of DatabaseHandler."""
+
+    # Test IDs outside the 6-digit range generated by the app
+    TEST_IDS = range(9000000, 9000020)
+
+    def tearDown(self):
+        """Remove any rows written by these tests."""
+        Location.objects.filter(unique_id__in=self.TEST_IDS).delete()
+
+    def test_concurrent_saves_share_batches(self):
+        """
+        Test if concurrent save_location calls are all committed
+        using fewer transactions than records.
+        """
+        db_handler = DatabaseHandler(flush_interval_ms=50)
+        results = []
+        with patch.object(db_handler.write_buffer, "_write_batch", wraps=db_handler.write_buffer._write_batch) as write_batch:
+            threads = [
+                threading.Thread(target=lambda uid=uid: results.append(db_handler.save_location(43.0376, -76.1326, uid)))
+                for uid in self.TEST_IDS
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            db_handler.close()
+
+        # Commit mode acknowledges only saved records
+        self.assertEqual(results, [True] * len(self.TEST_IDS))
+        self.assertEqual(Location.objects.filter(unique_id__in=self.TEST_IDS).count(), len(self.TEST_IDS))
+        self.assertLess(write_batch.call_count, len(self.TEST_IDS))
+
+    def test_enqueue_mode_flushes_on_close(self):
+        """
+        Test if enqueue mode acknowledges immediately and close() flushes the queue.
+        """
+        db_handler = DatabaseHandler(durability=DURABILITY_ENQUEUE, flush_interval_ms=1000)
+        unique_id = self.TEST_IDS[0]
+
+        self.assertTrue(db_handler.save_location(43.0376, -76.1326, unique_id))
+        db_handler.close()
+
+        self.assertEqual(Location.objects.filter(unique_id=unique_id).count(), 1)
+
+    def test_durability_from_environment_and_release(self):
+        """
+        Test if handlers created without a durability mode read it from the environment,
+        and if a dropped handler is freed with its queue flushed and its thread stopped.
+        """
+        with patch.dict(os.environ, {"ACCESSPOINTER_DB_DURABILITY": DURABILITY_ENQUEUE}):
+            db_handler = DatabaseHandler(flush_interval_ms=1000)
+            with self.assertRaises(ValueError):
+                with patch.dict(os.environ, {"ACCESSPOINTER_DB_DURABILITY": "sometimes"}):
+                    DatabaseHandler()
+        self.assertEqual(db_handler.durability, DURABILITY_ENQUEUE)
+        self.assertEqual(DatabaseHandler().durability, "commit")
+
+        unique_id = self.TEST_IDS[1]
+        self.assertTrue(db_handler.save_location(43.0376, -76.1326, unique_id))
+        thread = db_handler.write_buffer.thread
+        handler_ref = weakref.ref(db_handler)
+        del db_handler
+        gc.collect()
+        self.assertIsNone(handler_ref())
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(Location.objects.filter(unique_id=unique_id).count(), 1)
+
+class TestBackendRoutes(unittest.TestCase):
+    """Tests for the speed test backend routes defined in BackendRoutes.py."""
+
+    def setUp(self):
+        """Set up a test Flask app with the backend blueprint registered."""
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        self.app.register_blueprint(backend_bp)
+        self.client = self.app.test_client()
+
+    def test_garbage_streams_shared_block(self):
+        """
+        Test if /backend/garbage streams the pre-generated block ckSize times with a
+        matching Content-Length, without building the payload in memory.
+        """
+        response = self.client.get("/backend/garbage?ckSize=3", buffered=False)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers["Content-Length"], str(3 * len(PREGENERATED_DATA)))
+        chunks = list(response.response)
+        response.close()
+        self.assertEqual(len(chunks), 3)
+        # Every chunk is the shared block itself, not a copy
+        self.assertTrue(all(chunk is PREGENERATED_DATA for chunk in chunks))
+
+        # The size is clamped to 1024 blocks, and only the blocks actually read are produced
+        response = self.client.get("/backend/garbage?ckSize=5000", buffered=False)
+        self.assertEqual(response.headers["Content-Length"], str(1024 * len(PREGENERATED_DATA)))
+        self.assertIs(next(iter(response.response)), PREGENERATED_DATA)
+        response.close()
+        self.assertEqual(self.client.get("/backend/garbage?ckSize=abc").headers["Content-Length"], str(4 * len(PREGENERATED_DATA)))
+
+    def test_garbage_measures_downloads(self):
+        """
+        Test if /backend/garbage records, per test ID, only the blocks actually sent,
+        the time to first byte and whether each stream ran to the end.
+        """
+        # One full download of two blocks
+        self.assertEqual(len(self.client.get("/backend/garbage?ckSize=2&test_id=888").data), 2 * len(PREGENERATED_DATA))
+        # One download cancelled by the client after the first block was written
+        response = self.client.get("/backend/garbage?ckSize=100&test_id=888", buffered=False)
+        chunks = iter(response.response)
+        next(chunks)
+        next(chunks)
+        response.close()
+        # Nothing is recorded until a stream ends, or without a test ID
+        response = self.client.get("/backend/garbage?ckSize=2&test_id=889", buffered=False)
+        self.assertIsNone(self.client.get("/backend/transfer-stats/889").get_json()["download"])
+        response.close()
+        self.client.get("/backend/garbage?ckSize=1")
+
+        download = self.client.get("/backend/transfer-stats/888").get_json()["download"]
+        self.assertEqual((download["streams"], download["completed_streams"]), (2, 1))
+        self.assertEqual(download["bytes"], 3 * len(PREGENERATED_DATA))
+        self.assertGreater(download["mbps"], 0)
+        self.assertGreaterEqual(download["mean_ttfb_ms"], 0)
+        # A stream closed before anything was sent counts no bytes
+        self.assertEqual(self.client.get("/backend/transfer-stats/889").get_json()["download"]["bytes"], 0)
+
+
+    def test_get_ip_isp_lookup_cache(self):
+        """
+        Test if /backend/getIP resolves the ISP through the pluggable lookup (a records
+        file standing in for ipinfo.io), answers repeated IPs from the cache, caches
+        misses for the shorter negative TTL, evicts the least recently used IP, and if
+        the ipinfo.io backend reuses one pooled HTTP session.
+        """
+        records_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(records_dir.cleanup)
+        records_path = os.path.join(records_dir.name, "isp.json")
+        with open(records_path, "w") as records_file:
+            json.dump({"203.0.113.5": {"ip": "203.0.113.5", "org": "AS64500 Example Campus Net"},
+                       "203.0.113.6": {"ip": "203.0.113.6", "asn": {"name": "Example Transit"}}}, records_file)
+        backend = FileLookup(records_path)
+        backend.lookup = MagicMock(wraps=backend.lookup)
+        cache = CachedIspLookup(backend, max_entries=2, ttl_seconds=100, negative_ttl_seconds=10)
+
+        with patch.object(BackendRoutes, "isp_lookup", cache):
+            for _ in range(3):
+                data = self.client.get("/backend/getIP?isp", environ_base={"REMOTE_ADDR": "203.0.113.5"}).get_json()
+                self.assertEqual((data["ISP"], data["processedString"]), ("64500 Example Campus Net", "203.0.113.5 - 64500 Example Campus Net"))
+            self.assertEqual(data["rawIspInfo"]["org"], "AS64500 Example Campus Net")
+            self.assertEqual(backend.lookup.call_count, 1)
+            # Without 'isp', or for local addresses, nothing is looked up
+            self.assertIsNone(self.client.get("/backend/getIP", environ_base={"REMOTE_ADDR": "203.0.113.9"}).get_json()["ISP"])
+            self.assertEqual(self.client.get("/backend/getIP?isp", environ_base={"REMOTE_ADDR": "127.0.0.1"}).get_json()["ISP"], "localhost IPv4 access")
+            self.assertEqual(backend.lookup.call_count, 1)
+        # Without a configured lookup the response has no ISP
+        with patch.object(BackendRoutes, "isp_lookup", None):
+            self.assertIsNone(self.client.get("/backend/getIP?isp", environ_base={"REMOTE_ADDR": "203.0.113.5"}).get_json()["ISP"])
+
+        # Hits last until the TTL, misses until the negative TTL
+        self.assertEqual(cache.lookup("203.0.113.5", now=1e9)[0], "64500 Example Campus Net")
+        self.assertEqual(cache.lookup("203.0.113.9", now=1e9), (None, None))
+        cache.lookup("203.0.113.9", now=1e9 + 9)
+        self.assertEqual(backend.lookup.call_count, 3)
+        cache.lookup("203.0.113.9", now=1e9 + 11)
+        cache.lookup("203.0.113.5", now=1e9 + 99)
+        self.assertEqual(backend.lookup.call_count, 4)
+        # The least recently used IP is evicted
+        self.assertEqual(cache.lookup("203.0.113.6", now=1e9 + 99)[0], "Example Transit")
+        self.assertEqual((len(cache), list(cache.entries)), (2, ["203.0.113.5", "203.0.113.6"]))
+
+        # The ipinfo.io backend sends every lookup through its pooled session; failures give None
+        ipinfo = IpinfoLookup("token", base_url="http://127.0.0.1:9")
+        ipinfo.session.get = MagicMock(return_value=MagicMock(ok=True, json=lambda: {"org": "AS64501 Fixture ISP"}))
+        self.assertEqual(ipinfo.lookup("198.51.100.1"), ("64501 Fixture ISP", {"org": "AS64501 Fixture ISP"}))
+        ipinfo.session.get.assert_called_once_with("http://127.0.0.1:9/198.51.100.1/json", params={"token": "token"}, timeout=ipinfo.timeout)
+        ipinfo.session.get = MagicMock(side_effect=requests.exceptions.ConnectTimeout("timed out"))
+        self.assertIsNone(ipinfo.lookup("198.51.100.1"))
+
+    def test_get_ip_prefix_table(self):
+        """
+        Test if /backend/getIP resolves ISPs offline from a CSV prefix table, for IPv4,
+        IPv6 and IPv4-mapped addresses, with the most specific nested prefix winning.
+        """
+        table_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(table_dir.cleanup)
+        table_path = os.path.join(table_dir.name, "prefixes.csv")
+        with open(table_path, "w") as table_file:
+            table_file.write("network,isp,asn\n"
+                             "203.0.113.0/24,Campus Net,AS64500\n"
+                             "203.0.113.128/25,Campus Dorms,AS64500\n"
+                             "203.0.113.200/32,Campus Lab,AS64500\n"
+                             "198.51.100.0/24,Example Transit,AS64501\n"
+                             "2001:db8::/32,Example IPv6,AS64502\n"
+                             "2001:db8:1::/48,Example IPv6 Campus,AS64502\n")
+        table = create_isp_lookup(prefix_table=table_path, api_key="unused")
+        self.assertIsInstance(table, PrefixTableLookup)
+        self.assertEqual(len(table), 6)
+
+        with patch.object(BackendRoutes, "isp_lookup", table):
+            data = self.client.get("/backend/getIP?isp", environ_base={"REMOTE_ADDR": "203.0.113.130"}).get_json()
+            self.assertEqual((data["ISP"], data["rawIspInfo"]["network"], data["rawIspInfo"]["asn"]), ("Campus Dorms", "203.0.113.128/25", "AS64500"))
+            self.assertIsNone(self.client.get("/backend/getIP?isp", environ_base={"REMOTE_ADDR": "192.0.2.1"}).get_json()["ISP"])
+        expected = {
+            "203.0.113.0": "Campus Net", "203.0.113.127": "Campus Net", "203.0.113.128": "Campus Dorms",
+            "203.0.113.199": "Campus Dorms", "203.0.113.200": "Campus Lab", "203.0.113.201": "Campus Dorms",
+            "203.0.113.255": "Campus Dorms", "203.0.114.0": None, "198.51.100.7": "Example Transit",
+            "2001:db8::1": "Example IPv6", "2001:db8:1:ffff::1": "Example IPv6 Campus", "2001:db8:2::1": "Example IPv6",
+            "2001:db9::1": None, "::ffff:198.51.100.7": "Example Transit", "not-an-ip": None,
+        }
+        self.assertEqual({ip: (table.lookup(ip) or (None,))[0] for ip in expected}, expected)
+
+        with open(table_path, "w") as table_file:
+            table_file.write("prefix,isp\n10.0.0.0/8,Private\n")
+        with self.assertRaises(ValueError):
+            PrefixTableLookup(table_path)
+
+    def test_empty_drains_and_measures_uploads(self):
+        """
+        Test if /backend/empty reads upload bodies to the end and records the bytes and
+        server-side rate per test ID (parallel streams counted once in wall time), and if
+        /submit-speed reports that rate next to the client's number.
+        """
+        for _ in range(3):
+            response = self.client.post("/backend/empty?test_id=777&cors=true", data=b"x" * 300000)
+            self.assertEqual((response.status_code, response.data), (200, b""))
+        # Pings (no body) and uploads without a test ID are not recorded
+        self.client.get("/backend/empty?test_id=778")
+        self.client.post("/backend/empty", data=b"x" * 1000)
+
+        upload = self.client.get("/backend/transfer-stats/777").get_json()["upload"]
+        self.assertEqual((upload["streams"], upload["bytes"]), (3, 900000))
+        self.assertGreater(upload["mbps"], 0)
+        self.assertIsNone(self.client.get("/backend/transfer-stats/778").get_json()["upload"])
+
+        # Uploads the client aborts part way are still measured, as incomplete streams
+        class AbortingStream(io.BytesIO):
+            """Request body whose connection resets once its bytes are used up."""
+            def readinto(self, buffer):
+                count = super().readinto(buffer)
+                if not count:
+                    raise ConnectionResetError("client went away")
+                return count
+
+        truncated = io.BytesIO(b"x" * 100000)
+        for body in (truncated, AbortingStream(b"x" * 200000)):
+            response = self.client.post("/backend/empty?test_id=779", input_stream=body,
+                                        environ_overrides={"CONTENT_LENGTH": "300000"})
+            self.assertEqual(response.status_code, 200)
+        partial = self.client.get("/backend/transfer-stats/779").get_json()["upload"]
+        self.assertEqual((partial["streams"], partial["completed_streams"], partial["bytes"]), (2, 0, 300000))
+        self.assertGreater(partial["mbps"], 0)
+
+        # The ledger counts overlapping streams once in wall time and stays bounded
+        ledger = TransferLedger(max_tests=2)
+        ledger.record("a", 1000000, 10.0, 12.0)
+        ledger.record("a", 1000000, 11.0, 12.0)
+        self.assertEqual(ledger.summary("a"), {"streams": 2, "completed_streams": 2, "bytes": 2000000,
+                                               "seconds": 2.0, "mbps": 8.0, "mean_ttfb_ms": None})
+        ledger.record("b", 1, 0.0, 1.0)
+        ledger.record("c", 1, 0.0, 1.0)
+        self.assertIsNone(ledger.summary("a"))
+
+        # The backend routes record into the same ledgers the main routes read
+        self.assertIs(BackendRoutes.upload_ledger, TransferStats.upload_ledger)
+        self.assertIs(routes_module.download_ledger, TransferStats.download_ledger)
+
+        # /submit-speed returns the server-measured upload rate for the test run
+        position_log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(position_log_dir.cleanup)
+        with patch.dict(os.environ, {"ACCESSPOINTER_POSITION_LOG_DIR": position_log_dir.name}):
+            routes = Routes(Flask(__name__))
+        routes.db_handler.save_speed_test = MagicMock(return_value=False)
+        routes.sessions.set_test_id("upload-session", 777)
+        response = routes.app.test_client().post("/submit-speed", json={"session_id": "upload-session", "dlStatus": "10", "ulStatus": "5", "pingStatus": "20"})
+        self.assertAlmostEqual(response.get_json()["server_upload_mbps"], upload["mbps"])
+        self.assertIsNone(response.get_json()["server_download_mbps"])
+
+
+class TestSessionBackends(unittest.TestCase):
+    """Tests for the shared SQLite session backend, used when running several worker processes."""
+
+    def setUp(self):
+        """Point the session backend at a fresh SQLite file shared by two app instances."""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, "sessions.sqlite3")
+        self.parity_db_path = os.path.join(self.temp_dir.name, "parity.sqlite3")
+        environment = {"ACCESSPOINTER_SESSION_BACKEND": "sqlite", "ACCESSPOINTER_SESSION_DB": self.db_path,
+                       "ACCESSPOINTER_POSITION_LOG_DIR": os.path.join(self.temp_dir.name, "positions")}
+        with patch.dict(os.environ, environment):
+            # Two Routes instances stand in for two worker processes
+            self.workers = [Routes(Flask(__name__)) for _ in range(2)]
+        self.clients = [worker.app.test_client() for worker in self.workers]
+
+    def tearDown(self):
+        """Close the SQLite connections and delete the temporary file."""
+        for worker in self.workers:
+            worker.sessions.close()
+            worker.position_log.close()
+        self.temp_dir.cleanup()
+
+    def test_sessions_shared_between_workers(self):
+        """
+        Test if a test ID and live location recorded by one worker are visible
+        to the other, which could not work with per-process session dicts.
+        """
+        session_id = "shared-session"
+        unique_id = self.clients[0].get(f"/generate_unique_id?session_id={session_id}").get_json()["id"]
+        self.workers[1].db_handler.save_speed_test = MagicMock(return_value=False)
+        response = self.clients[1].post("/submit-speed", json={"session_id": session_id, "dlStatus": "10", "ulStatus": "5", "pingStatus": "20"})
+        self.assertEqual(response.status_code, 200)
+        self.workers[1].db_handler.save_speed_test.assert_called_once_with(10.0, 5.0, 20.0, unique_id)
+
+        self.clients[0].post("/save_user_location", json={"session_id": session_id, "latitude": 43.0376, "longitude": -76.1325})
+        self.clients[0].post("/save_user_location", json={"session_id": session_id, "latitude": 43.0377, "longitude": -76.1326})
+        # Worker 1 sees the position smoothed by worker 0, and the raw fix behind it
+        smoothed_lat, smoothed_lon, _ = self.workers[0].sessions.get_location(session_id)
+        live = self.clients[1].get(f"/get-live-location/{session_id}?raw=1").get_json()
+        self.assertEqual((live["x"], live["y"], live["in_bounds"]), map_lat_lon_to_pixels(smoothed_lat, smoothed_lon))
+        self.assertEqual((live["raw"]["x"], live["raw"]["y"], live["raw"]["in_bounds"]), map_lat_lon_to_pixels(43.0377, -76.1326))
+        self.assertEqual(len(self.clients[1].get(f"/trail/{session_id}").get_json()["points"]), 2)
+        self.assertIn(session_id, self.clients[1].get("/live-locations").get_json()["sessions"])
+        nearby = self.clients[1].get(f"/sessions/nearby?latitude={smoothed_lat}&longitude={smoothed_lon}&radius=1").get_json()["sessions"]
+        self.assertEqual([r["session_id"] for r in nearby], [session_id])
+
+        # The other worker's occupancy grid follows moves and removals
+        x, y, _ = map_lat_lon_to_pixels(smoothed_lat, smoothed_lon)
+        cell_size = self.workers[1].occupancy.cell_size
+        occupancy = self.clients[1].get("/occupancy-data").get_json()
+        self.assertEqual(occupancy["sessions"], 1)
+        self.assertEqual([(p["x"] // cell_size, p["y"] // cell_size) for p in occupancy["data"]], [(x // cell_size, y // cell_size)])
+        self.workers[0].sessions.remove(session_id)
+        self.assertEqual(self.clients[1].get("/occupancy-data").get_json()["sessions"], 0)
+
+    def test_connections_closed_with_their_threads(self):
+        """
+        Test if the per-thread SQLite connections are closed when their threads exit,
+        so a thread per request does not leave one open connection per request.
+        """
+        store = self.workers[0].sessions
+        opened = []
+
+        def request_thread(i):
+            store.update_location(f"thread-{i}", 43.0376, -76.1325)
+            opened.append(store._connection())
+
+        for batch in range(10):
+            threads = [threading.Thread(target=request_thread, args=(batch * 30 + i,)) for i in range(30)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        gc.collect()
+
+        def is_open(connection):
+            try:
+                connection.execute("SELECT 1")
+                return True
+            except sqlite3.ProgrammingError:
+                return False
+
+        self.assertEqual(len(opened), 300)
+        self.assertEqual(sum(map(is_open, opened)), 0)
+        # Only this thread's connection (if any) is still tracked
+        self.assertLessEqual(len(store._connections), 1)
+        self.assertEqual(len(store), 300)
+        store.close()
+        self.assertEqual(len(store._connections), 0)
+
+    def test_backend_parity(self):
+        """
+        Test if the SQLite backend behaves like the in-memory store for updates,
+        trails, 'since' filtering, expiry and change notification across workers.
+        """
+        stores = [
+            SessionStore(trail_capacity=3),
+            SQLiteSessionStore(self.parity_db_path, 43.0376, -76.1326, trail_capacity=3),
+        ]
+        try:
+            for store in stores:
+                self.assertTrue(store.update_location("a", 1.0, 2.0, timestamp=100.0))
+                self.assertFalse(store.update_location("a", 1.0, 2.0, timestamp=101.0))
+                for i in range(4):
+                    store.update_location("a", 1.0 + i + 1, 2.0, timestamp=102.0 + i)
+                store.set_test_id("b", 42, timestamp=200.0)
+                self.assertEqual(store.get_location("a"), (5.0, 2.0, 105.0))
+                self.assertEqual(store.get_trail("a"), ([3.0, 4.0, 5.0], [2.0, 2.0, 2.0], [103.0, 104.0, 105.0]))
+                self.assertEqual(store.get_trail("a", 1), ([5.0], [2.0], [105.0]))
+                self.assertEqual(store.get_test_id("b"), 42)
+                self.assertEqual(store.locations(["a", "b"], since=104.5), {"a": (5.0, 2.0, 105.0), "b": None})
+                self.assertEqual(store.locations(since=105.0), {})
+                # Coalesced fixes keep the position but refresh the timestamp
+                self.assertEqual(store.record_fix("a", 5.000001, 2.0, 2.0, timestamp=106.0), (False, 1))
+                self.assertEqual(store.get_location("a"), (5.0, 2.0, 106.0))
+                self.assertEqual(len(store.get_trail("a")[0]), 3)
+                self.assertEqual(store.expire(50, now=180.0), ["a"])
+                self.assertEqual((store.get_location("a"), store.get_test_id("b"), len(store)), (None, 42, 1))
+
+            # A change written by another worker wakes a waiter (via the cross-process poll)
+            other = SQLiteSessionStore(self.parity_db_path, 43.0376, -76.1326)
+            sequence, location = stores[1].wait_for_location_change("c", None, 0)
+            self.assertEqual((sequence, location), (-1, None))
+            mover = threading.Timer(0.1, lambda: other.update_location("c", 3.0, 4.0, timestamp=300.0))
+            mover.start()
+            sequence, location = stores[1].wait_for_location_change("c", sequence, 5)
+            mover.join()
+            other.close()
+            self.assertEqual(location, (3.0, 4.0, 300.0))
+        finally:
+            stores[1].close()
+
+    def test_expiry_with_out_of_order_timestamps(self):
+        """
+        Test if sessions touched with decreasing explicit timestamps still expire by
+        their latest activity in both backends, even when they share a shard, and if
+        a backend missing an abstract method cannot be created.
+        """
+        stores = [
+            SessionStore(num_shards=1),
+            SQLiteSessionStore(os.path.join(self.temp_dir.name, "order.sqlite3"), 43.0376, -76.1326),
+        ]
+        try:
+            for store in stores:
+                store.set_test_id("late", 1, timestamp=500.0)
+                store.update_location("early", 1.0, 2.0, timestamp=400.0)
+                store.set_test_id("middle", 2, timestamp=450.0)
+                # A touch older than the session's last activity does not make it idle
+                store.set_test_id("late", 3, timestamp=300.0)
+                self.assertEqual(store.expire(60, now=505.0), ["early"])
+                self.assertEqual(store.expire(60, now=515.0), ["middle"])
+                self.assertEqual(store.expire(60, now=555.0), [])
+                self.assertEqual(store.expire(60, now=565.0), ["late"])
+        finally:
+            stores[1].close()
+
+        class IncompleteBackend(SessionBackend):
+            def record_fix(self, session_id, latitude, longitude, min_distance_meters=0.0, timestamp=None, accuracy=None):
+                return True, 0
+        with self.assertRaises(TypeError):
+            IncompleteBackend()
+
+    def test_location_smoothing(self):
+        """
+        Test if the Kalman filter on ingest damps GPS jitter, so a device standing still
+        leaves (almost) no trail writes, while a walking device is still tracked, and if
+        both backends keep the filter state and the raw fixes identically.
+        """
+        origin_lat, origin_lon = 43.0376, -76.1326
+        meters_lon = METERS_PER_DEGREE * math.cos(math.radians(origin_lat))
+        stores = [
+            SessionStore(location_filter=PositionFilter(origin_lat, origin_lon)),
+            SQLiteSessionStore(self.parity_db_path, origin_lat, origin_lon, location_filter=PositionFilter(origin_lat, origin_lon)),
+        ]
+        unfiltered = SessionStore()
+        try:
+            # Standing still with about 4 m of noise per fix, one fix per second
+            rng = random.Random(3)
+            fixes = [(origin_lat + rng.gauss(0, 4) / METERS_PER_DEGREE, origin_lon + rng.gauss(0, 4) / meters_lon) for _ in range(30)]
+            for store in stores + [unfiltered]:
+                for i, (lat, lon) in enumerate(fixes):
+                    store.record_fix("still", lat, lon, MOVEMENT_THRESHOLD_METERS, timestamp=1000.0 + i, accuracy=4.0)
+            self.assertEqual(stores[0].get_location("still"), stores[1].get_location("still"))
+            self.assertEqual(stores[1].get_raw_location("still"), fixes[-1] + (1029.0,))
+            smoothed_writes = len(stores[0].get_trail("still")[0])
+            self.assertLess(smoothed_writes, len(unfiltered.get_trail("still")[0]) * 0.7)
+            self.assertEqual(len(stores[1].get_trail("still")[0]), smoothed_writes)
+            # The smoothed track stays closer to the true position than the raw fixes
+            state, smoothed_errors = None, []
+            for i, (lat, lon) in enumerate(fixes):
+                state, smoothed_lat, smoothed_lon = stores[0].location_filter.step(state, lat, lon, 1000.0 + i, 4.0)
+                smoothed_errors.append(distance_meters(origin_lat, origin_lon, smoothed_lat, smoothed_lon))
+            raw_errors = [distance_meters(origin_lat, origin_lon, lat, lon) for lat, lon in fixes]
+            self.assertLess(sum(smoothed_errors[5:]), sum(raw_errors[5:]) * 0.8)
+
+            # Walking north at 1.2 m/s: the smoothed track follows within a few meters
+            for i in range(30):
+                north = 1.2 * i + rng.gauss(0, 3)
+                for store in stores:
+                    store.record_fix("walker", origin_lat + north / METERS_PER_DEGREE, origin_lon, MOVEMENT_THRESHOLD_METERS, timestamp=2000.0 + i)
+            self.assertEqual(stores[0].get_location("walker"), stores[1].get_location("walker"))
+            self.assertLess(distance_meters(origin_lat + 1.2 * 29 / METERS_PER_DEGREE, origin_lon, *stores[0].get_location("walker")[:2]), 4.0)
+        finally:
+            stores[1].close()
+
+    def test_backed_off_device_keeps_track(self):
+        """
+        Test if a stationary device polling at the longest suggested interval (plus
+        network latency) keeps its filter track instead of restarting it at every raw
+        fix, so its GPS jitter stays smoothed and it stays backed off.
+        """
+        origin_lat, origin_lon = 43.0376, -76.1326
+        meters_lon = METERS_PER_DEGREE * math.cos(math.radians(origin_lat))
+        self.assertGreater(MAX_GAP_SECONDS, MAX_UPDATE_INTERVAL_MS / 1000 + 5)
+        store = SessionStore(location_filter=PositionFilter(origin_lat, origin_lon))
+        rng = random.Random(7)
+        interval_seconds = MAX_UPDATE_INTERVAL_MS / 1000 + 1
+        moves, intervals = 0, []
+        for i in range(20):
+            lat = origin_lat + rng.gauss(0, 3) / METERS_PER_DEGREE
+            lon = origin_lon + rng.gauss(0, 3) / meters_lon
+            moved, stationary_updates = store.record_fix("desk", lat, lon, MOVEMENT_THRESHOLD_METERS,
+                                                         timestamp=1000.0 + i * interval_seconds, accuracy=3.0)
+            moves += moved
+            intervals.append(suggest_update_interval_ms(stationary_updates, 0.0))
+        # A restarted track would sit exactly on the raw fix with the fix's variance
+        state = store._shard("desk").records["desk"].filter_state
+        self.assertLess(state[5], 3.0 ** 2)
+        self.assertNotEqual(store.get_location("desk")[:2], store.get_raw_location("desk")[:2])
+        # Jitter no longer counts as movement: the interval stays at the cap
+        self.assertLessEqual(moves, 3)
+        self.assertEqual(intervals[-10:], [MAX_UPDATE_INTERVAL_MS] * 10)
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -74,10 +75,36 @@ WSGI_APPLICATION = 'database.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLite connection profile, applied to every new connection via init_command.
+# WAL lets heatmap reads run while measurements are being written, and
+# busy_timeout makes a blocked connection wait instead of failing with
+# "database is locked".
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL', # Durable with WAL; fsync happens at checkpoints.
+    'busy_timeout': 5000, # Milliseconds to wait for a lock.
+    'mmap_size': 134217728, # Read up to 128 MiB of the file through memory mapping.
+    'cache_size': -16000, # Negative values are KiB: ~16 MiB page cache per connection.
+}
+# Take the write lock when a transaction starts, so a reader never has to
+# upgrade its lock mid-transaction (which fails immediately with SQLITE_BUSY).
+SQLITE_TRANSACTION_MODE = 'IMMEDIATE'
+
+
+def sqlite_init_command(pragmas: dict) -> str:
+    """Builds the init_command string that applies the given PRAGMAs."""
+    return ';'.join(f'PRAGMA {name}={value}' for name, value in pragmas.items())
+
+
+# The database file can be redirected with ACCESSPOINTER_DB_PATH (used by Benchmark.py).
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('ACCESSPOINTER_DB_PATH', BASE_DIR / 'db.sqlite3'),
+        'OPTIONS': {
+            'init_command': sqlite_init_command(SQLITE_PRAGMAS),
+            'transaction_mode': SQLITE_TRANSACTION_MODE,
+        },
     }
 }
 
@@ -0,0 +1,112 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:09
+
+from django.db import migrations, models
+
+
+def parse_coordinate(value) -> float:
+    """
+    Parses a stored coordinate, accepting a decimal comma ("12,5") as written by
+    some client locales.
+
+    Raises:
+        TypeError, ValueError: If the value is not a number in either form.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return float(value.replace(",", "."))
+
+
+def normalize_coordinates(apps, schema_editor):
+    """
+    Prepares Location rows for the CharField -> FloatField change.
+    SQLite only converts text that is already a plain number when the table is
+    rebuilt, so coordinates are rewritten in canonical float form. The FloatField
+    columns are NOT NULL and a row without a position is useless to the heatmap
+    join, so rows whose coordinates cannot be parsed at all are removed; each one
+    is logged with its values and the total is reported at the end.
+    """
+    Location = apps.get_model('myapp', 'Location')
+    dropped = []
+    for location in Location.objects.all().iterator():
+        try:
+            latitude = parse_coordinate(location.latitude)
+            longitude = parse_coordinate(location.longitude)
+        except (TypeError, ValueError):
+            print(f"Removing location {location.pk} (ID {location.unique_id}) with non-numeric coordinates "
+                  f"({location.latitude!r}, {location.longitude!r})")
+            dropped.append(location.pk)
+            continue
+        if (str(latitude), str(longitude)) != (location.latitude, location.longitude):
+            Location.objects.filter(pk=location.pk).update(latitude=str(latitude), longitude=str(longitude))
+    if dropped:
+        Location.objects.filter(pk__in=dropped).delete()
+        print(f"Removed {len(dropped)} location row(s) with non-numeric coordinates out of {Location.objects.count() + len(dropped)}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_alter_internet_unique_id_alter_location_unique_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_coordinates, migrations.RunPython.noop),
+        # Existing rows keep a NULL created_at (their save time is unknown); adding the
+        # column with auto_now_add directly would stamp them all with the migration time.
+        migrations.AddField(
+            model_name='internet',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='internet',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='internet',
+            name='download',
+            field=models.FloatField(),
+        ),
+        migrations.AlterField(
+            model_name='internet',
+            name='ping',
+            field=models.FloatField(),
+        ),
+        migrations.AlterField(
+            model_name='internet',
+            name='unique_id',
+            field=models.IntegerField(db_index=True, default=100000),
+        ),
+        migrations.AlterField(
+            model_name='internet',
+            name='upload',
+            field=models.FloatField(),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='latitude',
+            field=models.FloatField(),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='longitude',
+            field=models.FloatField(),
+        ),
+        migrations.AlterField(
+            model_name='location',
+            name='unique_id',
+            field=models.IntegerField(db_index=True, default=100000),
+        ),
+    ]
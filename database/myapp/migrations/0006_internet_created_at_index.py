@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0005_numeric_measurements_indexed_unique_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='internet',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, null=True),
+        ),
+    ]
@@ -3,18 +3,27 @@ from django.db import models
 # Create your models here.
 
 class Location(models.Model):
-    latitude = models.CharField(max_length=255)
-    longitude = models.CharField(max_length=255)
-    unique_id = models.IntegerField(default = 100000)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    # Not unique: a test ID gets a new row each time its position is saved, and the
+    # data join reads the latest one (MAX(id) per unique_id), which the index serves.
+    unique_id = models.IntegerField(default = 100000, db_index = True)
+    # When the row was saved; NULL for rows recorded before this field existed.
+    created_at = models.DateTimeField(auto_now_add = True, null = True)
 
     def __str__(self):
-        return self.latitude + ", " + self.longitude + f"\nid: {self.unique_id}"
+        return f"{self.latitude}, {self.longitude}\nid: {self.unique_id}"
 
 class Internet(models.Model):
-    download = models.IntegerField()
-    upload = models.IntegerField()
-    ping = models.IntegerField()
-    unique_id = models.IntegerField(default = 100000)
+    download = models.FloatField()
+    upload = models.FloatField()
+    ping = models.FloatField()
+    # Not unique either: repeated tests under one ID are kept, and readers let the
+    # later row win.
+    unique_id = models.IntegerField(default = 100000, db_index = True)
+    # When the measurement was saved; NULL for rows recorded before this field existed.
+    # Indexed so time-windowed heatmap queries are range scans.
+    created_at = models.DateTimeField(auto_now_add = True, null = True, db_index = True)
 
     def __str__(self):
-        return f"Download Speed: {self.download:.2f} Mbps\nUpload Speed: {self.upload:.2f} Mbps\nPing: {self.ping:.3f} ms\nid: {self.unique_id}"
\ No newline at end of file
+        return f"Download Speed: {self.download:.2f} Mbps\nUpload Speed: {self.upload:.2f} Mbps\nPing: {self.ping:.3f} ms\nid: {self.unique_id}"